@@ -0,0 +1,47 @@
+"""Compare two benchmark result files.
+
+Usage:
+    python -m benchmarks.compare before.jsonl after.jsonl
+"""
+
+import sys
+import json
+
+from collections import OrderedDict
+
+KEY_FIELDS = ('benchmark', 'n_triples', 'stage')
+VALUE_FIELDS = ('seconds', 'peak_bytes')
+
+
+def load_results(fname):
+    """
+    :param fname: json lines file written by benchmarks.run
+    :return results: {(benchmark, n_triples, stage): record}, last record wins
+    """
+    results = OrderedDict()
+    with open(fname, 'r') as f:
+        for line in f:
+            record = json.loads(line)
+            results[tuple(record.get(field) for field in KEY_FIELDS)] = record
+    return results
+
+def main():
+    if len(sys.argv) != 3:
+        sys.exit(__doc__)
+    before, after = load_results(sys.argv[1]), load_results(sys.argv[2])
+
+    print('\t'.join(KEY_FIELDS + tuple(
+        '{} {}'.format(field, which) for field in VALUE_FIELDS
+        for which in ('before', 'after', 'ratio'))))
+    for key in after:
+        if key not in before:
+            continue
+        row = [str(k) for k in key]
+        for field in VALUE_FIELDS:
+            old, new = before[key].get(field), after[key].get(field)
+            ratio = new / old if old and new is not None else None
+            row.extend('-' if v is None else '{:.4g}'.format(v) for v in (old, new, ratio))
+        print('\t'.join(row))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,423 @@
+"""End-to-end benchmarks of the GLIMPSE pipeline on synthetic KGs.
+
+Usage:
+    python -m benchmarks.run --sizes 10000 100000 --output results.jsonl
+
+Every stage of the pipeline is timed (and memory profiled with
+tracemalloc unless --no-memory is set) for each KG size, and one json
+record per (size, stage) is written so that results from two commits
+can be compared with benchmarks.compare. The 'spmv' benchmark times the
+transition matrix-vector product of random walks under each entity
+order of src/reorder.py, and with --spmv-threads on threads (see
+src/spmv.py), with its speedup over the loaded order on one thread.
+The 'names' benchmark looks up labels in a table of one per entity,
+from a dict loaded from the table as Freebase used to, and from the
+memory-mapped index of src/names.py right after opening it (cold) and
+again (warm).
+The 'clusters' benchmark simulates --cluster-users users drawing their
+topic entities from a few shared interest groups, and compares
+summarizing each of them with GLIMPSE with src/cluster.py's shared
+summaries, in users per second and in mean F1 on their test queries.
+With --dtypes, the pipeline also runs under other dtype policies of
+src/dtypes.py, and a 'dtype' record compares each one's F1 and memory
+with float64's.
+"""
+
+import gc
+import os
+import sys
+import shutil
+import json
+import time
+import random
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+
+import numpy as np
+
+from src.algorithms import query_vector, random_walk_with_restart
+from src.cluster import cluster_users, seed_distributions, shared_summaries
+from src.glimpse import GLIMPSE, Summary, greedy_select
+from src.heap import Heap
+from src.metrics import query_log_metrics
+from src.names import StringIndex, build_index
+from src.reorder import ORDERS, bandwidth
+from src import dtypes, spmv
+from src.synthetic import Synthetic
+from src.user import query_log_by_mids, split_log
+
+def git_commit():
+    """
+    :return commit: short hash of the checked out commit, or None
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def measure(fn, memory=True):
+    """
+    :param fn: function of no arguments to run
+    :param memory: trace peak Python memory allocated while running fn
+    :return result, stats: fn's return value and dict of measurements
+
+    Tracing memory slows down allocation-heavy stages, so timings
+    taken with memory=True are only comparable to each other.
+    """
+    gc.collect()
+    if memory:
+        tracemalloc.start()
+    t0, c0 = time.perf_counter(), time.process_time()
+    result = fn()
+    stats = {
+        'seconds': time.perf_counter() - t0,
+        'cpu_seconds': time.process_time() - c0
+    }
+    if memory:
+        stats['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, stats
+
+def run_pipeline(args, n_triples):
+    """
+    :param args: parsed command-line arguments
+    :param n_triples: number of triples in the synthetic KG
+    :return records: list of dict, one per pipeline stage
+    """
+    records = []
+
+    def record(stage, stats, **extra):
+        records.append(dict(stats, stage=stage, **extra))
+
+    KG = Synthetic(n_entities=max(1, n_triples // args.triples_per_entity),
+            n_relationships=args.n_relationships, n_triples=n_triples,
+            skew=args.skew, seed=args.seed)
+    _, stats = measure(KG.load, memory=args.memory)
+    record('load', stats)
+
+    # Simulate one user
+    KG.write_queries(args.n_topic_mids, args.n_queries_per_mid, seed=args.seed)
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    topic_mids = random.sample(sorted(KG.topic_mids()), k=min(10, args.n_topic_mids))
+    query_log = query_log_by_mids(KG, topic_mids, args.n_queries)
+    train_log, test_log = split_log(query_log, 0.5, np.random)
+    K = max(1, int(args.percent_triples * KG.number_of_triples()))
+
+    M, stats = measure(KG.transition_matrix, memory=args.memory)
+    record('transition_matrix', stats)
+
+    x = query_vector(KG, train_log)
+    _, stats = measure(lambda: random_walk_with_restart(M, x, power=args.power),
+            memory=args.memory)
+    record('random_walk_with_restart', stats)
+
+    _, stats = measure(lambda: KG.model_user_pref(train_log, power=args.power),
+            memory=args.memory)
+    record('model_user_pref', stats)
+
+    heap, stats = measure(lambda: Heap(KG), memory=args.memory)
+    record('heap', stats, heap_size=len(heap))
+
+    S = Summary(KG)
+    _, stats = measure(lambda: greedy_select(heap, S, K, epsilon=args.epsilon),
+            memory=args.memory)
+    record('greedy', stats, K=K)
+
+    _, stats = measure(lambda: S.fill(KG.ordered_triples(), K), memory=args.memory)
+    record('fill', stats)
+
+    metrics, stats = measure(lambda: query_log_metrics([S], test_log), memory=args.memory)
+    record('evaluate', stats, n_queries=len(test_log),
+            total=metrics[0]['total'], average=metrics[0]['average'])
+
+    for r in records:
+        r.update(benchmark='pipeline', n_triples=KG.number_of_triples(),
+                n_entities=KG.number_of_entities(), skew=args.skew)
+
+    shutil.rmtree(KG.data_dir_)
+    return records
+
+def run_spmv(args, n_triples):
+    """
+    :param args: parsed command-line arguments
+    :param n_triples: number of triples in the synthetic KG
+    :return records: list of dict, one per entity order
+    """
+    records = []
+    KG = Synthetic(n_entities=max(1, n_triples // args.triples_per_entity),
+            n_relationships=args.n_relationships, n_triples=n_triples,
+            skew=args.skew, seed=args.seed)
+    KG.load()
+    x = np.random.RandomState(args.seed).rand(KG.number_of_entities())
+
+    def products():
+        for _ in range(args.spmv_repeats):
+            M * y
+
+    loaded_seconds = None
+    threads = ('threads',) if args.spmv_threads > 1 else ()
+    for name in ('loaded',) + ORDERS + threads:
+        order, extra = None, {}
+        if name in ORDERS:
+            order, stats = measure(lambda: KG.reorder_entities(name), memory=False)
+            extra['reorder_seconds'] = stats['seconds']
+        M, y = KG.transition_matrix(), x if order is None else x[order]
+        if name == 'threads':
+            spmv.use_threads(args.spmv_threads)
+            M, extra['n_threads'] = spmv.operator(M), args.spmv_threads
+            extra['identical'] = bool(np.array_equal(M * y, KG.transition_matrix() * y))
+        _, stats = measure(products, memory=False)
+        spmv.use_scipy()
+        if loaded_seconds is None:
+            loaded_seconds = stats['seconds']
+
+        records.append(dict(stats, stage=name, repeats=args.spmv_repeats,
+            bandwidth=bandwidth(KG.transition_matrix()),
+            speedup=loaded_seconds / stats['seconds'], **extra))
+        if order is not None:
+            KG.reorder_entities(np.argsort(order)) # back to the loaded order
+
+    for r in records:
+        r.update(benchmark='spmv', n_triples=KG.number_of_triples(),
+                n_entities=KG.number_of_entities(), skew=args.skew)
+
+    shutil.rmtree(KG.data_dir_)
+    return records
+
+def run_names(args, n_triples):
+    """
+    :param args: parsed command-line arguments
+    :param n_triples: number of triples of the synthetic KG the table
+        has labels of
+    :return records: list of dict, one per way of looking up labels
+    """
+    records = []
+    n_names = max(1, n_triples // args.triples_per_entity)
+    rng = np.random.RandomState(args.seed)
+    mids = ['m.{:07x}'.format(i) for i in rng.permutation(n_names)]
+    queries = [mids[i] for i in rng.randint(n_names, size=args.name_lookups)]
+
+    data_dir = tempfile.mkdtemp(prefix='glimpse-names-')
+    tsv, fname = os.path.join(data_dir, 'names.tsv'), os.path.join(data_dir, 'names.idx')
+    with open(tsv, 'w') as f:
+        f.write('mid\tname\n')
+        for i, mid in enumerate(mids):
+            f.write('{}\tEntity {}\n'.format(mid, i))
+
+    def read_names():
+        with open(tsv, 'r') as f:
+            next(f)
+            for line in f:
+                yield line.rstrip().split('\t')
+
+    def lookups(names):
+        return [names.get(mid, mid) for mid in queries]
+
+    names, stats = measure(lambda: dict(read_names()), memory=args.memory)
+    records.append(dict(stats, stage='dict_load'))
+    expected, stats = measure(lambda: lookups(names), memory=args.memory)
+    records.append(dict(stats, stage='dict_lookups'))
+    del names
+
+    _, stats = measure(lambda: build_index(read_names(), fname), memory=args.memory)
+    records.append(dict(stats, stage='index_build', index_bytes=os.path.getsize(fname)))
+    index, stats = measure(lambda: StringIndex(fname), memory=args.memory)
+    records.append(dict(stats, stage='index_open'))
+    for stage in ('index_cold', 'index_warm'):
+        result, stats = measure(lambda: lookups(index), memory=args.memory)
+        records.append(dict(stats, stage=stage, identical=result == expected))
+    index.close()
+
+    for r in records:
+        r.update(benchmark='names', n_names=n_names, n_lookups=args.name_lookups)
+
+    shutil.rmtree(data_dir)
+    return records
+
+def run_clusters(args, n_triples):
+    """
+    :param args: parsed command-line arguments
+    :param n_triples: number of triples in the synthetic KG
+    :return records: list of dict, one per way of summarizing the users
+    """
+    records = []
+    KG = Synthetic(n_entities=max(1, n_triples // args.triples_per_entity),
+            n_relationships=args.n_relationships, n_triples=n_triples,
+            skew=args.skew, seed=args.seed)
+    KG.load()
+    KG.write_queries(args.n_topic_mids, args.n_queries_per_mid, seed=args.seed)
+    K = max(1, int(args.percent_triples * KG.number_of_triples()))
+
+    # Users of a group ask about overlapping samples of its topic entities
+    py_rng, rng = random.Random(args.seed), np.random.RandomState(args.seed)
+    topic_mids = sorted(KG.topic_mids())
+    groups = [py_rng.sample(topic_mids, k=min(10, len(topic_mids)))
+            for _ in range(args.cluster_groups)]
+    train_logs, test_logs = [], []
+    for user in range(args.cluster_users):
+        group = groups[user % len(groups)]
+        mids = py_rng.sample(group, k=max(1, len(group) * 3 // 4))
+        query_log = query_log_by_mids(KG, mids, args.n_queries, rng=rng, py_rng=py_rng)
+        train_log, test_log = split_log(query_log, 0.5, rng)
+        train_logs.append(train_log)
+        test_logs.append(test_log)
+    KG.transition_matrix()
+
+    def per_user():
+        return [GLIMPSE(KG, K, train_log, epsilon=args.epsilon, power=args.power)
+                for train_log in train_logs]
+
+    def shared():
+        return shared_summaries(KG, K, train_logs, similarity=args.cluster_similarity,
+                base_fraction=args.cluster_base_fraction, epsilon=args.epsilon,
+                power=args.power)
+
+    f1 = {}
+    for stage, summarize in (('per_user', per_user), ('shared', shared)):
+        np.random.seed(args.seed)
+        summaries, stats = measure(summarize, memory=args.memory)
+        f1[stage] = [query_log_metrics([S], test_log)[0]['total'][0]
+                for S, test_log in zip(summaries, test_logs)]
+        records.append(dict(stats, stage=stage, mean_f1=float(np.mean(f1[stage])),
+            users_per_second=args.cluster_users / stats['seconds']))
+
+    labels = cluster_users(seed_distributions(KG, train_logs), args.cluster_similarity)
+    per_user_seconds = records[0]['seconds']
+    records[1].update(n_clusters=len(set(labels)),
+            speedup=per_user_seconds / records[1]['seconds'],
+            mean_f1_delta=float(np.mean(f1['shared']) - np.mean(f1['per_user'])),
+            max_f1_loss=float(np.max(np.subtract(f1['per_user'], f1['shared']))))
+
+    for r in records:
+        r.update(benchmark='clusters', n_triples=KG.number_of_triples(), K=K,
+                n_users=args.cluster_users, n_groups=args.cluster_groups,
+                similarity=args.cluster_similarity,
+                base_fraction=args.cluster_base_fraction)
+
+    shutil.rmtree(KG.data_dir_)
+    return records
+
+def run_dtypes(args, n_triples):
+    """
+    :param args: parsed command-line arguments
+    :param n_triples: number of triples in the synthetic KG
+    :return records: pipeline records of each dtype policy, and one
+        record per policy comparing it with float64
+    """
+    records, evaluations, peaks = [], {}, {}
+    for policy in ['float64'] + [p for p in args.dtypes if p != 'float64']:
+        dtypes.set_policy(policy)
+        try:
+            pipeline = run_pipeline(args, n_triples)
+        finally:
+            dtypes.set_policy('float64')
+
+        for r in pipeline:
+            if r['stage'] == 'evaluate':
+                evaluations[policy] = r
+            peaks.setdefault(policy, {})[r['stage']] = r.get('peak_bytes')
+            if policy != 'float64':
+                r['benchmark'] = 'pipeline-{}'.format(policy)
+            r['dtype'] = policy
+        if policy == 'float64' and 'float64' not in args.dtypes:
+            continue
+        records += pipeline
+
+    for policy in args.dtypes:
+        if policy == 'float64':
+            continue
+        base, ev = evaluations['float64'], evaluations[policy]
+        records.append({
+            'benchmark': 'dtype', 'stage': policy, 'n_triples': ev['n_triples'],
+            'total': ev['total'], 'average': ev['average'],
+            'total_f1_delta': ev['total'][0] - base['total'][0],
+            'average_f1_delta': ev['average'][0] - base['average'][0],
+            'peak_bytes_ratio': {stage: peak / peaks['float64'][stage]
+                for stage, peak in peaks[policy].items()
+                if peak and peaks['float64'].get(stage)}
+        })
+    return records
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 30000, 100000],
+            help='Numbers of triples of the synthetic KGs. Default is 10000 30000 100000.')
+    parser.add_argument('--triples-per-entity', type=int, default=10,
+            help='Ratio of triples to entities. Default is 10.')
+    parser.add_argument('--n-relationships', type=int, default=50,
+            help='Number of relationships. Default is 50.')
+    parser.add_argument('--skew', type=float, default=1.,
+            help='Power-law exponent of entity degrees. Default is 1.')
+    parser.add_argument('--n-topic-mids', type=int, default=50,
+            help='Number of topic entities to generate queries for. Default is 50.')
+    parser.add_argument('--n-queries-per-mid', type=int, default=20,
+            help='Number of queries generated per topic entity. Default is 20.')
+    parser.add_argument('--n-queries', type=int, default=200,
+            help='Number of queries in the simulated user log. Default is 200.')
+    parser.add_argument('--percent-triples', type=float, default=0.01,
+            help='Ratio of number of triples of KG to use as K. Default is 0.01.')
+    parser.add_argument('--epsilon', type=float, default=1e-3,
+            help='GLIMPSE epsilon-from-optimal factor. Default is 1e-3.')
+    parser.add_argument('--power', type=int, default=1,
+            help='Number of terms in Taylor expansion. Default is 1.')
+    parser.add_argument('--seed', type=int, default=0,
+            help='Seed of the KG, queries and user. Default is 0.')
+    parser.add_argument('--spmv-repeats', type=int, default=20,
+            help='Number of products per entity order in the spmv benchmark, '
+                 '0 to skip it. Default is 20.')
+    parser.add_argument('--spmv-threads', type=int, default=1,
+            help='Also time the spmv benchmark on this many threads. Default is 1.')
+    parser.add_argument('--name-lookups', type=int, default=1000,
+            help='Number of label lookups in the names benchmark, 0 to skip it. '
+                 'Default is 1000.')
+    parser.add_argument('--cluster-users', type=int, default=20,
+            help='Number of users in the clusters benchmark, 0 to skip it. '
+                 'Default is 20.')
+    parser.add_argument('--cluster-groups', type=int, default=4,
+            help='Number of interest groups of the users of the clusters '
+                 'benchmark. Default is 4.')
+    parser.add_argument('--cluster-similarity', type=float, default=0.3,
+            help='Minimum similarity of users in a cluster. Default is 0.3.')
+    parser.add_argument('--cluster-base-fraction', type=float, default=0.5,
+            help='Share of K selected per cluster before personalizing. '
+                 'Default is 0.5.')
+    parser.add_argument('--dtypes', nargs='+', choices=sorted(dtypes.POLICIES),
+            default=['float64'],
+            help='Dtype policies to run the pipeline under. Default is float64.')
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+            help='Do not trace memory, for timings without tracemalloc overhead.')
+    parser.add_argument('--output', default='-',
+            help='File to append json lines results to. Default is stdout.')
+
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    commit = git_commit()
+
+    out = sys.stdout if args.output == '-' else open(args.output, 'a')
+    try:
+        for n_triples in args.sizes:
+            records = run_dtypes(args, n_triples) if args.dtypes != ['float64'] \
+                    else run_pipeline(args, n_triples)
+            if args.spmv_repeats > 0:
+                records += run_spmv(args, n_triples)
+            if args.name_lookups > 0:
+                records += run_names(args, n_triples)
+            if args.cluster_users > 0:
+                records += run_clusters(args, n_triples)
+            for record in records:
+                record['commit'] = commit
+                out.write(json.dumps(record) + '\n')
+                out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""Startup-time budget of the command-line interface.
+
+Usage:
+    python -m benchmarks.startup --output results.jsonl
+
+Times `main.py --help` and a small run on a synthetic KG in fresh
+interpreters, and exits with a non-zero status if the median time of
+either exceeds its budget, so that a slow import added at module level
+is caught before it reaches short batch jobs.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+import numpy as np
+
+from .run import git_commit
+
+MAIN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'main.py')
+
+SMALL_RUN = ['--kg', 'Synthetic', '--n_users', '1', '--n-topic-mids', '10',
+             '--n-queries', '50', '--method', 'glimpse', '--seed', '0']
+
+
+def time_command(argv, repeat):
+    """
+    :param argv: arguments to main.py
+    :param repeat: number of runs
+    :return seconds: list of wall-clock seconds of each run
+    """
+    seconds = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        subprocess.run([sys.executable, MAIN] + argv, check=True,
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        seconds.append(time.perf_counter() - t0)
+    return seconds
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--repeat', type=int, default=5,
+            help='Number of runs of each command. Default is 5.')
+    parser.add_argument('--help-budget', type=float, default=0.5,
+            help='Budget in seconds for main.py --help. Default is 0.5.')
+    parser.add_argument('--run-budget', type=float, default=10.,
+            help='Budget in seconds for a small synthetic run. Default is 10.')
+    parser.add_argument('--output', default='-',
+            help='File to append json lines results to. Default is stdout.')
+
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    commit = git_commit()
+
+    commands = [
+        ('help', ['--help'], args.help_budget),
+        ('small_run', SMALL_RUN, args.run_budget),
+    ]
+
+    over_budget = []
+    out = sys.stdout if args.output == '-' else open(args.output, 'a')
+    try:
+        for stage, argv, budget in commands:
+            seconds = time_command(argv, args.repeat)
+            record = {
+                'benchmark': 'startup', 'n_triples': None, 'stage': stage,
+                'seconds': float(np.median(seconds)), 'min_seconds': min(seconds),
+                'budget_seconds': budget, 'commit': commit
+            }
+            out.write(json.dumps(record) + '\n')
+            out.flush()
+
+            if record['seconds'] > budget:
+                over_budget.append(stage)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    if over_budget:
+        sys.exit('Over startup budget: {}'.format(', '.join(over_budget)))
+
+if __name__ == '__main__':
+    main()
@@ -1,64 +1,393 @@
 import argparse
 import random
 import logging
+import importlib
 
 logging.basicConfig(format='[%(asctime)s] - %(message)s',
                     level=logging.DEBUG)
 
 from time import time
-from sklearn.model_selection import train_test_split
 
-from src.base import YAGO, DBPedia, Freebase
-from src.user import query_log_by_mids, query_log_by_topics
-from src.glimpse import SummaryMethod, GLIMPSE
-from src.metrics import total_query_log_metrics, average_query_log_metrics
+from src import instrument
 
 
-# Available choices for user input arguments in main
+# Available choices for user input arguments in main. Entries name the
+# module and class or function to use, and are only imported and
+# constructed once selected, so unused KGs cost nothing at startup.
 # TODO: Change these to point to your local data directories
 KG_MAPPING = {
-    'YAGO': YAGO(query_dir='queries/final/', mid_dir='queries/by-mid/'),
-    'Freebase': Freebase(query_dir='queries/final/'),
-    'DBPedia': DBPedia()
+    'YAGO': ('src.base', 'YAGO', {'query_dir': 'queries/final/', 'mid_dir': 'queries/by-mid/'}),
+    'Freebase': ('src.base', 'Freebase', {'query_dir': 'queries/final/'}),
+    'DBPedia': ('src.base', 'DBPedia', {}),
+    'Synthetic': ('src.synthetic', 'Synthetic', {'n_topic_mids': 100}),
 }
 
 METHODS = {
-    'glimpse': SummaryMethod(GLIMPSE, 'GLIMPSE'),
-    'glimpse-2': SummaryMethod(GLIMPSE, 'GLIMPSE-2', power=2),
+    'glimpse': ('src.glimpse', 'GLIMPSE', 'GLIMPSE', {}),
+    'glimpse-2': ('src.glimpse', 'GLIMPSE', 'GLIMPSE-2', {'power': 2}),
 }
 
-def answer_queries_in_log(KG, K, query_log, summary_methods, test_size=0.5):
+def load_kg(name):
+    """
+    :param name: key of KG_MAPPING
+    :return KG: new, not yet loaded KnowledgeGraph
+    """
+    module, cls, kwargs = KG_MAPPING[name]
+    return getattr(importlib.import_module(module), cls)(**kwargs)
+
+def load_method(name):
+    """
+    :param name: key of METHODS
+    :return summary_method: SummaryMethod
+    """
+    from src.glimpse import SummaryMethod
+
+    module, fn, pretty_name, kwargs = METHODS[name]
+    return SummaryMethod(getattr(importlib.import_module(module), fn), pretty_name, **kwargs)
+
+def summarize(KG, K, train_log, summary_method, cache=None, seed=None, **kwargs):
+    """
+    :param KG: KnowledgeGraph
+    :param K: summary constraint
+    :param train_log: list of dict queries to summarize
+    :param summary_method: summarization method to use
+    :param cache: optional SummaryCache to look the summary up in
+    :param seed: optional key the generators were seeded with, for the cache
+    :param kwargs: optional keyword arguments for the method, e.g. profile=True
+    :return S, runtime: Summary and summarization time in seconds
+    """
+    t0 = time()
+    with instrument.labels(method=summary_method.name()), instrument.stage('summarize'):
+        if cache is not None:
+            S = cache.summarize(KG, K, train_log, summary_method, seed=seed, **kwargs)
+        else:
+            S = summary_method(KG, K, train_log, **kwargs) # call the object as a function
+    return S, time() - t0
+
+def summary_results(S, summary_method, runtime, metrics):
+    """
+    :param S: Summary
+    :param summary_method: summarization method S was made with
+    :param runtime: summarization time in seconds
+    :param metrics: dict of F1/precision/recall metrics of S
+    :return results: dict of runtime, metrics and heap statistics if profiled
+    """
+    results = dict(metrics, method=summary_method.name(), runtime=runtime)
+    if S.heap_stats() is not None:
+        results['heap_stats'] = S.heap_stats().summary()
+    return results
+
+def evaluate_summaries(summaries, test_log, n_jobs=1, eval_sample=None, rng=None):
+    """
+    :param summaries: list of Summary of the same KG
+    :param test_log: list of dict queries to evaluate on
+    :param n_jobs: number of worker processes to answer test queries with
+    :param eval_sample: optional keyword arguments of
+        sampled_query_log_metrics to estimate the metrics with, instead
+        of answering every test query
+    :param rng: optional np.random.RandomState to sample queries with
+    :return metrics: list of dict of F1/precision/recall metrics, one per summary
+    """
+    from src.metrics import query_log_metrics, sampled_query_log_metrics
+
+    if eval_sample is None:
+        return query_log_metrics(summaries, test_log, n_jobs=n_jobs)
+    return sampled_query_log_metrics(summaries, test_log, rng=rng, n_jobs=n_jobs,
+            **eval_sample)
+
+def log_results(results):
+    """
+    :param results: dict returned by summary_results
+    """
+    logging.info('\t---Summarized with {}---'.format(results['method']))
+    logging.info('\t  Time: {:.2f} seconds'.format(results['runtime']))
+    logging.info('\t  Total F1/precision/recall')
+    logging.info('\t    {:.2f}/{:.2f}/{:.2f}'.format(*results['total']))
+    logging.info('\t  Average F1/precision/recall')
+    logging.info('\t    {:.2f}/{:.2f}/{:.2f}'.format(*results['average']))
+    if 'n_evaluated' in results:
+        logging.info('\t  Estimated from {}/{} test queries, confidence intervals'.format(
+            results['n_evaluated'], results['n_queries']))
+        for kind in ('total', 'average'):
+            logging.info('\t    {}: {}'.format(kind.capitalize(), '/'.join(
+                '[{:.2f}, {:.2f}]'.format(*ci) for ci in results[kind + '_ci'])))
+    if 'heap_stats' in results:
+        stats = results['heap_stats']
+        logging.info('\t  Lazy hit rate/marginal evaluations per pop/ms per pop')
+        logging.info('\t    {:.2f}/{:.1f}/{:.3f}'.format(
+            stats['lazy_hit_rate'] or 0, stats['marginal_evaluations_per_pop'] or 0,
+            1000 * (stats['pop_seconds_mean'] or 0)))
+
+def key_seed(*key):
+    """
+    :param key: ints identifying the run, e.g. (seed, user, method)
+    :return seed: int seed derived from the key
+    """
+    import numpy as np
+
+    return int(np.random.SeedSequence(list(key)).generate_state(1)[0])
+
+def seed_rngs(*key):
+    """
+    :param key: ints identifying the run, e.g. (seed, user, method)
+
+    Seeds both the random and np.random global generators.
+    """
+    import numpy as np
+
+    seed = key_seed(*key)
+    random.seed(seed)
+    np.random.seed(seed)
+
+def user_rngs(*key):
+    """
+    :param key: ints identifying the run, e.g. (seed, user)
+    :return rng, py_rng: np.random.RandomState and random.Random in the
+        same states that seed_rngs(*key) puts the global generators in
+    """
+    import numpy as np
+
+    seed = key_seed(*key)
+    return np.random.RandomState(seed), random.Random(seed)
+
+def answer_queries_in_log(KG, K, query_log, summary_methods, test_size=0.5,
+        seed=None, n_jobs=1, cache=None, rng=None, eval_sample=None, log=True, **kwargs):
     """
     :param KG: KnowledgeGraph
     :param K: summary constraint
     :param query_log: list of dict
     :param summary_methods: summarization methods to use
     :param test_size: percent of queries to hold out for testing
+    :param seed: optional (seed, user) key; each method is seeded with (seed, user, i)
+    :param n_jobs: number of worker processes to answer test queries with
+    :param cache: optional SummaryCache to look summaries up in
+    :param rng: optional np.random.RandomState to split the log with,
+        and sample test queries with, instead of the np.random module
+    :param eval_sample: see evaluate_summaries
+    :param log: log each method's results
+    :param kwargs: optional keyword arguments for every summary method
+    :return results: list of dict, one per summary method
     """
+    import numpy as np
+    from src.user import split_log
+
     # Split the query log for training/testing
-    train_log, test_log = train_test_split(query_log, test_size=test_size)
+    train_log, test_log = split_log(query_log, test_size=test_size,
+            rng=np.random if rng is None else rng)
     logging.info('\tSplit query log into {}/{} split'.format(
         int((1 - test_size) * 100), int(test_size * 100)))
 
-    for summary_method in summary_methods:
+    summaries, runtimes = [], []
+    for i, summary_method in enumerate(summary_methods):
         logging.info('\t---Summarizing with {}---'.format(summary_method.name()))
+        if seed is not None:
+            seed_rngs(*seed, i)
+        S, runtime = summarize(KG, K, train_log, summary_method, cache=cache,
+                seed=None if seed is None else (*seed, i), **kwargs)
+        summaries.append(S)
+        runtimes.append(runtime)
+
+    # Evaluate question answering on the testing queries, sharing
+    # the answers on the full KG between all summaries
+    results = []
+    with instrument.stage('evaluate'):
+        metrics = evaluate_summaries(summaries, test_log, n_jobs=n_jobs,
+                eval_sample=eval_sample, rng=rng)
+    for S, summary_method, runtime, summary_metrics in zip(
+            summaries, summary_methods, runtimes, metrics):
+        results.append(summary_results(S, summary_method, runtime, summary_metrics))
+        if log:
+            log_results(results[-1])
+    return results
+
+def answer_queries_in_clusters(KG, K, users, summary_methods, args):
+    """
+    :param KG: KnowledgeGraph
+    :param K: number of triples in each summary
+    :param users: list of (user, (query_log, rng)) of every simulated user
+    :param summary_methods: summarization methods to use, GLIMPSE with
+        their power and epsilon
+    :param args: parsed command-line arguments
+    :return results: {user: list of dict results, one per method}
+
+    Summarizes the users of each cluster of similar users together, see
+    src/cluster.py; each user's runtime is the method's total runtime
+    divided by the number of users.
+    """
+    from src.cluster import shared_summaries
+    from src.user import split_log
+
+    train_logs, test_logs = [], []
+    for user, (query_log, rng) in users:
+        train_log, test_log = split_log(query_log, test_size=args.test_size, rng=rng)
+        train_logs.append(train_log)
+        test_logs.append(test_log)
 
-        # Run the summarization function
+    results = {user: [] for user, _ in users}
+    for i, summary_method in enumerate(summary_methods):
+        logging.info('---Summarizing {} users in clusters with {}---'.format(
+            len(users), summary_method.name()))
+        seed_rngs(args.seed, i)
+        kwargs = summary_method.kwargs()
         t0 = time()
-        S = summary_method(KG, K, train_log) # call the object as a function
-        runtime = time() - t0
-        logging.info('\t  Time: {:.2f} seconds'.format(runtime))
+        with instrument.labels(method=summary_method.name()), instrument.stage('summarize'):
+            summaries = shared_summaries(KG, K, train_logs,
+                    similarity=args.cluster_similarity,
+                    base_fraction=args.cluster_base_fraction,
+                    epsilon=kwargs.get('epsilon', 1e-3), power=kwargs.get('power', 1))
+        runtime = (time() - t0) / len(users)
 
-        # Evaluate question answering on the testing queries
-        total_F1, total_precision, total_recall = total_query_log_metrics(S, test_log)
-        logging.info('\t  Total F1/precision/recall')
-        logging.info('\t    {:.2f}/{:.2f}/{:.2f}'.format(
-            total_F1, total_precision, total_recall))
+        for (user, (_, rng)), S, test_log in zip(users, summaries, test_logs):
+            with instrument.labels(user=user, method=summary_method.name()), \
+                    instrument.stage('evaluate'):
+                metrics = evaluate_summaries([S], test_log, n_jobs=args.eval_jobs,
+                        eval_sample=eval_sample_kwargs(args), rng=rng)[0]
+            results[user].append(summary_results(S, summary_method, runtime, metrics))
 
-        avg_F1, avg_precision, avg_recall = average_query_log_metrics(S, test_log)
-        logging.info('\t  Average F1/precision/recall')
-        logging.info('\t    {:.2f}/{:.2f}/{:.2f}'.format(
-            avg_F1, avg_precision, avg_recall))
+    for user, _ in users:
+        logging.info('---Simulated user {}---'.format(user))
+        for result in results[user]:
+            log_results(result)
+    return results
+
+def simulate_query_log(KG, args, rng=None, py_rng=random):
+    """
+    :param KG: KnowledgeGraph
+    :param args: parsed command-line arguments
+    :param rng: np.random.RandomState, or None for the np.random module
+    :param py_rng: random.Random or the random module
+    :return query_log: list of dict queries for one simulated user
+    """
+    import numpy as np
+    from src.user import query_log_by_mids, query_log_by_topics
+
+    rng = np.random if rng is None else rng
+    if args.kg == 'Freebase':
+        topics = py_rng.sample(KG.topics(), k=args.n_topics)
+
+        return query_log_by_topics(
+                KG, topics, args.n_mids_per_topic, args.n_queries,
+                shuffle=args.shuffle, random_query_prob=args.random_query_prob,
+                rng=rng, py_rng=py_rng)
+
+    topic_mids = py_rng.sample(KG.topic_mids(), k=args.n_topic_mids)
+
+    return query_log_by_mids(
+            KG, topic_mids, args.n_queries,
+            shuffle=args.shuffle,
+            random_query_prob=args.random_query_prob,
+            rng=rng, py_rng=py_rng)
+
+def simulate_user_log(KG, args, user):
+    """
+    :param KG: KnowledgeGraph
+    :param args: parsed command-line arguments
+    :param user: user index
+    :return query_log, rng: list of dict queries of the user, and the
+        np.random.RandomState to split it with
+
+    Uses generators of its own, seeded by (seed, user), rather than the
+    global ones, so logs can be simulated while other users are summarized.
+    """
+    rng, py_rng = user_rngs(args.seed, user)
+    with instrument.labels(user=user), instrument.stage('simulate_log'):
+        query_log = simulate_query_log(KG, args, rng=rng, py_rng=py_rng)
+    return query_log, rng
+
+
+def method_kwargs(args):
+    """
+    :param args: parsed command-line arguments
+    :return kwargs: keyword arguments passed to every summary method
+    """
+    kwargs = {'profile': True} if args.profile_heap else {}
+    if args.checkpoint_dir is not None:
+        from src.checkpoint import Checkpointer
+        kwargs['checkpoint'] = Checkpointer(args.checkpoint_dir, every=args.checkpoint_every)
+    if args.budget_bytes is not None:
+        kwargs['budget'] = True
+    return kwargs
+
+def eval_sample_kwargs(args):
+    """
+    :param args: parsed command-line arguments
+    :return eval_sample: keyword arguments of sampled_query_log_metrics,
+        or None to answer every test query
+    """
+    if args.eval_ci_width is None and args.eval_time_budget is None:
+        return None
+    return {'width': args.eval_ci_width or 0., 'time_budget': args.eval_time_budget}
+
+# Inherited by forked worker processes, see simulate_users_parallel
+_WORKER_STATE = {}
+
+def _simulate_user(user):
+    """
+    :param user: user index
+    :return user, results, records: list of dict returned by
+        answer_queries_in_log, one per method, and instrumentation
+        records to pass on to the parent's recorder
+    """
+    KG, K, args = _WORKER_STATE['KG'], _WORKER_STATE['K'], _WORKER_STATE['args']
+    summary_methods = [load_method(name) for name in args.method]
+
+    # Every method of a user sees the same log and train/test split, and
+    # the test queries are answered on the full KG once for all of them
+    seed_rngs(args.seed, user)
+    query_log = simulate_query_log(KG, args)
+    kwargs = dict(method_kwargs(args), test_size=args.test_size, seed=(args.seed, user),
+            cache=_WORKER_STATE['cache'], eval_sample=eval_sample_kwargs(args), log=False)
+
+    recorder = instrument.recorder()
+    if recorder is None:
+        return user, answer_queries_in_log(KG, K, query_log, summary_methods, **kwargs), []
+
+    with recorder.capture() as records, instrument.labels(user=user):
+        results = answer_queries_in_log(KG, K, query_log, summary_methods, **kwargs)
+    return user, results, records
+
+def simulate_users_parallel(KG, K, args, cache=None):
+    """
+    :param KG: loaded KnowledgeGraph
+    :param K: summary constraint
+    :param args: parsed command-line arguments
+    :param cache: optional SummaryCache to look summaries up in
+    :return results: {user: list of dict results, one per method}
+
+    Workers are forked after the KG is loaded and its transition matrix
+    is built, so they share a single copy of the KG copy-on-write.
+    Each user is a task, seeded by (seed, user) for the query log and by
+    (seed, user, method index) for summarization, so results do not
+    depend on the number of workers.
+    """
+    import gc
+    import multiprocessing
+
+    # Build shared read-only structures once, before forking
+    KG.transition_matrix()
+    if args.random_query_prob > 0:
+        KG.query_pool().wait()
+    if cache is not None:
+        KG.fingerprint()
+    _WORKER_STATE.update(KG=KG, K=K, args=args, cache=cache)
+
+    # Keep the collector from touching (and so copying) inherited objects
+    gc.collect()
+    gc.freeze()
+
+    results = {}
+    try:
+        with multiprocessing.get_context('fork').Pool(args.n_jobs) as pool:
+            for user, user_results, records in pool.imap(_simulate_user, range(args.n_users)):
+                results[user] = user_results
+                for record in records:
+                    instrument.recorder().add(record)
+                logging.info('---Simulated user {}---'.format(user))
+                for result in results[user]:
+                    log_results(result)
+    finally:
+        gc.unfreeze()
+    return results
 
 def float_in_zero_one(value):
     """Check if a float value is in [0, 1]"""
@@ -79,6 +408,17 @@ def parse_args():
 
     parser.add_argument('--kg', choices=list(KG_MAPPING.keys()), default='YAGO',
             help='KG to summarize')
+    parser.add_argument('--out-of-core', default=None, metavar='DIR',
+            help='Keep the KG\'s triples on disk in this directory, built '
+                 'from the KG\'s dump on first use, for KGs larger than '
+                 'memory. Default is loading the KG into memory.')
+    parser.add_argument('--working-set-bytes', type=positive_int, default=1 << 28,
+            help='Memory to build and stream an --out-of-core KG with. '
+                 'Summaries still keep their candidate triples in memory, '
+                 'so peak memory grows with the KG. Default is 256 MiB.')
+    parser.add_argument('--reorder', choices=['degree', 'bfs', 'rcm'], default=None,
+            help='Renumber entities after loading the KG so that random '
+                 'walks have better cache locality. Default is no reordering.')
     parser.add_argument('--n-queries', type=positive_int, default=200,
             help='Number of queries to simulate per user. Default is 200.')
     parser.add_argument('--n-topic-mids', type=positive_int, default=50,
@@ -96,6 +436,9 @@ def parse_args():
     parser.add_argument('--percent-triples', type=float_in_zero_one, default=0.001,
             help='Ratio of number of triples of KG to use as K '
                  '(summary constraint). Default is 0.001.')
+    parser.add_argument('--budget-bytes', type=positive_int, default=None,
+            help='Limit summaries to this many bytes in the binary export '
+                 'format instead of --percent-triples triples. Default is None.')
     parser.add_argument('--random-query-prob', type=float_in_zero_one, default=0.1,
             help='Probability of users asking random queries rather '
                  'than topic-specific ones. Default is 0.1.')
@@ -104,44 +447,152 @@ def parse_args():
     parser.add_argument('--method', nargs='+', default=['glimpse'],
             choices=list(METHODS.keys()),
             help='Summarization methods to call. Default is [glimpse].')
+    parser.add_argument('--n-jobs', type=positive_int, default=1,
+            help='Number of worker processes to simulate users with. Default is 1.')
+    parser.add_argument('--cluster-similarity', type=float_in_zero_one, default=None,
+            help='Summarize clusters of users whose topic entities are at '
+                 'least this similar together, sharing a greedy prefix of '
+                 'their summaries. Default is one summary per user.')
+    parser.add_argument('--cluster-base-fraction', type=float_in_zero_one, default=0.5,
+            help='Share of the summaries selected for a whole cluster with '
+                 '--cluster-similarity. Default is 0.5.')
+    parser.add_argument('--prefetch', type=int, default=2,
+            help='Number of users whose query logs are simulated ahead on a '
+                 'background thread, when --n-jobs is 1. 0 to simulate '
+                 'each log just before it is used. Default is 2.')
+    parser.add_argument('--dtype', choices=['float64', 'float32'], default='float64',
+            help='Numeric types of preference vectors, the transition matrix '
+                 'and adjacency arrays; float32 also uses int32 IDs and takes '
+                 'half the memory. Default is float64.')
+    parser.add_argument('--spmv-threads', type=positive_int, default=1,
+            help='Number of threads to multiply the transition matrix with '
+                 'in random walks. Default is 1.')
+    parser.add_argument('--eval-jobs', type=positive_int, default=1,
+            help='Number of worker processes to answer test queries with, '
+                 'when --n-jobs is 1. Default is 1.')
+    parser.add_argument('--eval-ci-width', type=float_in_zero_one, default=None,
+            help='Estimate test metrics from test queries sampled by topic '
+                 'entity until every 95%% confidence interval is at most '
+                 'this wide. Default is answering every test query.')
+    parser.add_argument('--eval-time-budget', type=float, default=None,
+            help='Seconds to sample test queries for per user, with or '
+                 'without --eval-ci-width. Default is no limit.')
+    parser.add_argument('--seed', type=int, default=None,
+            help='Seed for simulated users and summaries. Default is random.')
+    parser.add_argument('--metrics-out', default=None,
+            help='File to write per-stage timing and memory metrics to. '
+                 'Default is no metrics.')
+    parser.add_argument('--metrics-format', choices=instrument.Recorder.FORMATS,
+            default='jsonl', help='Format of --metrics-out. Default is jsonl.')
+    parser.add_argument('--trace-memory', action='store_true',
+            help='Also record tracemalloc deltas per stage. Default False.')
+    parser.add_argument('--profile-heap', action='store_true',
+            help='Count lazy greedy hits, marginal evaluations and time per '
+                 'pop of each summary. Default False.')
+    parser.add_argument('--cache-dir', default=None,
+            help='Directory to cache summaries in, reused across runs with '
+                 'the same seed. Default is no cache.')
+    parser.add_argument('--cache-bytes', type=positive_int, default=1 << 30,
+            help='Size of the summary cache directory. Default is 1 GiB.')
+    parser.add_argument('--checkpoint-dir', default=None,
+            help='Directory to checkpoint the greedy loop of summaries in. '
+                 'Rerunning with the same --seed resumes interrupted '
+                 'summaries. Default is no checkpoints.')
+    parser.add_argument('--checkpoint-every', type=float, default=600.,
+            help='Seconds between checkpoints. Default is 600.')
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.cluster_similarity is not None and args.budget_bytes is not None:
+        parser.error('--cluster-similarity summaries are limited by --percent-triples, '
+                'not --budget-bytes')
+    if args.cluster_similarity is not None:
+        for flag, value in (('--cache-dir', args.cache_dir),
+                ('--checkpoint-dir', args.checkpoint_dir), ('--profile-heap', args.profile_heap),
+                ('--n-jobs above 1', args.n_jobs > 1)):
+            if value:
+                parser.error('{} cannot be used with --cluster-similarity'.format(flag))
+    if args.out_of_core is not None and args.reorder is not None:
+        parser.error('--reorder cannot be used with --out-of-core, whose KG is read-only')
+    return args
 
 def main():
     args = parse_args()
 
-    KG = KG_MAPPING[args.kg]
-    summary_methods = [METHODS[name] for name in args.method]
+    if args.metrics_out is not None:
+        instrument.enable(instrument.Recorder(open(args.metrics_out, 'w'),
+            fmt=args.metrics_format, trace_memory=args.trace_memory))
+
+    if args.dtype != 'float64':
+        from src import dtypes
+        dtypes.set_policy(args.dtype)
+
+    KG = load_kg(args.kg)
+    if args.out_of_core is not None:
+        from src.ooc import DiskKnowledgeGraph
+        KG = DiskKnowledgeGraph(args.out_of_core, source=KG,
+                working_set_bytes=args.working_set_bytes)
+    summary_methods = [load_method(name) for name in args.method]
+
+    cache = None
+    if args.cache_dir is not None:
+        from src.cache import SummaryCache
+        cache = SummaryCache(cache_dir=args.cache_dir, max_bytes=args.cache_bytes)
 
     # Load the KG into memory
     logging.info('Loading {}'.format(KG.name()))
-    KG.load()
+    with instrument.stage('load'):
+        KG.load()
     logging.info('Loaded {}'.format(KG.name()))
 
-    # Number of triples for summary
-    K = int(args.percent_triples * KG.number_of_triples())
-    logging.info('K = {}'.format(K))
+    if args.spmv_threads > 1:
+        from src import spmv
+        spmv.use_threads(args.spmv_threads)
 
-    # Simulate users with specified parameters
-    for user in range(args.n_users):
-        logging.info('---Simulating user {}---'.format(user))
+    if args.reorder is not None:
+        with instrument.stage('reorder'):
+            KG.reorder_entities(args.reorder)
+        logging.info('Reordered entities by {}'.format(args.reorder))
+
+    # Number of triples for summary
+    if args.budget_bytes is not None:
+        K = args.budget_bytes
+        logging.info('Budget = {} bytes'.format(K))
+    else:
+        K = int(args.percent_triples * KG.number_of_triples())
+        logging.info('K = {}'.format(K))
 
-        if args.kg == 'Freebase':
-            topics = random.sample(KG.topics(), k=args.n_topics)
+    if args.seed is None:
+        args.seed = random.randrange(2 ** 32)
+    logging.info('Seed = {}'.format(args.seed))
 
-            query_log = query_log_by_topics(
-                    KG, topics, args.n_mids_per_topic, args.n_queries,
-                    shuffle=args.shuffle, random_query_prob=args.random_query_prob)
+    # Simulate users with specified parameters
+    if args.n_jobs > 1:
+        simulate_users_parallel(KG, K, args, cache=cache)
+    elif args.cluster_similarity is not None:
+        users = [(user, simulate_user_log(KG, args, user)) for user in range(args.n_users)]
+        answer_queries_in_clusters(KG, K, users, summary_methods, args)
+    else:
+        # Simulate upcoming users' logs while the current one is summarized
+        simulate = lambda user: simulate_user_log(KG, args, user)
+        if args.prefetch > 0:
+            from src.pipeline import prefetch
+            logs = prefetch(simulate, range(args.n_users), depth=args.prefetch)
         else:
-            topic_mids = random.sample(KG.topic_mids(), k=args.n_topic_mids)
+            logs = ((user, simulate(user)) for user in range(args.n_users))
+
+        for user, (query_log, rng) in logs:
+            logging.info('---Simulating user {}---'.format(user))
+            logging.info('---Generated a log of {} queries----'.format(len(query_log)))
 
-            query_log = query_log_by_mids(
-                    KG, topic_mids, args.n_queries,
-                    shuffle=args.shuffle,
-                    random_query_prob=args.random_query_prob)
-        logging.info('---Generated a log of {} queries----'.format(len(query_log)))
+            with instrument.labels(user=user):
+                answer_queries_in_log(KG, K, query_log, summary_methods,
+                        test_size=args.test_size, seed=(args.seed, user), rng=rng,
+                        n_jobs=args.eval_jobs, cache=cache, eval_sample=eval_sample_kwargs(args),
+                        **method_kwargs(args))
 
-        answer_queries_in_log(KG, K, query_log, summary_methods, test_size=args.test_size)
+    if instrument.recorder() is not None:
+        instrument.recorder().close()
+        instrument.disable()
 
     logging.info('Shutting down...')
 
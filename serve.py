@@ -0,0 +1,93 @@
+"""Keeps a KG loaded and serves summaries over HTTP, see src/service.py.
+
+Usage:
+    python serve.py --kg Synthetic --port 8000
+"""
+
+import argparse
+import logging
+
+logging.basicConfig(format='[%(asctime)s] - %(message)s',
+                    level=logging.INFO)
+
+from main import KG_MAPPING, METHODS, load_kg, load_method, positive_int
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--kg', choices=list(KG_MAPPING.keys()), default='YAGO',
+            help='KG to summarize')
+    parser.add_argument('--reorder', choices=['degree', 'bfs', 'rcm'], default=None,
+            help='Renumber entities after loading the KG so that random '
+                 'walks have better cache locality. Default is no reordering.')
+    parser.add_argument('--dtype', choices=['float64', 'float32'], default='float64',
+            help='Numeric types of preference vectors, the transition matrix '
+                 'and adjacency arrays; float32 also uses int32 IDs and takes '
+                 'half the memory. Default is float64.')
+    parser.add_argument('--spmv-threads', type=positive_int, default=1,
+            help='Number of threads to multiply the transition matrix with '
+                 'in random walks. Default is 1.')
+    parser.add_argument('--host', default='127.0.0.1',
+            help='Address to listen on. Default is 127.0.0.1.')
+    parser.add_argument('--port', type=int, default=8000,
+            help='Port to listen on. Default is 8000.')
+    parser.add_argument('--n-workers', type=positive_int, default=4,
+            help='Number of worker threads running requests. Default is 4.')
+    parser.add_argument('--max-pending', type=positive_int, default=64,
+            help='Number of queued and running requests beyond which '
+                 'requests are rejected with 503. Default is 64.')
+    parser.add_argument('--batch-size', type=positive_int, default=16,
+            help='Maximum number of random walks computed together. Default is 16.')
+    parser.add_argument('--batch-wait', type=float, default=0.005,
+            help='Seconds to wait for more random walks to batch. Default is 0.005.')
+    parser.add_argument('--cache-entries', type=int, default=128,
+            help='Number of summaries cached in memory, 0 for no cache. Default is 128.')
+    parser.add_argument('--cache-dir', default=None,
+            help='Directory to also cache summaries in. Default is memory only.')
+    parser.add_argument('--cache-bytes', type=positive_int, default=1 << 30,
+            help='Size of the summary cache directory. Default is 1 GiB.')
+
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    from src.cache import SummaryCache
+    from src.service import SummaryService, make_server
+
+    if args.dtype != 'float64':
+        from src import dtypes
+        dtypes.set_policy(args.dtype)
+
+    KG = load_kg(args.kg)
+    logging.info('Loading {}'.format(KG.name()))
+    KG.load()
+    logging.info('Loaded {}'.format(KG.name()))
+    if args.reorder is not None:
+        KG.reorder_entities(args.reorder)
+    if args.spmv_threads > 1:
+        from src import spmv
+        spmv.use_threads(args.spmv_threads)
+
+    cache = None
+    if args.cache_entries > 0:
+        cache = SummaryCache(max_entries=args.cache_entries, cache_dir=args.cache_dir,
+                max_bytes=args.cache_bytes)
+
+    service = SummaryService(KG, {name: load_method(name) for name in METHODS},
+            n_workers=args.n_workers, max_pending=args.max_pending,
+            batch_size=args.batch_size, batch_wait=args.batch_wait, cache=cache)
+    server = make_server(service, host=args.host, port=args.port)
+    logging.info('Serving on http://{}:{}'.format(*server.server_address))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        logging.info('Shutting down...')
+
+if __name__ == '__main__':
+    main()
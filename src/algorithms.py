@@ -1,5 +1,7 @@
 import numpy as np
 
+from . import spmv
+from .dtypes import value_dtype
 
 def query_vector(KG, query_log):
     """
@@ -7,7 +9,7 @@ def query_vector(KG, query_log):
     :param query_log: list of queries in dict format
     :return x: query vector (n_entities,)
     """
-    x = np.zeros(KG.number_of_entities())
+    x = np.zeros(KG.number_of_entities(), dtype=value_dtype())
     for query in query_log:
         parse = query['Parse']
         topic_eid = KG.entity_id(parse['TopicEntityMid'])
@@ -17,19 +19,62 @@ def query_vector(KG, query_log):
 def random_walk_with_restart(M, x, c=0.15, power=1):
     """
     :param M: scipy sparse transition matrix
-    :param x: np.array (n_entities,) seed initializations
+    :param x: np.array (n_entities,) seed initializations, or
+        (n_entities, n_seeds) to walk from several seed vectors at once
     :param c: float in [0, 1], optional restart prob
     :param power: number of terms in Taylor expansion
-    :return r: np.array (n_entities,) random walk vector
+    :return r: np.array random walk vector(s), shaped like x
 
     Approximates the matrix inverse using the Taylor expansion:
         (I - M)^-1 = I + M + M^2 + M^3 ...
+
+    Products with M use the backend selected in src/spmv.py.
+    """
+    return RandomWalk(M, x, c=c).vector(power)
+
+def random_walks_with_restart(M, x, powers, c=0.15):
+    """
+    :param M: scipy sparse transition matrix
+    :param x: np.array seed initializations, see random_walk_with_restart
+    :param powers: numbers of terms in Taylor expansion
+    :param c: float in [0, 1], optional restart prob
+    :return r: {power: np.array random walk vector(s)}, equal to
+        random_walk_with_restart for each power, for max(powers) products
     """
-    q = c * np.copy(x)
-    r = np.copy(q) # result vector
-
-    for _ in range(power):
-        q = (1 - c) * M * q
-        r += q
-        r /= np.sum(r)
-    return r
+    walk = RandomWalk(M, x, c=c)
+    return {power: walk.vector(power) for power in sorted(set(powers))}
+
+
+class RandomWalk(object):
+    """Taylor series of a random walk with restart, extended term by term"""
+
+    def __init__(self, M, x, c=0.15):
+        """
+        :param M: scipy sparse transition matrix
+        :param x: np.array seed initializations, see random_walk_with_restart
+        :param c: float in [0, 1], optional restart prob
+        """
+        self.M_ = spmv.operator(M)
+        self.c_ = c
+        self.q_ = c * np.asarray(x, dtype=value_dtype())
+        # Random walk vectors by number of terms; terms are replaced,
+        # never updated in place, so the first vector is the first term
+        self.vectors_ = [self.q_]
+
+    def number_of_terms(self):
+        return len(self.vectors_) - 1
+
+    def vector(self, power):
+        """
+        :param power: number of terms in Taylor expansion
+        :return r: np.array random walk vector(s), shaped like x; shared
+            with later calls, so not to be modified
+
+        Each term beyond the ones already computed costs one product with M.
+        """
+        while self.number_of_terms() < power:
+            self.q_ = (1 - self.c_) * (self.M_ * self.q_)
+            r = self.vectors_[-1] + self.q_
+            r /= np.sum(r, axis=0)
+            self.vectors_.append(r)
+        return self.vectors_[power]
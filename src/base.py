@@ -2,13 +2,18 @@ import os
 import gzip
 import json
 import re
+import hashlib
 
 import numpy as np
 
 from collections import defaultdict
 from scipy.sparse import csr_matrix
 
-from .algorithms import query_vector, random_walk_with_restart
+from .algorithms import RandomWalk, query_vector
+from .dtypes import index_dtype, value_dtype
+from .instrument import stage
+from .names import StringIndex, build_index
+from .query import QueryPool
 
 # TODO: Replace these data directories with your own paths
 FREEBASE_DATA_DIR = '/x/tsafavi/data/WebQSDP/data/'
@@ -18,12 +23,17 @@ DBPEDIA_DATA_DIR = '/x/tsafavi/data/dbpedia3.5.1/'
 
 class KnowledgeGraph(object):
 
-    def __init__(self):
+    def __init__(self, reverse_index=False):
         """A KG is a set of entities E, a set of relationships R,
-        and a set of triples E x R x E."""
+        and a set of triples E x R x E.
+
+        :param reverse_index: also index triples by tail entity after load
+        """
         self.entities_ = set()
         self.relationships_ = set()
         self.triples_ = {}
+        self.reverse_index_ = reverse_index
+        self.reverse_triples_ = None
         self.number_of_triples_ = 0
 
         # Map entities to numeric IDs
@@ -31,6 +41,20 @@ class KnowledgeGraph(object):
         self.entity_id_ = {}
         self.id_entity_ = {}
 
+        # Map relationships to numeric IDs
+        self.rid_ = 0
+        self.relationship_id_ = {}
+        self.id_relationship_ = {}
+
+        self.query_pool_ = None
+        self.preference_vector_ = None
+
+        # Integer arrays and matrices derived from triples_, rebuilt lazily
+        self.adjacency_ = None
+        self.transition_matrix_ = None
+        self.fingerprint_ = None
+        self.random_walk_ = None
+
         self.name_ = None
 
     def name(self):
@@ -62,6 +86,20 @@ class KnowledgeGraph(object):
                     triples.add((e1, r, e2))
         return triples
 
+    def ordered_triples(self):
+        """
+        :return triples: generator of (e1, r, e2) triples in (head,
+            relationship, tail) ID order
+
+        Unlike triples(), the order does not depend on how strings hash,
+        so seeded random choices among triples are reproducible.
+        """
+        adjacency = self.adjacency_arrays()
+        id_entity, id_relationship = self.id_entity_, self.id_relationship_
+        for eid1, rid, eid2 in zip(adjacency['head'].tolist(), adjacency['rel'].tolist(),
+                adjacency['tail'].tolist()):
+            yield id_entity[eid1], id_relationship[rid], id_entity[eid2]
+
     def number_of_entities(self):
         """
         :return n_entities: number of entities in the KG
@@ -123,7 +161,16 @@ class KnowledgeGraph(object):
         e1, r, e2 = triple
         if not self.has_triple(triple):
             self.number_of_triples_ += 1
-            self.relationships_.add(r)
+            self.adjacency_ = None
+            self.transition_matrix_ = None
+            self.fingerprint_ = None
+            self.random_walk_ = None
+
+            if not self.has_relationship(r):
+                self.relationship_id_[r] = self.rid_
+                self.id_relationship_[self.rid_] = r
+                self.relationships_.add(r)
+                self.rid_ += 1
 
             # Record new entities
             for entity in (e1, e2):
@@ -139,6 +186,51 @@ class KnowledgeGraph(object):
                 self.triples_[e1][r] = set()
             self.triples_[e1][r].add(e2)
 
+            if self.reverse_triples_ is not None:
+                if e2 not in self.reverse_triples_:
+                    self.reverse_triples_[e2] = {}
+                if r not in self.reverse_triples_[e2]:
+                    self.reverse_triples_[e2][r] = set()
+                self.reverse_triples_[e2][r].add(e1)
+
+    def has_reverse_index(self):
+        """
+        :return has_reverse_index: True if triples are indexed by tail entity
+        """
+        return self.reverse_triples_ is not None
+
+    def heads(self, entity, relationship):
+        """
+        :param entity: str tail entity
+        :param relationship: str
+        :return heads: set of {e1 : (e1, relationship, entity) in KG}
+
+        Requires the reverse index, see build_reverse_index.
+        """
+        if entity in self.reverse_triples_ and relationship in self.reverse_triples_[entity]:
+            return self.reverse_triples_[entity][relationship]
+        return set()
+
+    def build_reverse_index(self):
+        """Index all triples by tail entity: {e2: {r: {e1}}}.
+        Once built, the index is kept up to date by add_triple."""
+        adj = self.adjacency_arrays()
+        order = np.lexsort((adj['head'], adj['rel'], adj['tail']))
+        head, rel, tail = adj['head'][order], adj['rel'][order], adj['tail'][order]
+
+        starts = np.flatnonzero(np.concatenate((
+            [True], (tail[1:] != tail[:-1]) | (rel[1:] != rel[:-1])))) \
+                if len(tail) else np.zeros(0, dtype=np.int64)
+        ends = np.append(starts[1:], len(tail))
+
+        heads = [self.id_entity_[eid] for eid in head.tolist()]
+        self.reverse_triples_ = {}
+        for start, end, eid2, rid in zip(starts.tolist(), ends.tolist(),
+                tail[starts].tolist(), rel[starts].tolist()):
+            e2 = self.id_entity_[eid2]
+            if e2 not in self.reverse_triples_:
+                self.reverse_triples_[e2] = {}
+            self.reverse_triples_[e2][self.id_relationship_[rid]] = set(heads[start:end])
 
     def entity_id(self, entity):
         """
@@ -154,46 +246,161 @@ class KnowledgeGraph(object):
         """
         return self.id_entity_[eid]
 
-    def csr_matrix(self):
+    def relationship_id(self, relationship):
+        """
+        :param relationship: str label
+        :return rid: relationship integer ID
+        """
+        return self.relationship_id_[relationship]
+
+    def id_relationship(self, rid):
+        """
+        :param rid: relationship integer ID
+        :return relationship: str label
+        """
+        return self.id_relationship_[rid]
+
+    def reorder_entities(self, order='rcm'):
         """
-        :return A: scipy sparse CSR adjacency matrix
+        :param order: 'degree', 'bfs' or 'rcm', see src/reorder.py, or
+            np.array (n_entities,) of old entity IDs in new ID order
+        :return order: np.array of old entity IDs in new ID order
+
+        Renumbers all entities so that the transition matrix has better
+        locality. Meant to be called right after load, since entity IDs
+        handed out before, e.g. in query vectors, are not renumbered.
+        """
+        if isinstance(order, str):
+            from .reorder import entity_order
+            order = entity_order(self, order)
+        order = np.asarray(order, dtype=np.int64)
+        if sorted(order.tolist()) != list(range(self.number_of_entities())):
+            raise ValueError('Entity order is not a permutation of entity IDs')
+
+        id_entity = self.id_entity_
+        self.id_entity_ = {eid: id_entity[old] for eid, old in enumerate(order.tolist())}
+        self.entity_id_ = {entity: eid for eid, entity in self.id_entity_.items()}
+
+        self.adjacency_ = None
+        self.transition_matrix_ = None
+        self.fingerprint_ = None
+        self.random_walk_ = None
+        if self.preference_vector_ is not None:
+            self.preference_vector_ = self.preference_vector_[order]
+        return order
+
+    def adjacency_arrays(self):
+        """
+        :return adjacency: dict of integer arrays over all triples
+
+        Triples are sorted by (head, relation, tail) ID and grouped
+        by (head, relation) pair:
+            'head', 'rel', 'tail': (n_triples,) triple IDs
+            'group_head', 'group_rel': (n_groups,) IDs of each pair
+            'group_ptr': (n_groups + 1,) offsets of each pair's tails
+            'head_ptr': (n_entities + 1,) offsets of each head's groups
+
+        The arrays are cached until the next triple is added.
         """
-        row, col, data = [], [], []
+        if self.adjacency_ is not None:
+            return self.adjacency_
+
+        n = self.number_of_triples()
+        head = np.empty(n, dtype=index_dtype())
+        rel = np.empty(n, dtype=index_dtype())
+        tail = np.empty(n, dtype=index_dtype())
+
+        i = 0
         for e1 in self.triples_:
+            eid1 = self.entity_id(e1)
             for r in self.triples_[e1]:
-                for e2 in self.triples_[e1][r]:
-                    row.append(self.entity_id(e1))
-                    col.append(self.entity_id(e2))
-                    data.append(1)
+                rid = self.relationship_id(r)
+                j = i + len(self.triples_[e1][r])
+                head[i:j] = eid1
+                rel[i:j] = rid
+                tail[i:j] = [self.entity_id(e2) for e2 in self.triples_[e1][r]]
+                i = j
+
+        order = np.lexsort((tail, rel, head))
+        head, rel, tail = head[order], rel[order], tail[order]
+
+        # Group boundaries wherever the (head, relation) pair changes
+        starts = np.flatnonzero(np.concatenate((
+            [True], (head[1:] != head[:-1]) | (rel[1:] != rel[:-1])))) \
+                if n else np.zeros(0, dtype=np.int64)
+        group_ptr = np.append(starts, n)
+        group_head, group_rel = head[starts], rel[starts]
+        head_ptr = np.searchsorted(
+                group_head, np.arange(self.number_of_entities() + 1))
+
+        self.adjacency_ = {
+            'head': head, 'rel': rel, 'tail': tail,
+            'group_head': group_head, 'group_rel': group_rel,
+            'group_ptr': group_ptr, 'head_ptr': head_ptr
+        }
+        return self.adjacency_
+
+    def fingerprint(self):
+        """
+        :return fingerprint: hex digest identifying the KG's triples
+
+        KGs with the same triples under the same entity and relationship
+        IDs have the same fingerprint. It is cached until the next triple
+        is added.
+        """
+        if self.fingerprint_ is None:
+            adjacency = self.adjacency_arrays()
+            h = hashlib.sha256()
+            for key in ('head', 'rel', 'tail'):
+                h.update(adjacency[key].astype('<i8').tobytes())
+            for names in (self.id_entity_, self.id_relationship_):
+                h.update('{}\n'.format(len(names)).encode('utf-8'))
+                for i in range(len(names)):
+                    h.update(names[i].encode('utf-8') + b'\0')
+            self.fingerprint_ = h.hexdigest()
+        return self.fingerprint_
 
+    def csr_matrix(self):
+        """
+        :return A: scipy sparse CSR adjacency matrix, counting the triples
+            from each entity to each other
+        """
+        adjacency = self.adjacency_arrays()
         n = self.number_of_entities()
-        return csr_matrix(
-                (np.array(data), (np.array(row), np.array(col))),
-                shape=(n,n))
+        return csr_matrix((np.ones(len(adjacency['head']), dtype=value_dtype()),
+            (adjacency['head'], adjacency['tail'])), shape=(n,n))
 
     def transition_matrix(self):
         """
         :return A: scipy CSR column-stochastic transition matrix
+
+        The matrix is cached until the next triple is added.
         """
-        # Create the degree matrix
-        row, col, data = [], [], []
-        for e1 in self.triples_:
-            for r in self.triples_[e1]:
-                for e2 in self.triples_[e1][r]:
-                    row.append(self.entity_id(e1))
-                    col.append(self.entity_id(e1))
-                    data.append(1)
+        if self.transition_matrix_ is None:
+            self.transition_matrix_ = self._transition_matrix()
+        return self.transition_matrix_
 
+    def _transition_matrix(self):
+        # A^T D for the degree matrix D, built from the triples directly
+        # instead of multiplying the two, and without A's ones
+        adjacency = self.adjacency_arrays()
+        head, tail = adjacency['head'], adjacency['tail']
         n = self.number_of_entities()
-        D = csr_matrix(
-                (1 / np.array(data), (np.array(row), np.array(col))),
-                shape=(n,n))
-        return self.csr_matrix().transpose() * D
+        degree = np.bincount(head, minlength=n).astype(value_dtype())
+        return csr_matrix((degree[head], (tail, head)), shape=(n,n))
 
     def reset(self):
         """Sets all values to 0"""
         self.entity_value_ = defaultdict(float)
         self.triple_value_ = defaultdict(float)
+        self.preference_vector_ = None
+
+    def preference_vector(self):
+        """
+        :return x: np.array (n_entities,) random walk vector the values
+            were last computed from, see store_pref, or None
+        """
+        return self.preference_vector_
 
     def entity_value(self, entity):
         """
@@ -209,30 +416,86 @@ class KnowledgeGraph(object):
         """
         return self.triple_value_[triple]
 
+    def valued_triples(self):
+        """
+        :return triples: generator of ((e1, r, e2), value) pairs of all
+            triples in ID order, with value the sum of the triple's and
+            its entities' values
+        """
+        for triple in self.ordered_triples():
+            e1, r, e2 = triple
+            yield triple, self.entity_value(e1) + self.entity_value(e2) + \
+                    self.triple_value(triple)
+
     def model_user_pref(self, query_log, power=1):
         """
         :param query_log: list of queries as dicts
         :param power: number of terms in Taylor expansion
         """
-        self.reset()
+        self.model_seed_pref(query_vector(self, query_log), power=power)
+
+    def model_seed_pref(self, x, power=1):
+        """
+        :param x: np.array (n_entities,) seed initializations, e.g. query_vector
+        :param power: number of terms in Taylor expansion
 
+        The terms of the last seed's random walk are kept, so modeling the
+        same seed with another power, e.g. for GLIMPSE and GLIMPSE-2 on the
+        same query log, only computes the terms beyond those.
+        """
         # Perform random walk on the KG
-        x = query_vector(self, query_log)
-        M = self.transition_matrix()
-        x = random_walk_with_restart(M, x, power=power)
+        with stage('random_walk_with_restart'):
+            x = self.random_walk(x).vector(power)
         # x /= np.sum(x)
 
+        self.store_pref(x)
+
+    def random_walk(self, x):
+        """
+        :param x: np.array (n_entities,) seed initializations
+        :return walk: RandomWalk from x, the same as the previous call's if
+            x and the KG are unchanged
+        """
+        x = np.asarray(x)
+        key = (x.shape, x.dtype.str, hashlib.sha256(np.ascontiguousarray(x).tobytes()).digest())
+        if self.random_walk_ is None or self.random_walk_[0] != key:
+            with stage('transition_matrix'):
+                M = self.transition_matrix()
+            self.random_walk_ = (key, RandomWalk(M, x))
+        return self.random_walk_[1]
+
+    def store_pref(self, x):
+        """
+        :param x: np.array (n_entities,) random walk vector, as returned by
+            random_walk_with_restart, not modified afterwards
+
+        Replaces all entity and triple values by the preferences in x.
+        """
+        self.reset()
+        self.preference_vector_ = x
+
         # Store entity and triple values
-        for eid, val in enumerate(x):
-            entity = self.id_entity(eid)
-            self.entity_value_[entity] = np.log(val + 1)
+        with stage('preference_values'):
+            for eid, val in enumerate(x):
+                entity = self.id_entity(eid)
+                self.entity_value_[entity] = np.log(val + 1)
 
-        for e1 in self.triples_:
-            for r in self.triples_[e1]:
-                for e2 in self.triples_[e1][r]:
-                    triple = (e1, r, e2)
-                    eid1, eid2 = self.entity_id(e1), self.entity_id(e2)
-                    self.triple_value_[triple] = np.log(x[eid1] * x[eid2] + 1)
+            for e1 in self.triples_:
+                for r in self.triples_[e1]:
+                    for e2 in self.triples_[e1][r]:
+                        triple = (e1, r, e2)
+                        eid1, eid2 = self.entity_id(e1), self.entity_id(e2)
+                        self.triple_value_[triple] = np.log(x[eid1] * x[eid2] + 1)
+
+    def query_pool(self, **kwargs):
+        """
+        :param kwargs: optional keyword arguments for QueryPool
+        :return pool: QueryPool over query_dir(), created on first call
+            and again whenever kwargs differ from the last call's
+        """
+        if self.query_pool_ is None or self.query_pool_[0] != kwargs:
+            self.query_pool_ = (kwargs, QueryPool(self.query_dir(), **kwargs))
+        return self.query_pool_[1]
 
     def query_dir(self):
         raise NotImplementedError
@@ -256,19 +519,21 @@ class Freebase(KnowledgeGraph):
 
     def __init__(self, rdf_gz='webqsp-filtered-relations-freebase-rdfs.gz',
                  entity_names='all_entities.tsv', query_dir='queries/',
-                 topic_dir='by-topic/', mid_dir='by-mid/'):
+                 topic_dir='by-topic/', mid_dir='by-mid/', reverse_index=False):
         """
         :param rdf_gz: filename of Freebase dump
         :param entity_names: mapping from MIDs to labels
         :param query_dir: directory where queries are saved as json
         :param topic_dir: directory where lists of query IDs by topic are stored
         :param mid_dir: directory where lists of query IDs by MID are stored
+        :param reverse_index: also index triples by tail entity after load
         """
-        super().__init__()
+        super().__init__(reverse_index=reverse_index)
         self.name_ = 'Freebase'
 
         self.rdf_gz_ = os.path.join(FREEBASE_DATA_DIR, rdf_gz)
         self.entity_names_ = os.path.join(FREEBASE_DATA_DIR, entity_names)
+        self.entity_names_index_ = None
         self.query_dir_ = os.path.join(FREEBASE_DATA_DIR, query_dir)
         self.topic_dir_ = os.path.join(FREEBASE_DATA_DIR, topic_dir)
         self.mid_dir_ = os.path.join(FREEBASE_DATA_DIR, mid_dir)
@@ -293,21 +558,39 @@ class Freebase(KnowledgeGraph):
         return self.mid_dir_
 
     def topics(self):
-        return [fname.split('.')[0] for fname in os.listdir(self.topic_dir_)]
+        return sorted(fname.split('.')[0] for fname in os.listdir(self.topic_dir_))
 
     def topic_mids(self):
-        return [fname[:-5] for fname in os.listdir(self.mid_dir_)]
+        return sorted(fname[:-5] for fname in os.listdir(self.mid_dir_))
 
-    def entity_names(self):
-        entity_names = {}
+    def iter_entity_names(self):
+        """
+        :return names: generator of (MID, label) pairs of the names file
+        """
         with open(self.entity_names_, 'r') as f:
             next(f)
             for line in f:
                 mid, name = line.rstrip().split('\t')
-                entity_names[mid] = name
-        return entity_names
+                yield mid, name
 
-    def load(self, head=None, strip=True):
+    def entity_names(self):
+        """
+        :return entity_names: StringIndex of {MID: label}, memory-mapped
+            from an index of the names file built on first use
+        """
+        if self.entity_names_index_ is None:
+            fname = self.entity_names_ + '.idx'
+            if not os.path.exists(fname) or \
+                    os.path.getmtime(fname) < os.path.getmtime(self.entity_names_):
+                build_index(self.iter_entity_names(), fname)
+            self.entity_names_index_ = StringIndex(fname)
+        return self.entity_names_index_
+
+    def iter_triples(self, strip=True):
+        """
+        :param strip: strip the Freebase prefix of names
+        :return triples: generator of (e1, r, e2) triples of the dump
+        """
         with gzip.open(self.rdf_gz_, 'rt') as f:
             for line in f:
                 fact = tuple(line.rstrip().split('\t')[:-1])
@@ -319,22 +602,30 @@ class Freebase(KnowledgeGraph):
                     e2 = self.strip_prefix(e2) if self.has_fb_prefix(e2) else e2
                     r = self.strip_prefix(r) if self.has_fb_prefix(r) else r
 
-                triple = (e1, r, e2)
-                self.add_triple(triple)
+                yield e1, r, e2
+
+    def load(self, head=None, strip=True):
+        for triple in self.iter_triples(strip=strip):
+            self.add_triple(triple)
+
+            if self.number_of_triples() == head:
+                break
 
-                if self.number_of_triples() == head:
-                    return
+        if self.reverse_index_:
+            self.build_reverse_index()
 
 
 class YAGO(KnowledgeGraph):
 
-    def __init__(self, rdf_gz='yagoFacts.gz', query_dir='queries/', mid_dir='by-mid/'):
+    def __init__(self, rdf_gz='yagoFacts.gz', query_dir='queries/', mid_dir='by-mid/',
+                 reverse_index=False):
         """
         :param rdf_gz: YAGO dump
         :param query_dir: directory where queries are saved as json
         :param mid_dir: directory where lists of query IDs by MID are stored
+        :param reverse_index: also index triples by tail entity after load
         """
-        super().__init__()
+        super().__init__(reverse_index=reverse_index)
         self.name_ = 'YAGO'
 
         self.rdf_gz_ = os.path.join(YAGO_DATA_DIR, rdf_gz)
@@ -355,12 +646,16 @@ class YAGO(KnowledgeGraph):
         return self.mid_dir_
 
     def topic_mids(self):
-        return [fname[:-5] for fname in os.listdir(self.mid_dir_)]
+        return sorted(fname[:-5] for fname in os.listdir(self.mid_dir_))
 
     def entity_names(self):
         return { entity : entity for entity in self.entities() }
 
-    def load(self, head=None, strip=True):
+    def iter_triples(self, strip=True):
+        """
+        :param strip: strip punctuation from names
+        :return triples: generator of (e1, r, e2) triples of the dump
+        """
         with gzip.open(self.rdf_gz_, 'rt') as f:
             for line in f:
                 fact = tuple(line.rstrip().split('\t')[:-1])
@@ -375,22 +670,30 @@ class YAGO(KnowledgeGraph):
                 if not e1 or not e2:
                     continue
 
-                triple = (e1, r, e2)
-                self.add_triple(triple)
+                yield e1, r, e2
+
+    def load(self, head=None, strip=True):
+        for triple in self.iter_triples(strip=strip):
+            self.add_triple(triple)
+
+            if self.number_of_triples() == head:
+                break
 
-                if self.number_of_triples() == head:
-                    return
+        if self.reverse_index_:
+            self.build_reverse_index()
 
 
 class DBPedia(KnowledgeGraph):
 
-    def __init__(self, rdf_gz='facts.gz', query_dir='queries/', mid_dir='by-mid/'):
+    def __init__(self, rdf_gz='facts.gz', query_dir='queries/', mid_dir='by-mid/',
+                 reverse_index=False):
         """
         :param rdf_gz: YAGO dump
         :param query_dir: directory where queries are saved as json
         :param mid_dir: directory where lists of query IDs by MID are stored
+        :param reverse_index: also index triples by tail entity after load
         """
-        super().__init__()
+        super().__init__(reverse_index=reverse_index)
         self.name_ = 'DBPedia'
 
         self.rdf_gz_ = os.path.join(DBPEDIA_DATA_DIR, rdf_gz)
@@ -407,12 +710,15 @@ class DBPedia(KnowledgeGraph):
         return self.mid_dir_
 
     def topic_mids(self):
-        return [fname[:-5] for fname in os.listdir(self.query_dir_)]
+        return sorted(fname[:-5] for fname in os.listdir(self.query_dir_))
 
     def entity_names(self):
         return { entity : entity for entity in self.entities() }
 
-    def load(self, head=None, strip=True):
+    def iter_triples(self):
+        """
+        :return triples: generator of (e1, r, e2) triples of the dump
+        """
         with gzip.open(self.rdf_gz_, 'rt') as f:
             for line in f:
                 fact = line.rstrip('\n')[:-2].split(' ')
@@ -422,8 +728,14 @@ class DBPedia(KnowledgeGraph):
                 if not e1 or not e2:
                     continue
 
-                triple = (e1, r, e2)
-                self.add_triple(triple)
+                yield e1, r, e2
+
+    def load(self, head=None, strip=True):
+        for triple in self.iter_triples():
+            self.add_triple(triple)
+
+            if self.number_of_triples() == head:
+                break
 
-                if self.number_of_triples() == head:
-                    return
+        if self.reverse_index_:
+            self.build_reverse_index()
@@ -0,0 +1,168 @@
+"""Content-addressed cache of summaries.
+
+A summary is identified by the KG it summarizes (KnowledgeGraph.
+fingerprint()), the topic entity counts of the query log it was made
+from, K, the summary method and its keyword arguments, and an optional
+seed. GLIMPSE only sees a query log through its topic entity counts, so
+logs that differ in questions or order but not in counts share a summary.
+
+Summaries are kept in an in-memory LRU tier and, if a directory is
+given, in an on-disk tier of binary exports (see src/export.py) that
+evicts the least recently used files beyond a total size.
+"""
+
+import os
+import json
+import hashlib
+import threading
+
+from collections import OrderedDict
+
+from . import export
+from .user import topic_counts
+
+# Keyword arguments that do not change the summary
+IGNORED_KWARGS = ('profile', 'checkpoint')
+
+
+def summary_key(KG, K, query_log, summary_method, seed=None, **kwargs):
+    """
+    :param KG: KnowledgeGraph
+    :param K: summary constraint
+    :param query_log: list of dict queries
+    :param summary_method: SummaryMethod
+    :param seed: optional json-serializable seed the summary was made with
+    :param kwargs: keyword arguments overriding the method's
+    :return key: hex digest identifying the summary
+    """
+    kwargs = dict(summary_method.kwargs(), **kwargs)
+    description = {
+        'kg': KG.fingerprint(),
+        'topic_counts': topic_counts(query_log),
+        'K': K,
+        'method': summary_method.name(),
+        'kwargs': {k: v for k, v in kwargs.items() if k not in IGNORED_KWARGS},
+        'seed': seed
+    }
+    return hashlib.sha256(
+            json.dumps(description, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class SummaryCache(object):
+
+    def __init__(self, max_entries=128, cache_dir=None, max_bytes=1 << 30):
+        """
+        :param max_entries: number of summaries kept in memory
+        :param cache_dir: optional directory of the on-disk tier
+        :param max_bytes: total size of the on-disk tier
+        """
+        self.max_entries_ = max_entries
+        self.cache_dir_ = cache_dir
+        self.max_bytes_ = max_bytes
+        self.memory_ = OrderedDict()
+        self.lock_ = threading.Lock()
+        self.hits_ = {'memory': 0, 'disk': 0}
+        self.misses_ = 0
+
+        if cache_dir is not None and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def stats(self):
+        """
+        :return stats: dict of hit and miss counts
+        """
+        return {'memory_hits': self.hits_['memory'], 'disk_hits': self.hits_['disk'],
+                'misses': self.misses_}
+
+    def _fname(self, key):
+        return os.path.join(self.cache_dir_, '{}.glsm'.format(key))
+
+    def get(self, KG, key):
+        """
+        :param KG: KnowledgeGraph the summary was made from
+        :param key: key returned by summary_key
+        :return S: cached Summary, or None
+        """
+        with self.lock_:
+            if key in self.memory_:
+                self.memory_.move_to_end(key)
+                self.hits_['memory'] += 1
+                return self.memory_[key]
+
+        if self.cache_dir_ is not None:
+            fname = self._fname(key)
+            try:
+                S = export.load_summary(KG, fname)
+                os.utime(fname) # mark as recently used
+            except (OSError, ValueError):
+                S = None
+            if S is not None:
+                with self.lock_:
+                    self.hits_['disk'] += 1
+                self._remember(key, S)
+                return S
+
+        with self.lock_:
+            self.misses_ += 1
+        return None
+
+    def put(self, key, S):
+        """
+        :param key: key returned by summary_key
+        :param S: Summary
+        """
+        self._remember(key, S)
+        if self.cache_dir_ is not None:
+            fname = self._fname(key)
+            # Unique per writer: forked workers share the parent's thread IDs
+            tmp_fname = '{}.{}.{}.tmp'.format(fname, os.getpid(), threading.get_ident())
+            export.save_summary(S, tmp_fname)
+            os.replace(tmp_fname, fname)
+            self._evict()
+
+    def _remember(self, key, S):
+        with self.lock_:
+            self.memory_[key] = S
+            self.memory_.move_to_end(key)
+            while len(self.memory_) > self.max_entries_:
+                self.memory_.popitem(last=False)
+
+    def _evict(self):
+        """Delete least recently used files until the disk tier fits max_bytes"""
+        files = []
+        for fname in os.listdir(self.cache_dir_):
+            if not fname.endswith('.glsm'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir_, fname))
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, fname))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, fname in sorted(files):
+            if total <= self.max_bytes_:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir_, fname))
+            except OSError:
+                pass
+            total -= size
+
+    def summarize(self, KG, K, query_log, summary_method, seed=None, **kwargs):
+        """
+        :param KG: KnowledgeGraph
+        :param K: summary constraint
+        :param query_log: list of dict queries
+        :param summary_method: SummaryMethod
+        :param seed: optional seed the generators were seeded with, part
+            of the key since GLIMPSE samples the heap at random
+        :param kwargs: keyword arguments overriding the method's
+        :return S: cached Summary, or a new one which is then cached
+        """
+        key = summary_key(KG, K, query_log, summary_method, seed=seed, **kwargs)
+        S = self.get(KG, key)
+        if S is None:
+            S = summary_method(KG, K, query_log, **kwargs)
+            self.put(key, S)
+        return S
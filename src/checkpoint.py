@@ -0,0 +1,154 @@
+"""Checkpoints of the greedy loop of GLIMPSE.
+
+With a large K, the greedy loop can run for hours. A Checkpointer
+periodically saves everything the rest of the loop depends on: the
+triples selected so far, the heap's triples and marginal values in heap
+order, the state of np.random, which the heap samples from, and the
+preference vector the values were computed from.
+
+Checkpoints are named by a key of the summary's inputs, including the
+state of np.random when GLIMPSE starts, so a run resumes from a
+checkpoint exactly when an uninterrupted run with the same inputs would
+have produced it, and then produces the same summary.
+"""
+
+import os
+import json
+import hashlib
+
+import numpy as np
+
+from time import perf_counter
+
+from .user import topic_counts
+
+def checkpoint_key(KG, K, query_log, epsilon, power, budget=False):
+    """
+    :param KG: KnowledgeGraph
+    :param K: number of triples in summary
+    :param query_log: user queries
+    :param epsilon: epsilon-from-optimal factor
+    :param power: number of terms in Taylor expansion
+    :param budget: False, or the selection of a summary whose K is a
+        byte budget, 'ratio' or 'value', see GLIMPSE
+    :return key: hex digest identifying the run of GLIMPSE
+    """
+    _, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    description = {
+        'kg': KG.fingerprint(),
+        'topic_counts': topic_counts(query_log),
+        'K': K,
+        'epsilon': epsilon,
+        'power': power,
+        'budget': budget,
+        'rng': [hashlib.sha256(keys.tobytes()).hexdigest(), pos, has_gauss, cached_gaussian]
+    }
+    return hashlib.sha256(
+            json.dumps(description, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class Checkpointer(object):
+
+    def __init__(self, checkpoint_dir, every=600., every_pops=None):
+        """
+        :param checkpoint_dir: directory to write checkpoints to
+        :param every: seconds between checkpoints, or None
+        :param every_pops: number of selected triples between checkpoints, or None
+        """
+        self.checkpoint_dir_ = checkpoint_dir
+        self.every_, self.every_pops_ = every, every_pops
+
+        self.KG_ = None
+        self.fname_ = None
+        self.selected_ = []
+
+        if not os.path.isdir(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+
+    def fname(self):
+        return self.fname_
+
+    def open(self, KG, key):
+        """
+        :param KG: KnowledgeGraph being summarized
+        :param key: key returned by checkpoint_key
+        :return state: dict of the latest checkpoint of this key, or None
+
+        The state has 'selected' and 'heap_items' triples, the 'x'
+        preference vector, the 'sample_size' of the loop and the 'rng'
+        state to restore with np.random.set_state.
+        """
+        self.KG_ = KG
+        self.fname_ = os.path.join(self.checkpoint_dir_, '{}.npz'.format(key))
+        self.selected_ = []
+        self.last_time_, self.last_pops_ = perf_counter(), 0
+
+        if not os.path.isfile(self.fname_):
+            return None
+
+        with np.load(self.fname_) as f:
+            state = {k: f[k] for k in f.files}
+
+        triple = lambda ids: (KG.id_entity(ids[0]), KG.id_relationship(ids[1]),
+                KG.id_entity(ids[2]))
+        self.selected_ = [triple(ids) for ids in state['selected'].tolist()]
+        self.last_pops_ = len(self.selected_)
+
+        return {
+            'selected': list(self.selected_),
+            'heap_items': list(zip(map(triple, state['heap_triples'].tolist()),
+                state['heap_values'].tolist())),
+            'x': state['x'],
+            'sample_size': int(state['sample_size']),
+            'rng': ('MT19937', state['rng_keys'], int(state['rng_pos']),
+                int(state['rng_has_gauss']), float(state['rng_cached_gaussian']))
+        }
+
+    def add(self, triple):
+        """
+        :param triple: (e1, r, e2) triple just selected by the greedy loop
+        """
+        self.selected_.append(triple)
+
+    def due(self):
+        """
+        :return due: whether a checkpoint should be saved now
+        """
+        if self.every_pops_ is not None and \
+                len(self.selected_) - self.last_pops_ >= self.every_pops_:
+            return True
+        return self.every_ is not None and perf_counter() - self.last_time_ >= self.every_
+
+    def save(self, heap, sample_size):
+        """
+        :param heap: Heap of the greedy loop
+        :param sample_size: sample size of the greedy loop
+        """
+        KG = self.KG_
+        ids = lambda triples: np.array([
+            (KG.entity_id(e1), KG.relationship_id(r), KG.entity_id(e2))
+            for e1, r, e2 in triples], dtype=np.int64).reshape(-1, 3)
+
+        items = heap.items()
+        _, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+
+        # Write to a temporary file first so a crash never leaves a
+        # partial checkpoint behind
+        tmp_fname = self.fname_ + '.tmp'
+        with open(tmp_fname, 'wb') as f:
+            np.savez(f, selected=ids(self.selected_),
+                    heap_triples=ids(triple for triple, _ in items),
+                    heap_values=np.array([value for _, value in items], dtype=np.float64),
+                    x=KG.preference_vector(), sample_size=sample_size,
+                    rng_keys=keys, rng_pos=pos, rng_has_gauss=has_gauss,
+                    rng_cached_gaussian=cached_gaussian)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_fname, self.fname_)
+
+        self.last_time_, self.last_pops_ = perf_counter(), len(self.selected_)
+
+    def remove(self):
+        """Delete the checkpoint of a finished run"""
+        if self.fname_ is not None and os.path.isfile(self.fname_):
+            os.remove(self.fname_)
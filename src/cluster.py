@@ -0,0 +1,198 @@
+"""Summarizing many users at once by sharing work within clusters of users.
+
+Users whose query logs ask about the same topic entities get nearly the
+same summaries, so instead of one model_user_pref and GLIMPSE run each:
+
+1. users are clustered by the cosine similarity of their seed
+   distributions, i.e. their normalized query_vector
+2. the random walks of the mean and the consensus of the members' seeds,
+   and of every member's seed, are computed together, one product with
+   the transition matrix per term for the whole cluster
+3. the walk of the mean seed is stored on the KG once, and its candidate
+   heap is built once
+4. a greedy prefix of base_fraction * K triples is selected once among
+   the candidates, valued under the walk of the consensus seed, the
+   elementwise minimum of the members' seeds, i.e. what every member
+   values; there is no prefix if the members share no topic entity
+5. each member's summary starts from the prefix and is completed by a
+   greedy selection over the remaining candidates, valued under the
+   member's own random walk
+
+The mean seed is positive wherever a member's is, so its walk, and so
+the candidate heap, covers every triple of positive value to any
+member; personalization only loses the prefix triples a member would
+not have picked. Clusters of a single user are summarized exactly as by
+GLIMPSE.
+"""
+
+import math
+
+import numpy as np
+
+from scipy.cluster.hierarchy import fcluster, linkage
+
+from .algorithms import RandomWalk, query_vector
+from .dtypes import value_dtype
+from .glimpse import Summary, greedy_select
+from .heap import Heap
+from .instrument import stage
+
+def seed_distributions(KG, query_logs):
+    """
+    :param KG: KnowledgeGraph
+    :param query_logs: list of query logs, one per user
+    :return X: np.array (n_entities, n_users) query vectors normalized to sum 1
+    """
+    X = np.column_stack([query_vector(KG, query_log) for query_log in query_logs])
+    return X / np.maximum(np.sum(X, axis=0), 1)
+
+def cluster_users(X, similarity=0.5):
+    """
+    :param X: np.array (n_entities, n_users) seed distributions
+    :param similarity: float in [0, 1], minimum average cosine similarity
+        between users of the same cluster
+    :return labels: list of cluster index per user, numbered from 0 in
+        order of each cluster's first user
+    """
+    n_users = X.shape[1]
+    if n_users < 2:
+        return [0] * n_users
+
+    # Average linkage, cut where clusters get less similar than required
+    Z = linkage(X.T, method='average', metric='cosine')
+    flat = fcluster(Z, t=1 - similarity, criterion='distance')
+
+    labels, index = [], {}
+    for label in flat.tolist():
+        labels.append(index.setdefault(label, len(index)))
+    return labels
+
+
+class MemberSummary(Summary):
+    """Summary valued under a user's preference vector rather than the
+    preferences stored on its parent KG"""
+
+    def __init__(self, KG, x):
+        """
+        :param KG: KnowledgeGraph
+        :param x: np.array (n_entities,) random walk vector of the user
+        """
+        super().__init__(KG)
+        # Python floats, as the greedy loop values one triple at a time
+        self.x_ = np.asarray(x).tolist()
+        self.member_entity_value_ = np.log(x + 1).tolist()
+
+    def _entity_value(self, entity):
+        return self.member_entity_value_[self.parent().entity_id(entity)]
+
+    def _triple_value(self, triple):
+        e1, _, e2 = triple
+        entity_id = self.parent().entity_id
+        return math.log(self.x_[entity_id(e1)] * self.x_[entity_id(e2)] + 1)
+
+    def marginal_value(self, triple):
+        """
+        :param triple: (e1, r, e2) triple
+        :return marginal_value: total marginal value of adding triple to S
+        """
+        total = 0
+        e1, r, e2 = triple
+
+        if not self.has_entity(e1):
+            total += self._entity_value(e1)
+        if not self.has_entity(e2):
+            total += self._entity_value(e2)
+        if not self.has_triple(triple):
+            total += self._triple_value(triple)
+        return total
+
+    def value(self):
+        return sum(self._entity_value(entity) for entity in self.entities()) + \
+                sum(self._triple_value(triple) for triple in self.triples())
+
+def member_items(KG, triples, x):
+    """
+    :param KG: KnowledgeGraph
+    :param triples: list of candidate (e1, r, e2) triples
+    :param x: np.array (n_entities,) random walk vector of a user
+    :return items: (triple, value) pairs of the candidates of positive
+        value under x, with value as in KnowledgeGraph.valued_triples
+    """
+    eid1 = np.fromiter((KG.entity_id(e1) for e1, _, _ in triples), dtype=np.int64,
+            count=len(triples))
+    eid2 = np.fromiter((KG.entity_id(e2) for _, _, e2 in triples), dtype=np.int64,
+            count=len(triples))
+    x1, x2 = x[eid1], x[eid2]
+    values = (np.log(x1 + 1) + np.log(x2 + 1) + np.log(x1 * x2 + 1)).astype(value_dtype())
+    return [(triples[i], values[i]) for i in np.flatnonzero(values > 0).tolist()]
+
+def shared_summaries(KG, K, query_logs, labels=None, similarity=0.5, base_fraction=0.5,
+        epsilon=1e-3, power=1):
+    """
+    :param KG: KnowledgeGraph to summarize
+    :param K: number of triples in each summary
+    :param query_logs: list of query logs, one per user
+    :param labels: optional cluster index per user, cluster_users of the
+        users' seed distributions if None
+    :param similarity: minimum similarity of users in a cluster, see cluster_users
+    :param base_fraction: float in [0, 1], share of K selected for the
+        whole cluster before personalizing each member's summary
+    :param epsilon: float in (0, 1] or None, epsilon-from-optimal factor
+    :param power: number of terms in Taylor expansion
+    :return summaries: list of Summary, one per user
+
+    Leaves the preferences of the last cluster stored on KG.
+    """
+    X = seed_distributions(KG, query_logs)
+    if labels is None:
+        labels = cluster_users(X, similarity=similarity)
+
+    clusters = {}
+    for user, label in enumerate(labels):
+        clusters.setdefault(label, []).append(user)
+
+    summaries = [None] * len(query_logs)
+    for members in clusters.values():
+        # Walk from the cluster's seeds and its members' seeds together
+        mean, consensus = np.mean(X[:, members], axis=1), np.min(X[:, members], axis=1)
+        shared = [mean] if len(members) == 1 else \
+                [mean, consensus] if K * base_fraction >= 1 and np.any(consensus) else [mean]
+        with stage('random_walk_with_restart'):
+            seeds = np.column_stack(shared + ([] if len(members) == 1 else [X[:, members]]))
+            R = RandomWalk(KG.transition_matrix(), seeds).vector(power)
+
+        KG.store_pref(R[:, 0])
+        with stage('heap'):
+            heap = Heap(KG)
+        if len(members) == 1:
+            summaries[members[0]] = S = Summary(KG)
+            with stage('greedy'):
+                greedy_select(heap, S, K, epsilon=epsilon)
+            with stage('fill'):
+                S.fill(KG.ordered_triples(), K)
+            continue
+
+        # The prefix is what all members value, if they agree on anything
+        candidates, prefix = heap.triples(), []
+        if len(shared) > 1:
+            base = MemberSummary(KG, R[:, 1])
+            with stage('heap'):
+                heap = Heap(KG, items=member_items(KG, candidates, R[:, 1]))
+            with stage('greedy'):
+                greedy_select(heap, base, int(base_fraction * K), epsilon=epsilon)
+            # In the prefix's own ID order, not the hash order of triples()
+            prefix = list(base.ordered_triples())
+            candidates = [triple for triple in candidates if not base.has_triple(triple)]
+
+        for j, user in enumerate(members):
+            S = MemberSummary(KG, R[:, len(shared) + j])
+            for triple in prefix:
+                S.add_triple(triple)
+            with stage('heap'):
+                heap = Heap(KG, items=member_items(KG, candidates, R[:, len(shared) + j]))
+            with stage('greedy'):
+                greedy_select(heap, S, K, epsilon=epsilon)
+            with stage('fill'):
+                S.fill(KG.ordered_triples(), K)
+            summaries[user] = S
+    return summaries
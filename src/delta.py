@@ -0,0 +1,216 @@
+"""Binary deltas between successive summaries of a user.
+
+A delta turns a summary in the binary export format of src/export.py
+into a newer summary, so a refreshed summary costs bytes and patching
+work in proportion to the triples that changed instead of to K:
+
+    data = export.to_bytes(S_old)           # shipped once
+    delta = diff(KG, data, S_new)           # on every refresh
+    data = patch_bytes(data, delta)         # or patch_file(fname, delta)
+
+Triples are compared by their IDs in the parent KG. The delta holds the
+rows of the export's triples to remove, the names to append to its
+vocabularies and the triples to add, as indices into the appended
+vocabularies:
+
+    header, '\\n'-joined utf-8 new names, uint32 removed rows, uint32 added triples
+
+Patching keeps the file in the export format, but not in its canonical
+order: names are only ever appended, so names that no triple uses any
+more are kept, and triples are moved instead of shifted. The sender
+therefore diffs against the patched bytes it last shipped, which
+patch_bytes reproduces exactly, not against export.to_bytes(S_old).
+"""
+
+import mmap
+import struct
+
+import numpy as np
+
+from . import export
+
+MAGIC = b'GLSD'
+VERSION = 1
+HEADER = struct.Struct('<4sHxxIIIIII')
+
+
+def _vocabulary_ids(names, name_id):
+    """
+    :param names: list of entity or relationship names
+    :param name_id: KG.entity_id or KG.relationship_id
+    :return ids: np.array of the names' KG IDs
+    """
+    return np.array([name_id(name) for name in names], dtype=np.int64)
+
+def diff(KG, data, S):
+    """
+    :param KG: parent KnowledgeGraph of both summaries
+    :param data: bytes in the binary export format of the previous
+        summary, as shipped, i.e. possibly patched
+    :param S: new Summary
+    :return delta: bytes turning data into an export of S, see patch_bytes
+    """
+    entities, relationships, triples = export.parse_bytes(data)
+    entity_ids = _vocabulary_ids(entities, KG.entity_id)
+    relationship_ids = _vocabulary_ids(relationships, KG.relationship_id)
+
+    # Rows of the previous summary by their triple's KG IDs
+    old_ids = np.column_stack([entity_ids[triples[:, 0]], relationship_ids[triples[:, 1]],
+        entity_ids[triples[:, 2]]]) if len(triples) else np.empty((0, 3), dtype=np.int64)
+    old_rows = {triple: row for row, triple in enumerate(map(tuple, old_ids.tolist()))}
+    new_ids = {(KG.entity_id(e1), KG.relationship_id(r), KG.entity_id(e2))
+            for e1, r, e2 in S.triples()}
+
+    removed = sorted(row for triple, row in old_rows.items() if triple not in new_ids)
+    added = sorted(triple for triple in new_ids if triple not in old_rows)
+
+    # Append the names of added triples that are not in the vocabularies yet
+    entity_index = {eid: i for i, eid in enumerate(entity_ids.tolist())}
+    relationship_index = {rid: i for i, rid in enumerate(relationship_ids.tolist())}
+    new_entities, new_relationships = [], []
+    for e1, r, e2 in added:
+        for eid in (e1, e2):
+            if eid not in entity_index:
+                entity_index[eid] = len(entity_index)
+                new_entities.append(KG.id_entity(eid))
+        if r not in relationship_index:
+            relationship_index[r] = len(relationship_index)
+            new_relationships.append(KG.id_relationship(r))
+
+    added = np.array([(entity_index[e1], relationship_index[r], entity_index[e2])
+        for e1, r, e2 in added], dtype=np.uint32).reshape(-1, 3)
+    entity_bytes = '\n'.join(new_entities).encode('utf-8')
+    relationship_bytes = '\n'.join(new_relationships).encode('utf-8')
+
+    header = HEADER.pack(MAGIC, VERSION, len(removed), len(added), len(new_entities),
+            len(new_relationships), len(entity_bytes), len(relationship_bytes))
+    return header + entity_bytes + relationship_bytes + \
+            np.array(removed, dtype='<u4').tobytes() + added.astype('<u4').tobytes()
+
+def parse_delta(delta):
+    """
+    :param delta: bytes returned by diff
+    :return removed, entity_bytes, relationship_bytes, added: np.array of
+        rows to remove, utf-8 new names and np.array (n_added, 3) triples
+    """
+    magic, version, n_removed, n_added, _, _, n_entity_bytes, n_relationship_bytes = \
+            HEADER.unpack_from(delta)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('Not a version {} summary delta'.format(VERSION))
+
+    offset = HEADER.size
+    entity_bytes = bytes(delta[offset:offset + n_entity_bytes])
+    offset += n_entity_bytes
+    relationship_bytes = bytes(delta[offset:offset + n_relationship_bytes])
+    offset += n_relationship_bytes
+    removed = np.frombuffer(delta, dtype='<u4', count=n_removed, offset=offset)
+    offset += removed.nbytes
+    added = np.frombuffer(delta, dtype='<u4', count=3 * n_added, offset=offset).reshape(-1, 3)
+    return removed, entity_bytes, relationship_bytes, added
+
+def _append_names(vocabulary, names):
+    """
+    :param vocabulary: '\\n'-joined utf-8 names
+    :param names: '\\n'-joined utf-8 names to append
+    :return vocabulary: '\\n'-joined utf-8 names
+    """
+    if not names:
+        return vocabulary
+    return vocabulary + b'\n' + names if vocabulary else names
+
+def _patch(buf, delta, resize):
+    """
+    :param buf: writable buffer holding a binary export
+    :param delta: bytes returned by diff
+    :param resize: function resize(buf, n_bytes) returning the resized buffer
+    :return buf: patched buffer
+
+    Removed rows are filled with the last rows. The vocabularies grow in
+    place, and the triples after them move by a whole number of rows,
+    padded with separators at the end of the relationship vocabulary,
+    so only as many rows move as the new names take. The relationship
+    vocabulary itself is rewritten, which costs a few bytes per
+    relationship of the summary.
+    """
+    magic, version, n_entities, n_relationships, n_triples, n_entity_bytes, \
+            n_relationship_bytes = export.HEADER.unpack_from(buf)
+    if magic != export.MAGIC or version != export.VERSION:
+        raise ValueError('Not a version {} summary export'.format(export.VERSION))
+    _, _, _, _, n_new_entities, n_new_relationships, _, _ = HEADER.unpack_from(delta)
+    removed, entity_bytes, relationship_bytes, added = parse_delta(delta)
+
+    start = export.HEADER.size + n_entity_bytes + n_relationship_bytes
+    row = export.TRIPLE_BYTES
+    rows = lambda i, j: slice(start + i * row, start + j * row)
+
+    # Fill removed rows below the new number of triples with kept rows above it
+    n_kept = n_triples - len(removed)
+    holes = removed[removed < n_kept]
+    is_removed = np.zeros(n_triples - n_kept, dtype=bool)
+    is_removed[removed[removed >= n_kept] - n_kept] = True
+    for hole, filler in zip(holes.tolist(), (np.flatnonzero(~is_removed) + n_kept).tolist()):
+        buf[rows(hole, hole + 1)] = buf[rows(filler, filler + 1)]
+
+    # Names are never empty, so trailing separators are padding of previous patches
+    entities = b'\n' + entity_bytes if n_entities and entity_bytes else entity_bytes
+    relationships = _append_names(
+            bytes(buf[start - n_relationship_bytes:start]).rstrip(b'\n'), relationship_bytes)
+
+    entity_start = export.HEADER.size + n_entity_bytes
+    vocabulary_end = entity_start + len(entities) + len(relationships)
+    shift = max(0, -(-(vocabulary_end - start) // row))
+    relationships += b'\n' * (start + shift * row - vocabulary_end)
+
+    n_bytes = start + (shift + n_kept + len(added)) * row
+    if n_bytes > len(buf):
+        buf = resize(buf, n_bytes)
+
+    # Move the rows the grown vocabularies overwrite to the end
+    if shift:
+        moved = min(shift, n_kept)
+        buf[rows(max(shift, n_kept), max(shift, n_kept) + moved)] = bytes(buf[rows(0, moved)])
+
+    buf[entity_start:start + shift * row] = entities + relationships
+
+    end = n_bytes - len(added) * row
+    buf[end:n_bytes] = added.astype('<u4').tobytes()
+    export.HEADER.pack_into(buf, 0, export.MAGIC, export.VERSION,
+            n_entities + n_new_entities, n_relationships + n_new_relationships,
+            n_kept + len(added), n_entity_bytes + len(entities), len(relationships))
+
+    if n_bytes < len(buf):
+        buf = resize(buf, n_bytes)
+    return buf
+
+def _resize_bytearray(buf, n_bytes):
+    if n_bytes > len(buf):
+        buf.extend(bytes(n_bytes - len(buf)))
+    else:
+        del buf[n_bytes:]
+    return buf
+
+def _resize_mmap(buf, n_bytes):
+    buf.resize(n_bytes)
+    return buf
+
+def patch_bytes(data, delta):
+    """
+    :param data: bytes in the binary export format
+    :param delta: bytes returned by diff(KG, data, S)
+    :return data: bytes in the binary export format of S
+    """
+    return bytes(_patch(bytearray(data), delta, _resize_bytearray))
+
+def patch_file(fname, delta):
+    """
+    :param fname: file in the binary export format, e.g. written by
+        export.save_summary, patched in place through a memory map
+    :param delta: bytes returned by diff for the file's contents
+    """
+    with open(fname, 'r+b') as f:
+        buf = mmap.mmap(f.fileno(), 0)
+        try:
+            buf = _patch(buf, delta, _resize_mmap)
+            buf.flush()
+        finally:
+            buf.close()
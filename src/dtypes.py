@@ -0,0 +1,45 @@
+"""Numeric types of the arrays derived from a KG.
+
+Preference vectors and the transition matrix are dense or sparse arrays
+over all entities, and adjacency arrays hold an ID per triple, so on KGs
+with tens of millions of entities their types decide the memory of a
+user's summary. A policy sets them for the whole process:
+
+    float64: float64 values and int64 IDs, the default
+    float32: float32 values and int32 IDs, half the memory, for KGs
+             with fewer than 2^31 entities and triples
+
+Policies only change rounding: random walks, entity and triple values
+and heap marginals are computed the same way in either.
+"""
+
+import numpy as np
+
+POLICIES = {
+    'float64': (np.float64, np.int64),
+    'float32': (np.float32, np.int32)
+}
+
+_VALUE_DTYPE, _INDEX_DTYPE = POLICIES['float64']
+
+
+def set_policy(name):
+    """
+    :param name: one of POLICIES
+    """
+    global _VALUE_DTYPE, _INDEX_DTYPE
+    if name not in POLICIES:
+        raise ValueError('Unknown dtype policy: {}'.format(name))
+    _VALUE_DTYPE, _INDEX_DTYPE = POLICIES[name]
+
+def value_dtype():
+    """
+    :return dtype: type of preference vectors, matrix values and marginals
+    """
+    return _VALUE_DTYPE
+
+def index_dtype():
+    """
+    :return dtype: type of entity and relationship IDs in adjacency arrays
+    """
+    return _INDEX_DTYPE
@@ -0,0 +1,152 @@
+"""Compact export format of summaries.
+
+A summary is exported as a vocabulary of the entities and relationships
+it contains, each sorted by name, and its triples as (entity index,
+relationship index, entity index) rows sorted by index, so that equal
+summaries always export to equal bytes. There are two encodings:
+
+    json:   {"entities": [...], "relationships": [...], "triples": [[i, j, k], ...]}
+    binary: header, '\\n'-joined utf-8 vocabularies, little-endian uint32 triples
+
+The binary header holds a magic string, the format version, and the
+number of entities, relationships and triples, followed by the byte
+length of each vocabulary.
+"""
+
+import json
+import struct
+
+import numpy as np
+
+MAGIC = b'GLSM'
+VERSION = 1
+HEADER = struct.Struct('<4sHxxIIIII')
+TRIPLE_BYTES = 12
+
+
+def string_bytes(s):
+    """
+    :param s: entity or relationship name
+    :return n_bytes: bytes the name takes in a binary vocabulary, with
+        its separator; the last name of a vocabulary takes one less
+    """
+    return len(s.encode('utf-8')) + 1
+
+def summary_arrays(S):
+    """
+    :param S: Summary or KnowledgeGraph
+    :return entities, relationships, triples: sorted lists of names and
+        np.array (n_triples, 3) of vocabulary indices
+    """
+    entities = sorted(S.entities())
+    relationships = sorted(S.relationships())
+    entity_index = {entity: i for i, entity in enumerate(entities)}
+    relationship_index = {r: i for i, r in enumerate(relationships)}
+
+    triples = np.array([
+        (entity_index[e1], relationship_index[r], entity_index[e2])
+        for e1, r, e2 in S.triples()
+    ], dtype=np.uint32).reshape(-1, 3)
+    triples = triples[np.lexsort(triples.T[::-1])]
+    return entities, relationships, triples
+
+def arrays_to_summary(KG, entities, relationships, triples):
+    """
+    :param KG: parent KnowledgeGraph of the summary
+    :param entities: list of entity names
+    :param relationships: list of relationship names
+    :param triples: (n_triples, 3) vocabulary indices
+    :return S: Summary
+    """
+    from .glimpse import Summary
+
+    S = Summary(KG)
+    for i, j, k in np.asarray(triples).tolist():
+        S.add_triple((entities[i], relationships[j], entities[k]))
+    return S
+
+def to_dict(S):
+    """
+    :param S: Summary
+    :return d: json-serializable dict in the export format
+    """
+    entities, relationships, triples = summary_arrays(S)
+    return {
+        'entities': entities,
+        'relationships': relationships,
+        'triples': triples.tolist()
+    }
+
+def from_dict(KG, d):
+    """
+    :param KG: parent KnowledgeGraph of the summary
+    :param d: dict returned by to_dict
+    :return S: Summary
+    """
+    return arrays_to_summary(KG, d['entities'], d['relationships'], d['triples'])
+
+def to_bytes(S):
+    """
+    :param S: Summary
+    :return data: bytes in the binary export format
+    """
+    entities, relationships, triples = summary_arrays(S)
+    entity_bytes = '\n'.join(entities).encode('utf-8')
+    relationship_bytes = '\n'.join(relationships).encode('utf-8')
+
+    header = HEADER.pack(MAGIC, VERSION, len(entities), len(relationships),
+            len(triples), len(entity_bytes), len(relationship_bytes))
+    return header + entity_bytes + relationship_bytes + \
+            triples.astype('<u4').tobytes()
+
+def parse_bytes(data):
+    """
+    :param data: bytes in the binary export format
+    :return entities, relationships, triples: as returned by summary_arrays
+    """
+    magic, version, n_entities, n_relationships, n_triples, \
+            n_entity_bytes, n_relationship_bytes = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('Not a version {} summary export'.format(VERSION))
+
+    offset = HEADER.size
+    entities = data[offset:offset + n_entity_bytes].decode('utf-8').split('\n')
+    offset += n_entity_bytes
+    relationships = data[offset:offset + n_relationship_bytes].decode('utf-8').split('\n')
+    offset += n_relationship_bytes
+    triples = np.frombuffer(data, dtype='<u4', count=3 * n_triples,
+            offset=offset).reshape(-1, 3)
+
+    return entities[:n_entities], relationships[:n_relationships], triples
+
+def from_bytes(KG, data):
+    """
+    :param KG: parent KnowledgeGraph of the summary
+    :param data: bytes returned by to_bytes
+    :return S: Summary
+    """
+    return arrays_to_summary(KG, *parse_bytes(data))
+
+def save_summary(S, fname):
+    """
+    :param S: Summary
+    :param fname: file to write the binary export to
+    """
+    with open(fname, 'wb') as f:
+        f.write(to_bytes(S))
+
+def load_summary(KG, fname):
+    """
+    :param KG: parent KnowledgeGraph of the summary
+    :param fname: file written by save_summary
+    :return S: Summary
+    """
+    with open(fname, 'rb') as f:
+        return from_bytes(KG, f.read())
+
+def dumps(S):
+    """
+    :param S: Summary
+    :return s: str of the json export format
+    """
+    return json.dumps(to_dict(S), separators=(',', ':'))
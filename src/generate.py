@@ -0,0 +1,339 @@
+"""Bulk synthetic query generation.
+
+Queries follow the same recipe as generate_query in query.py:
+random walks of 1-3 hops from a topic entity, choosing a predicate
+uniformly among the entity's predicates and then an object uniformly
+among that predicate's objects, optionally followed by one constraint.
+Instead of walking the dict-of-dicts one query at a time, a chunk of
+queries is walked at once over KG.adjacency_arrays(), and answers and
+constraints are evaluated for the whole chunk with array operations.
+"""
+
+import logging
+import multiprocessing
+
+import numpy as np
+
+from .query import get_name, append_questions
+
+# Set per worker process by _init_worker
+_KG = None
+_ENTITY_NAMES = None
+_KEYS = None
+
+
+def _init_worker(KG, entity_names):
+    """
+    :param KG: KnowledgeGraph
+    :param entity_names: dict of {MID: label}
+    """
+    global _KG, _ENTITY_NAMES, _KEYS
+    _KG, _ENTITY_NAMES, _KEYS = KG, entity_names, None
+
+def _keys(adj):
+    """
+    :param adj: KG.adjacency_arrays()
+    :return n_rel: number of relationship IDs
+    :return group_key: (n_groups,) sorted keys of head * n_rel + rel
+    :return edge_key: (n_triples,) sorted keys of group * n_entities + tail
+    """
+    global _KEYS
+    if _KEYS is None:
+        n = len(adj['head_ptr']) - 1
+        n_rel = int(adj['rel'].max()) + 1 if len(adj['rel']) else 1
+        group = np.repeat(np.arange(len(adj['group_head'])), np.diff(adj['group_ptr']))
+        # Keys are int64, as n_entities * n_rel overflows int32 IDs
+        _KEYS = (n_rel, adj['group_head'].astype(np.int64) * n_rel + adj['group_rel'],
+                group * n + adj['tail'])
+    return _KEYS
+
+def _search(sorted_keys, keys):
+    """
+    :param sorted_keys: (n,) sorted int array
+    :param keys: (m,) int array
+    :return index: (m,) position of each key in sorted_keys, -1 if absent
+    """
+    if not len(sorted_keys):
+        return np.full(len(keys), -1, dtype=np.int64)
+    index = np.searchsorted(sorted_keys, keys)
+    index[index == len(sorted_keys)] = 0
+    return np.where(sorted_keys[index] == keys, index, -1)
+
+def _find_groups(adj, heads, rels):
+    """
+    :param adj: KG.adjacency_arrays()
+    :param heads: (m,) head entity IDs
+    :param rels: (m,) relationship IDs
+    :return groups: (m,) group index of each (head, rel) pair, -1 if absent
+    """
+    n_rel, group_key, _ = _keys(adj)
+    return _search(group_key, np.asarray(heads, dtype=np.int64) * n_rel + rels)
+
+def _has_triples(adj, heads, rels, tails):
+    """
+    :param adj: KG.adjacency_arrays()
+    :param heads, rels, tails: (m,) triple IDs
+    :return mask: (m,) whether each triple is in the KG
+    """
+    groups = _find_groups(adj, heads, rels)
+    n = len(adj['head_ptr']) - 1
+    _, _, edge_key = _keys(adj)
+    return (groups >= 0) & (_search(edge_key, groups.astype(np.int64) * n + tails) >= 0)
+
+def _random_groups(adj, entities, rng):
+    """
+    :param adj: KG.adjacency_arrays()
+    :param entities: (m,) entity IDs
+    :param rng: np.random.Generator
+    :return groups: (m,) uniformly chosen group of each entity, -1 if none
+    """
+    lo = adj['head_ptr'][entities]
+    n_groups = adj['head_ptr'][entities + 1] - lo
+    groups = lo + np.floor(rng.random(len(entities)) * n_groups).astype(np.int64)
+    return np.where(n_groups > 0, groups, -1)
+
+def _random_tails(adj, groups, rng):
+    """
+    :param adj: KG.adjacency_arrays()
+    :param groups: (m,) valid group indices
+    :param rng: np.random.Generator
+    :return tails: (m,) uniformly chosen tail of each group
+    """
+    lo = adj['group_ptr'][groups]
+    n_tails = adj['group_ptr'][groups + 1] - lo
+    return adj['tail'][lo + np.floor(rng.random(len(groups)) * n_tails).astype(np.int64)]
+
+def _expand(adj, query, entity, predicate):
+    """
+    :param adj: KG.adjacency_arrays()
+    :param query: (m,) query index of each frontier entity
+    :param entity: (m,) frontier entity IDs
+    :param predicate: (m,) predicate to follow from each frontier entity
+    :return query, entity: deduplicated frontier after one hop
+    """
+    groups = _find_groups(adj, entity, predicate)
+    query, groups = query[groups >= 0], groups[groups >= 0]
+
+    lo = adj['group_ptr'][groups]
+    counts = adj['group_ptr'][groups + 1] - lo
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    query = np.repeat(query, counts)
+    entity = adj['tail'][np.repeat(lo, counts) + offsets]
+    return _dedupe(adj, query, entity)
+
+def _dedupe(adj, query, entity):
+    """
+    :return query, entity: unique pairs sorted by query index
+    """
+    n = len(adj['head_ptr']) - 1
+    key = np.unique(np.asarray(query, dtype=np.int64) * n + entity)
+    return key // n, key % n
+
+def _walk(adj, topics, chain_lens, rng):
+    """
+    :param adj: KG.adjacency_arrays()
+    :param topics: (m,) topic entity IDs
+    :param chain_lens: (m,) max number of hops per query
+    :param rng: np.random.Generator
+    :return chains: (m, max(chain_lens)) predicate IDs, -1 after the chain ends
+    """
+    m = len(topics)
+    chains = np.full((m, int(chain_lens.max()) if m else 0), -1, dtype=np.int64)
+    entity, alive = topics.copy(), np.ones(m, dtype=bool)
+
+    for hop in range(chains.shape[1]):
+        walking = np.flatnonzero(alive & (chain_lens > hop))
+        groups = _random_groups(adj, entity[walking], rng)
+
+        # Walks stop at entities with no outgoing edges
+        alive[walking[groups < 0]] = False
+        walking, groups = walking[groups >= 0], groups[groups >= 0]
+
+        chains[walking, hop] = adj['group_rel'][groups]
+        entity[walking] = _random_tails(adj, groups, rng)
+    return chains
+
+def _constrain(adj, chains, hop, query, entity, rng, n_tries=3):
+    """
+    :param adj: KG.adjacency_arrays()
+    :param chains: (m, max_len) predicate IDs of each query
+    :param hop: index in the chain to constrain
+    :param query, entity: candidate answers at this hop
+    :param rng: np.random.Generator
+    :param n_tries: draws per query to find a predicate outside the chain
+    :return constraints: dict of {query index: (entity, predicate, argument)}
+    :return query, entity: candidates that satisfy their query's constraint
+    """
+    # Choose one candidate per query uniformly
+    starts = np.flatnonzero(np.concatenate(([True], query[1:] != query[:-1]))) \
+            if len(query) else np.zeros(0, dtype=np.int64)
+    counts = np.diff(np.append(starts, len(query)))
+    picks = starts + np.floor(rng.random(len(starts)) * counts).astype(np.int64)
+    constrained, subject = query[picks], entity[picks]
+
+    # Choose a predicate of the candidate that is not in the inferential chain
+    groups = np.full(len(subject), -1, dtype=np.int64)
+    for _ in range(n_tries):
+        retry = np.flatnonzero(groups < 0)
+        draws = _random_groups(adj, subject[retry], rng)
+        valid = draws >= 0
+        valid[valid] = ~(chains[constrained[retry[valid]]] == \
+                adj['group_rel'][draws[valid]][:, None]).any(axis=1)
+        groups[retry[valid]] = draws[valid]
+
+    keep = groups >= 0
+    constrained, subject, groups = constrained[keep], subject[keep], groups[keep]
+    predicate = adj['group_rel'][groups]
+    argument = _random_tails(adj, groups, rng)
+
+    # Filter candidates of constrained queries by (entity, predicate, argument)
+    slot = np.full(len(chains), -1, dtype=np.int64)
+    slot[constrained] = np.arange(len(constrained))
+    checked = slot[query] >= 0
+    satisfied = np.ones(len(query), dtype=bool)
+    satisfied[checked] = _has_triples(adj, entity[checked],
+            predicate[slot[query[checked]]], argument[slot[query[checked]]])
+
+    constraints = {
+        q: (s, p, a) for q, s, p, a in zip(
+            constrained.tolist(), subject.tolist(), predicate.tolist(), argument.tolist())
+    }
+    return constraints, query[satisfied], entity[satisfied]
+
+def _generate_chunk(task):
+    """
+    :param task: (first query number, topic entity IDs, seed sequence, kwargs)
+    :return queries: list of queries following WebQSP query structure
+    """
+    start, topics, seed, kwargs = task
+    KG, entity_names = _KG, _ENTITY_NAMES
+    adj = KG.adjacency_arrays()
+    rng = np.random.default_rng(seed)
+
+    m = len(topics)
+    chain_lens = rng.integers(kwargs['min_chain_len'], kwargs['max_chain_len'] + 1, size=m)
+    chains = _walk(adj, topics, chain_lens, rng)
+    chain_lens = (chains >= 0).sum(axis=1)
+
+    constrain = (rng.random(m) < kwargs['constraint_prob']) & (chain_lens > 0)
+    constraint_index = np.where(constrain,
+            np.floor(rng.random(m) * chain_lens), -1).astype(np.int64)
+
+    # Follow every query's inferential chain at once
+    constraints = {}
+    query, entity = np.arange(m), topics.copy()
+    for hop in range(chains.shape[1]):
+        moving = chains[query, hop] >= 0
+        query_m, entity_m = _expand(adj, query[moving], entity[moving],
+                chains[query[moving], hop])
+        query = np.concatenate((query[~moving], query_m))
+        entity = np.concatenate((entity[~moving], entity_m))
+        query, entity = _dedupe(adj, query, entity)
+
+        at_hop = constraint_index[query] == hop
+        if at_hop.any():
+            found, query_c, entity_c = _constrain(
+                    adj, chains, hop, query[at_hop], entity[at_hop], rng)
+            constraints.update({q: (hop,) + c for q, c in found.items()})
+            query = np.concatenate((query[~at_hop], query_c))
+            entity = np.concatenate((entity[~at_hop], entity_c))
+            query, entity = _dedupe(adj, query, entity)
+
+    answers = np.split(entity, np.searchsorted(query, np.arange(1, m)))
+
+    queries = []
+    for i in range(m):
+        topic_mid = KG.id_entity(int(topics[i]))
+        constraint_list = []
+        if i in constraints:
+            hop, subject, predicate, argument = constraints[i]
+            constraint_list.append({
+                'SourceNodeIndex': hop,
+                'NodePredicate': KG.id_relationship(predicate),
+                'Argument': KG.id_entity(argument),
+                'EntityName': get_name(KG.id_entity(subject), entity_names)
+            })
+
+        labels = [KG.id_entity(eid) for eid in answers[i].tolist() if eid != topics[i]]
+        queries.append({
+            'QuestionId': '{}{}'.format(kwargs['qid_prefix'], start + i),
+            'Parse': {
+                'TopicEntityMid': topic_mid,
+                'TopicEntityName': get_name(topic_mid, entity_names),
+                'InferentialChain': [
+                    KG.id_relationship(rid) for rid in chains[i, :chain_lens[i]].tolist()
+                ],
+                'Constraints': constraint_list,
+                'Answers': [ {
+                        'AnswerType': 'Entity' if KG.is_entity(answer) else 'Value',
+                        'AnswerArgument': answer,
+                        'EntityName': get_name(answer, entity_names)
+                    } for answer in labels
+                ]
+            }
+        })
+    return queries
+
+def generate_queries(KG, topic_mids, n_queries, packed_fname, min_chain_len=1,
+        max_chain_len=3, constraint_prob=0., entity_names={}, qid_prefix='Synth-',
+        chunk_size=10000, n_jobs=1, seed=None):
+    """
+    :param KG: KnowledgeGraph
+    :param topic_mids: topic entities to draw queries from, uniformly
+    :param n_queries: total number of queries to generate
+    :param packed_fname: packed query file that queries are appended to
+    :param min_chain_len, max_chain_len: range of inferential chain lengths
+    :param constraint_prob: prob. of adding a constraint at a random chain index
+    :param entity_names: mapping of {entity ID: label}
+    :param qid_prefix: prefix of generated query IDs
+    :param chunk_size: number of queries generated per task
+    :param n_jobs: number of worker processes
+    :param seed: int or None, seed of the per-chunk random generators
+    :return n_written: number of queries written
+
+    Each chunk draws from its own generator spawned from seed, so the
+    output only depends on seed and chunk_size, not on n_jobs. Chunks are
+    appended to packed_fname in order as soon as they are done.
+    """
+    topics = np.array([
+        KG.entity_id(mid) for mid in topic_mids if KG.has_entity(mid)
+    ], dtype=np.int64)
+    if len(topics) < len(topic_mids):
+        logging.warning('Skipping {} topic MIDs not in {}'.format(
+            len(topic_mids) - len(topics), KG.name()))
+    if not len(topics):
+        raise ValueError('No topic MIDs found in the KG')
+
+    kwargs = {
+        'min_chain_len': min_chain_len, 'max_chain_len': max_chain_len,
+        'constraint_prob': constraint_prob, 'qid_prefix': qid_prefix
+    }
+    starts = range(0, n_queries, chunk_size)
+    seeds = np.random.SeedSequence(seed).spawn(len(starts))
+    KG.adjacency_arrays() # build once before forking
+
+    def tasks():
+        for start, chunk_seed in zip(starts, seeds):
+            m = min(chunk_size, n_queries - start)
+            rng = np.random.default_rng(chunk_seed.spawn(1)[0])
+            yield start, topics[rng.integers(len(topics), size=m)], chunk_seed, kwargs
+
+    n_written = 0
+    if n_jobs == 1:
+        _init_worker(KG, entity_names)
+        chunks = map(_generate_chunk, tasks())
+    else:
+        pool = multiprocessing.get_context('fork').Pool(
+                n_jobs, initializer=_init_worker, initargs=(KG, entity_names))
+        chunks = pool.imap(_generate_chunk, tasks())
+
+    try:
+        for queries in chunks:
+            append_questions(queries, packed_fname)
+            n_written += len(queries)
+            logging.info('Wrote {}/{} queries'.format(n_written, n_queries))
+    finally:
+        if n_jobs != 1:
+            pool.close()
+            pool.join()
+    return n_written
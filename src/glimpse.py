@@ -2,11 +2,15 @@ import random
 
 import numpy as np
 
+from time import perf_counter
 from operator import itemgetter
 from collections import defaultdict
 
 from .base import KnowledgeGraph
-from .heap import Heap
+from .checkpoint import checkpoint_key
+from .export import HEADER, TRIPLE_BYTES, string_bytes
+from .heap import Heap, HeapStats
+from .instrument import stage
 
 
 class Summary(KnowledgeGraph):
@@ -17,10 +21,18 @@ class Summary(KnowledgeGraph):
         """
         super().__init__()
         self.parent_ = KG
+        self.heap_stats_ = None
 
     def parent(self):
         return self.parent_
 
+    def heap_stats(self):
+        """
+        :return stats: HeapStats of the greedy loop that built this
+            summary, if it was profiled, else None
+        """
+        return self.heap_stats_
+
     def marginal_value(self, triple):
         """
         :param triple: (e1, r, e2) triple
@@ -37,6 +49,15 @@ class Summary(KnowledgeGraph):
             total += self.parent().triple_value(triple)
         return total
 
+    def value(self):
+        """
+        :return value: total value of the summary's entities and triples
+            under the parent's current preferences
+        """
+        parent = self.parent()
+        return sum(parent.entity_value(entity) for entity in self.entities()) + \
+                sum(parent.triple_value(triple) for triple in self.triples())
+
     def fill(self, triples, k):
         """
         :param triples: triples to add to summary
@@ -48,6 +69,60 @@ class Summary(KnowledgeGraph):
             self.add_triple(triple)
 
 
+class BudgetSummary(Summary):
+    """Summary that tracks its size in the binary export format"""
+
+    def __init__(self, KG):
+        """
+        :param KG: KnowledgeGraph
+        """
+        super().__init__(KG)
+        self.number_of_bytes_ = HEADER.size
+
+    def number_of_bytes(self):
+        """
+        :return n_bytes: upper bound on the size of the summary's binary
+            export, see src/export.py, off by at most two separators
+        """
+        return self.number_of_bytes_
+
+    def marginal_cost(self, triple):
+        """
+        :param triple: (e1, r, e2) triple
+        :return cost: bytes that adding triple to S adds to its export,
+            counting the names of new entities and relationships
+        """
+        if self.has_triple(triple):
+            return 0
+
+        e1, r, e2 = triple
+        cost = TRIPLE_BYTES
+        for entity in {e1, e2}:
+            if not self.has_entity(entity):
+                cost += string_bytes(entity)
+        if not self.has_relationship(r):
+            cost += string_bytes(r)
+        return cost
+
+    def add_triple(self, triple):
+        """
+        :param triple: (e1, r, e2) triple
+        """
+        self.number_of_bytes_ += self.marginal_cost(triple)
+        super().add_triple(triple)
+
+    def fill(self, triples, budget):
+        """
+        :param triples: triples to add to summary
+        :param budget: limit in bytes
+        """
+        for triple in triples:
+            if self.number_of_bytes() >= budget:
+                return
+            if self.number_of_bytes() + self.marginal_cost(triple) <= budget:
+                self.add_triple(triple)
+
+
 class SummaryMethod(object):
     """Stores a summarization function and associated metadata."""
 
@@ -67,44 +142,185 @@ class SummaryMethod(object):
     def kwargs(self):
         return self.kwargs_
 
-    def __call__(self, KG, K, query_log):
+    def fn(self):
+        return self.fn_
+
+    def __call__(self, KG, K, query_log, **kwargs):
         """
         :param KG: KnowledgeGraph
         :param K: summary constraint
         :param query_log: query log
+        :param kwargs: optional keyword arguments for fn, overriding
+            the ones this method was created with
         :return results: results of function call
         """
-        return self.fn_(KG, K, query_log, **self.kwargs_)
+        return self.fn_(KG, K, query_log, **dict(self.kwargs_, **kwargs))
 
 
-def GLIMPSE(KG, K, query_log, epsilon=1e-3, power=1):
+def GLIMPSE(KG, K, query_log, epsilon=1e-3, power=1, profile=False, checkpoint=None,
+        budget=False):
     """
     :param KG: KnowledgeGraph to summarize
-    :param K: number of triples in summary
+    :param K: number of triples in summary, or bytes if budget is set
     :param query_log: user queries
     :param epsilon: float in (0, 1] or None, epsilon-from-optimal factor
     :param power: number of terms in Taylor expansion
-    :return S: Summary
+    :param profile: bool or HeapStats, count greedy loop events in
+        S.heap_stats()
+    :param checkpoint: optional Checkpointer to periodically save the
+        greedy loop with, and to resume it from if it was interrupted
+    :param budget: bool, limit the size of the summary's binary export
+        to K bytes instead of its number of triples, see budget_select
+    :return S: Summary, or BudgetSummary if budget is set
+
+    With a budget, selecting by value per byte alone can miss a few
+    valuable but long-named triples, so the summary is the better of a
+    selection by value per byte and one by value, as in CELF.
     """
-    # Estimate user preferences over KG
-    KG.model_user_pref(query_log, power=power)
+    summaries = []
+    for cost_scaled in ((True, False) if budget else (None,)):
+        state = None
+        if checkpoint is not None:
+            state = checkpoint.open(KG, checkpoint_key(KG, K, query_log, epsilon, power,
+                budget=budget and ('ratio' if cost_scaled else 'value')))
 
-    # Greedily select top-k triples for summary S
-    heap = Heap(KG)
-    S = Summary(KG)
+        # Estimate user preferences over KG
+        if state is not None:
+            KG.store_pref(state['x'])
+        elif not summaries:
+            KG.model_user_pref(query_log, power=power)
+        summaries.append(greedy_summary(KG, K, epsilon=epsilon, profile=profile,
+                checkpoint=checkpoint, state=state, budget=budget,
+                cost_scaled=cost_scaled))
+    return max(summaries, key=lambda S: S.value()) if budget else summaries[0]
+
+def greedy_summary(KG, K, epsilon=1e-3, profile=False, checkpoint=None, state=None,
+        budget=False, cost_scaled=None):
+    """
+    :param KG: KnowledgeGraph with user preferences already modeled
+    :param K: number of triples in summary, or bytes if budget is set
+    :param epsilon: float in (0, 1] or None, epsilon-from-optimal factor
+    :param profile: bool or HeapStats, count greedy loop events in
+        S.heap_stats()
+    :param checkpoint: optional opened Checkpointer to save the greedy loop with
+    :param state: optional checkpoint state to resume the greedy loop from
+    :param budget: bool, K is a byte budget of the binary export
+    :param cost_scaled: with a budget, whether to select triples by
+        marginal value per byte instead of by marginal value, or None
+        for the better of both selections, as GLIMPSE does
+    :return S: Summary, or BudgetSummary if budget is set
+    """
+    if budget and cost_scaled is None:
+        if checkpoint is not None:
+            raise ValueError('Checkpointed budget selections need an explicit cost_scaled')
+        return max((greedy_summary(KG, K, epsilon=epsilon, profile=profile, budget=True,
+            cost_scaled=cost_scaled) for cost_scaled in (True, False)),
+            key=lambda S: S.value())
+
+    stats = HeapStats() if profile is True else (profile or None)
+    S = BudgetSummary(KG) if budget else Summary(KG)
+    S.heap_stats_ = stats
+    with stage('heap'):
+        heap = Heap(KG, stats=stats, items=None if state is None else state['heap_items'],
+                cost=S.marginal_cost if budget and cost_scaled else None)
+
+    sample_size = None
+    if state is not None:
+        for triple in state['selected']:
+            S.add_triple(triple)
+        np.random.set_state(state['rng'])
+        sample_size = state['sample_size']
 
-    if len(heap) <= K:
+    select = budget_select if budget else greedy_select
+    with stage('greedy'):
+        select(heap, S, K, epsilon=epsilon, checkpoint=checkpoint, sample_size=sample_size)
+    with stage('fill'):
+        S.fill(KG.ordered_triples(), K)
+
+    if checkpoint is not None:
+        checkpoint.remove()
+    return S
+
+def greedy_select(heap, S, K, epsilon=1e-3, checkpoint=None, sample_size=None):
+    """
+    :param heap: Heap of candidate triples
+    :param S: Summary to add triples to
+    :param K: number of triples in summary
+    :param epsilon: float in (0, 1] or None, epsilon-from-optimal factor
+    :param checkpoint: optional opened Checkpointer to save the loop with
+    :param sample_size: sample size of a resumed loop, whose heap
+        marginals are already up to date
+    """
+    # Greedily select top-k triples for summary S
+    if len(heap) + S.number_of_triples() <= K:
         S.fill(heap.triples(), K)
     else:
-        heap.update(S, len(heap)) # update all marginals
-        sample_size = len(heap) if epsilon is None else \
-                int(len(heap) / K * np.log(1 / epsilon))
+        if sample_size is None:
+            heap.update(S, len(heap)) # update all marginals
+            sample_size = len(heap) if epsilon is None else \
+                    int(len(heap) / K * np.log(1 / epsilon))
+
+        stats = heap.stats()
+        if stats is not None:
+            stats.sample_size_ = sample_size
+            stats.heap_sizes_.append((0, len(heap)))
 
         while len(heap) and S.number_of_triples() < K:
+            if checkpoint is not None and checkpoint.due():
+                checkpoint.save(heap, sample_size)
+
+            t0 = perf_counter() if stats is not None else None
             triple = heap.pop()
             S.add_triple(triple)
+            if checkpoint is not None:
+                checkpoint.add(triple)
             heap.update(S, sample_size)
+            if stats is not None:
+                stats.record_pop(perf_counter() - t0, len(heap))
 
-    S.fill(KG.triples(), K)
-    return S
+def budget_select(heap, S, budget, epsilon=1e-3, checkpoint=None, sample_size=None):
+    """
+    :param heap: Heap of candidate triples
+    :param S: BudgetSummary to add triples to
+    :param budget: size limit of the summary's binary export in bytes
+    :param epsilon: float in (0, 1] or None, epsilon-from-optimal factor
+    :param checkpoint: optional opened Checkpointer to save the loop with
+    :param sample_size: sample size of a resumed loop, whose heap
+        marginals are already up to date
 
+    Knapsack variant of greedy_select: triples are taken in heap order,
+    i.e. by marginal value per byte if the heap has S.marginal_cost as
+    its cost, and triples that no longer fit in the remaining budget
+    are dropped.
+    """
+    if sample_size is None:
+        heap.update(S, len(heap)) # update all marginals
+
+        # The number of triples the budget fits, at their current cost
+        triples = heap.triples()
+        mean_cost = np.mean([S.marginal_cost(triple) for triple in triples]) \
+                if triples else TRIPLE_BYTES
+        K = max(1., (budget - S.number_of_bytes()) / mean_cost)
+        sample_size = len(heap) if epsilon is None else \
+                int(len(heap) / K * np.log(1 / epsilon))
+
+    stats = heap.stats()
+    if stats is not None:
+        stats.sample_size_ = sample_size
+        stats.heap_sizes_.append((0, len(heap)))
+
+    while len(heap) and S.number_of_bytes() + TRIPLE_BYTES <= budget:
+        if checkpoint is not None and checkpoint.due():
+            checkpoint.save(heap, sample_size)
+
+        t0 = perf_counter() if stats is not None else None
+        triple = heap.pop()
+        # Dropping a triple leaves S, and so the marginals, unchanged, but
+        # the next top still has to be selected among the rest
+        if S.number_of_bytes() + S.marginal_cost(triple) <= budget:
+            S.add_triple(triple)
+            if checkpoint is not None:
+                checkpoint.add(triple)
+        heap.update(S, sample_size)
+        if stats is not None:
+            stats.record_pop(perf_counter() - t0, len(heap))
@@ -2,6 +2,62 @@ import heapq
 
 import numpy as np
 
+from .dtypes import value_dtype
+
+
+class HeapStats(object):
+    """Counters of the "lazy lazy greedy" loop, for tuning epsilon"""
+
+    def __init__(self, sample_every=100, on_sample=None):
+        """
+        :param sample_every: record the heap size every this many pops
+        :param on_sample: optional function called as on_sample(stats)
+            every sample_every pops
+        """
+        self.sample_every_ = sample_every
+        self.on_sample_ = on_sample
+
+        self.sample_size_ = None
+        self.pops_ = 0
+        self.updates_ = 0
+        self.lazy_hits_ = 0
+        self.marginal_evaluations_ = 0
+        self.pop_seconds_ = []
+        self.heap_sizes_ = [] # (pops, heap size)
+
+    def record_pop(self, seconds, heap_size):
+        """
+        :param seconds: time to pop a triple, add it and update the heap
+        :param heap_size: number of triples left in the heap
+        """
+        self.pops_ += 1
+        self.pop_seconds_.append(seconds)
+        if self.pops_ % self.sample_every_ == 0:
+            self.heap_sizes_.append((self.pops_, heap_size))
+            if self.on_sample_ is not None:
+                self.on_sample_(self)
+
+    def summary(self):
+        """
+        :return summary: dict of derived statistics
+        """
+        pop_seconds = np.array(self.pop_seconds_)
+        return {
+            'sample_size': self.sample_size_,
+            'pops': self.pops_,
+            'updates': self.updates_,
+            'lazy_hit_rate': self.lazy_hits_ / self.updates_ if self.updates_ else None,
+            'marginal_evaluations': self.marginal_evaluations_,
+            'marginal_evaluations_per_pop':
+                self.marginal_evaluations_ / self.pops_ if self.pops_ else None,
+            'sample_size_per_heap_size':
+                self.sample_size_ / self.heap_sizes_[0][1]
+                if self.sample_size_ and self.heap_sizes_ and self.heap_sizes_[0][1] else None,
+            'pop_seconds_mean': float(pop_seconds.mean()) if len(pop_seconds) else None,
+            'pop_seconds_p99': float(np.percentile(pop_seconds, 99)) if len(pop_seconds) else None,
+            'heap_sizes': self.heap_sizes_
+        }
+
 
 class Heap(object):
 
@@ -32,20 +88,30 @@ class Heap(object):
             """Make Triples sortable"""
             return self._marginal_value() > other._marginal_value()
 
-    def __init__(self, KG):
+    def __init__(self, KG, stats=None, items=None, cost=None):
         """
         :param KG: KnowledgeGraph
+        :param stats: optional HeapStats to count greedy loop events in
+        :param items: optional (triple, value) pairs in heap order, e.g.
+            from items() of a checkpointed heap, instead of the KG's triples
+        :param cost: optional function cost(triple) > 0 of adding a triple
+            to the summary, e.g. BudgetSummary.marginal_cost; triples are
+            then ordered by marginal value per unit of cost
         """
         self.heap_ = []
+        self.stats_ = stats
+        self.cost_ = cost
+        self.value_type_ = value_dtype()
 
-        for triple in KG.triples():
-            e1, r, e2 = triple
-            total = KG.entity_value(e1) + \
-                    KG.entity_value(e2) + \
-                    KG.triple_value(triple)
+        if items is not None:
+            self.heap_ = [Heap.Triple(triple, value) for triple, value in items]
+            return
 
+        for triple, total in KG.valued_triples():
             if total > 0:
-                self.heap_.append(Heap.Triple(triple, total))
+                if cost is not None:
+                    total /= cost(triple)
+                self.heap_.append(Heap.Triple(triple, self.value_type_(total)))
 
     def __len__(self):
         return len(self.heap_)
@@ -53,6 +119,15 @@ class Heap(object):
     def triples(self):
         return [triple.triple() for triple in self.heap_]
 
+    def items(self):
+        """
+        :return items: (triple, marginal value) pairs in heap order
+        """
+        return [(triple.triple(), triple._marginal_value()) for triple in self.heap_]
+
+    def stats(self):
+        return self.stats_
+
     def pop(self):
         if not len(self.heap_):
             raise ValueError('Cannot pop from an empty heap')
@@ -63,7 +138,12 @@ class Heap(object):
         :param S: Summary
         :param item: Triple
         """
-        item.value_ = S.marginal_value(item.triple())
+        value = S.marginal_value(item.triple())
+        if self.cost_ is not None:
+            value /= self.cost_(item.triple())
+        item.value_ = self.value_type_(value)
+        if self.stats_ is not None:
+            self.stats_.marginal_evaluations_ += 1
 
     def _lazy_greedy(self, S, triples):
         """
@@ -106,6 +186,9 @@ class Heap(object):
         indices = np.random.randint(0, n, size=sample_size) if sample_size < n else np.arange(n)
         triples = self._triples_at_index(indices)
         before, after = self._lazy_greedy(S, triples)
+        if self.stats_ is not None:
+            self.stats_.updates_ += 1
+            self.stats_.lazy_hits_ += before == after
         if before == after:
             self._move_to_top(after.index_)
             return
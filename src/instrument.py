@@ -0,0 +1,280 @@
+"""Per-stage timing and memory instrumentation.
+
+Pipeline stages are wrapped in `with stage('name'):` blocks. Nothing is
+measured until a Recorder is enabled; while disabled, stage() returns a
+shared no-op context manager, so the hooks can stay in hot code paths.
+
+    recorder = Recorder(open('metrics.jsonl', 'w'))
+    enable(recorder)
+    with labels(user=0, method='GLIMPSE'):
+        with stage('greedy'):
+            ...
+    disable()
+    recorder.close()
+
+Each stage produces a record of wall and CPU seconds, the process' peak
+RSS, and optionally tracemalloc deltas, tagged with the enclosing labels.
+Records are written as json lines as they complete, or aggregated per
+(stage, labels) and written in Prometheus text format on close().
+
+Labels are per thread, so stages can be recorded from background
+threads. CPU time, RSS and tracemalloc peaks are per process, so those
+of a stage include work other threads do at the same time.
+"""
+
+import sys
+import json
+import time
+import threading
+import tracemalloc
+
+from collections import OrderedDict
+
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+_RECORDER = None
+
+# Per-thread labels and stack of traced stages
+_LOCAL = threading.local()
+
+
+def _labels():
+    return getattr(_LOCAL, 'labels', {})
+
+def _stack():
+    if not hasattr(_LOCAL, 'stack'):
+        _LOCAL.stack = []
+    return _LOCAL.stack
+
+
+class _NullContext(object):
+    """Stands in for stage() and labels() while instrumentation is disabled"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL = _NullContext()
+
+
+def peak_rss():
+    """
+    :return peak_rss: peak resident set size of this process in bytes, or None
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class Recorder(object):
+
+    FORMATS = ('jsonl', 'prometheus')
+
+    def __init__(self, out=None, fmt='jsonl', trace_memory=False):
+        """
+        :param out: writable text file, or None to only keep records in memory
+        :param fmt: 'jsonl' or 'prometheus'
+        :param trace_memory: also record tracemalloc deltas, which slows
+            down allocation-heavy code
+        """
+        if fmt not in Recorder.FORMATS:
+            raise ValueError('Unknown metrics format: {}'.format(fmt))
+
+        self.out_, self.fmt_ = out, fmt
+        self.trace_memory_ = trace_memory
+        self.records_ = []
+        self.capture_ = None
+
+    def start(self):
+        if self.trace_memory_ and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def records(self):
+        return self.records_
+
+    def add(self, record):
+        """
+        :param record: dict of measurements of one stage
+        """
+        if self.capture_ is not None:
+            self.capture_.append(record)
+            return
+
+        self.records_.append(record)
+        if self.out_ is not None and self.fmt_ == 'jsonl':
+            self.out_.write(json.dumps(record) + '\n')
+            self.out_.flush()
+
+    def capture(self):
+        """
+        :return capture: context manager collecting records into a list
+            instead of writing them, e.g. to send them from a worker
+            process back to the parent, which add()s them
+        """
+        return _Capture(self)
+
+    def prometheus(self):
+        """
+        :return text: records aggregated per (stage, labels) in Prometheus text format
+        """
+        totals = OrderedDict()
+        for record in self.records_:
+            labels = tuple(sorted(
+                (k, v) for k, v in record.items() if k not in Stage.MEASUREMENTS))
+            total = totals.setdefault(labels, {'calls': 0})
+            total['calls'] += 1
+            for k in ('seconds', 'cpu_seconds'):
+                total[k] = total.get(k, 0.) + record[k]
+            for k in ('peak_rss_bytes', 'tracemalloc_peak_bytes'):
+                if record.get(k) is not None:
+                    total[k] = max(total.get(k, 0), record[k])
+
+        metrics = [
+            ('calls', 'counter', 'Number of times the stage ran'),
+            ('seconds', 'counter', 'Wall-clock seconds spent in the stage'),
+            ('cpu_seconds', 'counter', 'CPU seconds spent in the stage'),
+            ('peak_rss_bytes', 'gauge', 'Peak RSS of the process after the stage'),
+            ('tracemalloc_peak_bytes', 'gauge', 'Peak traced memory during the stage'),
+        ]
+        lines = []
+        for name, kind, help_text in metrics:
+            metric = 'glimpse_stage_{}{}'.format(name, '_total' if kind == 'counter' else '')
+            lines.append('# HELP {} {}'.format(metric, help_text))
+            lines.append('# TYPE {} {}'.format(metric, kind))
+            for labels, total in totals.items():
+                if name in total:
+                    lines.append('{}{{{}}} {}'.format(metric, ','.join(
+                        '{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in labels),
+                        total[name]))
+        return '\n'.join(lines) + '\n'
+
+    def close(self):
+        if self.out_ is not None and self.fmt_ == 'prometheus':
+            self.out_.write(self.prometheus())
+        if self.out_ is not None and self.out_ not in (sys.stdout, sys.stderr):
+            self.out_.close()
+
+
+class _Capture(list):
+    """Records added to a Recorder while inside it, see Recorder.capture()"""
+
+    def __init__(self, recorder):
+        super().__init__()
+        self.recorder_ = recorder
+
+    def __enter__(self):
+        self.recorder_.capture_ = self
+        return self
+
+    def __exit__(self, *exc):
+        self.recorder_.capture_ = None
+        return False
+
+    def __reduce__(self):
+        return list, (list(self),)
+
+
+class Stage(object):
+    """Measures one run of a stage, see stage()"""
+
+    MEASUREMENTS = ('seconds', 'cpu_seconds', 'peak_rss_bytes', 'rss_growth_bytes',
+                    'tracemalloc_delta_bytes', 'tracemalloc_peak_bytes')
+
+    def __init__(self, recorder, name, labels):
+        self.recorder_, self.name_, self.labels_ = recorder, name, labels
+
+    def __enter__(self):
+        self.trace_ = self.recorder_.trace_memory_ and tracemalloc.is_tracing()
+        if self.trace_:
+            # Enclosing traced stages. tracemalloc has a single peak counter,
+            # which each stage resets, so a stage remembers the highest
+            # peak its nested stages reset away.
+            self.memory_, peak = tracemalloc.get_traced_memory()
+            stack = _stack()
+            if stack:
+                stack[-1].floor_ = max(stack[-1].floor_, peak)
+            self.floor_ = 0
+            tracemalloc.reset_peak()
+            stack.append(self)
+
+        self.rss_ = peak_rss()
+        self.cpu_ = time.process_time()
+        self.wall_ = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.wall_
+        cpu = time.process_time() - self.cpu_
+        rss = peak_rss()
+
+        record = dict(self.labels_, stage=self.name_, seconds=wall, cpu_seconds=cpu,
+                peak_rss_bytes=rss,
+                rss_growth_bytes=None if rss is None else rss - self.rss_)
+
+        if self.trace_:
+            memory, peak = tracemalloc.get_traced_memory()
+            _stack().pop()
+            record['tracemalloc_delta_bytes'] = memory - self.memory_
+            record['tracemalloc_peak_bytes'] = max(peak, self.floor_) - self.memory_
+
+        self.recorder_.add(record)
+        return False
+
+
+class _Labels(object):
+    """Adds labels to every stage recorded inside it, see labels()"""
+
+    def __init__(self, labels):
+        self.labels_ = labels
+
+    def __enter__(self):
+        self.outer_ = _labels()
+        _LOCAL.labels = dict(self.outer_, **self.labels_)
+        return self
+
+    def __exit__(self, *exc):
+        _LOCAL.labels = self.outer_
+        return False
+
+
+def enable(recorder):
+    """
+    :param recorder: Recorder that stages are recorded to
+    """
+    global _RECORDER
+    _RECORDER = recorder
+    recorder.start()
+
+def disable():
+    global _RECORDER
+    _RECORDER = None
+
+def recorder():
+    """
+    :return recorder: enabled Recorder, or None
+    """
+    return _RECORDER
+
+def stage(name):
+    """
+    :param name: name of the pipeline stage
+    :return context: context manager measuring the stage if enabled
+    """
+    if _RECORDER is None:
+        return _NULL
+    return Stage(_RECORDER, name, _labels())
+
+def labels(**kwargs):
+    """
+    :param kwargs: labels such as user=0, method='GLIMPSE'
+    :return context: context manager adding labels to stages inside it
+    """
+    if _RECORDER is None:
+        return _NULL
+    return _Labels(kwargs)
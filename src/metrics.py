@@ -1,5 +1,11 @@
+import time
+import multiprocessing
+
 import numpy as np
 
+from collections import defaultdict
+from scipy.stats import norm
+
 from .query import answer_query
 
 
@@ -65,3 +71,268 @@ def average_query_log_metrics(S, query_log):
         prec.append(P)
         rec.append(R)
     return np.mean(f1), np.mean(prec), np.mean(rec)
+
+# Inherited by forked worker processes, see query_log_metrics
+_SUMMARIES = None
+
+
+def _query_counts(query):
+    """
+    :param query: query in WebQSP format
+    :return total: (n_summaries, 3) tp, fp, fn against answers on the full KG
+    :return average: (n_summaries, 3) F1, precision, recall against the query's answers
+
+    Answers the query once on the full KG and once on each summary.
+    """
+    kg_matches = answer_query(_SUMMARIES[0].parent(), query)
+    query_matches = {
+        answer['AnswerArgument'] for answer in query['Parse']['Answers']
+    }
+
+    total, average = [], []
+    for S in _SUMMARIES:
+        summary_matches = answer_query(S, query)
+        total.append((
+            len(summary_matches.intersection(kg_matches)),
+            len(summary_matches.difference(kg_matches)),
+            len(kg_matches.difference(summary_matches))))
+
+        tp = len(summary_matches.intersection(query_matches))
+        fp = len(summary_matches.difference(query_matches))
+        fn = len(query_matches.difference(summary_matches))
+        average.append((f1_score(tp, fp, fn), precision(tp, fp, fn), recall(tp, fp, fn)))
+    return total, average
+
+def _answer_queries(queries, pool=None, n_jobs=1):
+    """
+    :param queries: list of queries
+    :param pool: optional pool of n_jobs processes forked after
+        _SUMMARIES was set
+    :return counts: list of _query_counts of each query
+    """
+    if pool is None:
+        return list(map(_query_counts, queries))
+    return pool.map(_query_counts, queries, chunksize=max(1, len(queries) // (4 * n_jobs)))
+
+def query_log_metrics(summaries, query_log, n_jobs=1):
+    """
+    :param summaries: list of Summary of the same KG
+    :param query_log: list of queries
+    :param n_jobs: number of worker processes to answer queries with
+    :return metrics: list of dict, one per summary, of
+        'total': (F1, precision, recall) as in total_query_log_metrics
+        'average': (F1, precision, recall) as in average_query_log_metrics
+
+    Each query is answered once on the full KG and once per summary,
+    and both kinds of metrics are derived from the same answer sets.
+    """
+    global _SUMMARIES
+    _SUMMARIES = summaries
+
+    if n_jobs == 1:
+        counts = _answer_queries(query_log)
+    else:
+        with multiprocessing.get_context('fork').Pool(n_jobs) as pool:
+            counts = _answer_queries(query_log, pool, n_jobs)
+    _SUMMARIES = None
+
+    metrics = []
+    for i in range(len(summaries)):
+        tp, fp, fn = np.sum([total[i] for total, _ in counts], axis=0) \
+                if counts else (0, 0, 0)
+        f1, prec, rec = np.mean([average[i] for _, average in counts], axis=0) \
+                if counts else (np.nan, np.nan, np.nan)
+        metrics.append({
+            'total': (f1_score(tp, fp, fn), precision(tp, fp, fn), recall(tp, fp, fn)),
+            'average': (f1, prec, rec)
+        })
+    return metrics
+
+def stratify(query_log, min_stratum_size=10):
+    """
+    :param query_log: list of queries
+    :param min_stratum_size: queries of topic entities with fewer
+        queries are pooled into one stratum
+    :return strata: list of lists of query indices, one per topic entity
+    """
+    by_topic = defaultdict(list)
+    for i, query in enumerate(query_log):
+        by_topic[query['Parse']['TopicEntityMid']].append(i)
+
+    strata, pooled = [], []
+    for indices in by_topic.values():
+        if len(indices) >= min_stratum_size:
+            strata.append(indices)
+        else:
+            pooled += indices
+    if pooled:
+        strata.append(sorted(pooled))
+    return strata
+
+# Pseudo-queries of prior variance added to the sampled queries' variances
+PRIOR_QUERIES = 5
+
+
+def _stratum_variances(samples, prior):
+    """
+    :param samples: list of np.array (n_h, n_variables), one per stratum
+    :param prior: np.array (n_variables,) of a variance no sample could
+        plausibly exceed
+    :return variances: np.array (n_strata, n_variables) of the variance
+        of each stratum, shrunk towards the variance of all samples,
+        itself shrunk towards the prior
+
+    The few queries of a stratum, or of the whole log early on, often
+    all have the same metrics, e.g. F1 of 0, which alone would make the
+    estimates look certain.
+    """
+    pooled = np.concatenate(samples)
+    pooled_var = (np.sum((pooled - np.mean(pooled, axis=0)) ** 2, axis=0) +
+            PRIOR_QUERIES * prior) / (len(pooled) - 1 + PRIOR_QUERIES)
+
+    variances = []
+    for y in samples:
+        dof = len(y) - 1
+        s2 = np.var(y, axis=0, ddof=1) if dof > 0 else 0.
+        variances.append((dof * s2 + PRIOR_QUERIES * pooled_var) / (dof + PRIOR_QUERIES))
+    return np.array(variances)
+
+def _stratified_mean(samples, sizes, prior):
+    """
+    :param samples: list of np.array (n_h, n_variables), one per stratum
+    :param sizes: np.array of the number of queries N_h of each stratum
+    :param prior: see _stratum_variances
+    :return mean, variance: np.array (n_variables,) of the stratified
+        estimates of the mean over all queries, and their variances
+    """
+    weights = sizes / np.sum(sizes)
+    mean, variance = 0., 0.
+    for w, N, y, s2 in zip(weights, sizes, samples, _stratum_variances(samples, prior)):
+        n = len(y)
+        mean = mean + w * np.mean(y, axis=0)
+        variance = variance + w ** 2 * (1 - n / N) * s2 / n
+    return mean, variance
+
+def _stratified_ratio(y, x, sizes):
+    """
+    :param y, x: lists of np.array (n_h, n_variables), one per stratum,
+        with 0 <= y <= x
+    :param sizes: np.array of the number of queries N_h of each stratum
+    :return ratio, variance: np.array (n_variables,) of the estimates of
+        sum(y) / sum(x) over all queries, and their linearized variances
+    """
+    x_mean, _ = _stratified_mean(x, sizes, 0.)
+    y_mean, _ = _stratified_mean(y, sizes, 0.)
+    ratio = np.divide(y_mean, x_mean, out=np.zeros_like(y_mean), where=x_mean > 0)
+
+    # Ratios of a query are in [0, 1], so its residual is at most x / 2 away
+    prior = np.mean(np.concatenate(x) ** 2, axis=0) / 4
+    _, residual_var = _stratified_mean([y_h - ratio * x_h for y_h, x_h in zip(y, x)],
+            sizes, prior)
+    variance = np.divide(residual_var, x_mean ** 2,
+            out=np.zeros_like(residual_var), where=x_mean > 0)
+    return ratio, variance
+
+def sampled_query_log_metrics(summaries, query_log, width=0.05, confidence=0.95,
+        time_budget=None, batch_size=100, min_stratum_size=10, rng=None, n_jobs=1):
+    """
+    :param summaries: list of Summary of the same KG
+    :param query_log: list of queries
+    :param width: stop once every confidence interval is at most this wide
+    :param confidence: confidence level of the intervals
+    :param time_budget: optional seconds after which to stop sampling
+    :param batch_size: number of queries sampled between checks
+    :param min_stratum_size: see stratify
+    :param rng: np.random.RandomState, or None for the np.random module
+    :param n_jobs: number of worker processes to answer queries with
+    :return metrics: list of dict, one per summary, of
+        'total': (F1, precision, recall) estimates of total_query_log_metrics
+        'average': (F1, precision, recall) estimates of average_query_log_metrics
+        'total_ci', 'average_ci': ((low, high), ...) confidence intervals
+            of each estimate
+        'n_evaluated': number of queries answered
+        'n_queries': number of queries of the log
+
+    Queries are stratified by topic entity and sampled without
+    replacement, first two per stratum, then one batch at a
+    time into the strata where they most reduce the estimates' variance
+    (Neyman allocation), until every interval is narrow enough, the time
+    budget runs out or all queries are answered, in which case the
+    estimates equal query_log_metrics exactly. Total metrics are ratio
+    estimates of the summed counts.
+    """
+    global _SUMMARIES
+    if not query_log:
+        return [dict(m, total_ci=tuple((e, e) for e in m['total']),
+            average_ci=tuple((e, e) for e in m['average']), n_evaluated=0, n_queries=0)
+            for m in query_log_metrics(summaries, query_log)]
+
+    rng = np.random if rng is None else rng
+    t0 = time.time()
+    z = norm.ppf(0.5 + confidence / 2)
+
+    strata = [[indices[i] for i in rng.permutation(len(indices))]
+            for indices in stratify(query_log, min_stratum_size)]
+    sizes = np.array([len(indices) for indices in strata], dtype=np.float64)
+    counts = [[] for _ in strata]
+    allocation = np.minimum(2, sizes).astype(np.int64)
+
+    _SUMMARIES = summaries
+    pool = multiprocessing.get_context('fork').Pool(n_jobs) if n_jobs > 1 else None
+    try:
+        while True:
+            # Answer the newly allocated queries of each stratum
+            new = [(h, i) for h, indices in enumerate(strata)
+                    for i in indices[len(counts[h]):allocation[h]]]
+            for (h, _), c in zip(new, _answer_queries(
+                    [query_log[i] for _, i in new], pool, n_jobs)):
+                counts[h].append(c)
+
+            # (n_h, n_summaries, 3) tp, fp, fn and F1, precision, recall
+            total = [np.array([t for t, _ in c], dtype=np.float64) for c in counts]
+            average = [np.array([a for _, a in c], dtype=np.float64) for c in counts]
+            tp, fp, fn = [[t[:, :, j] for t in total] for j in range(3)]
+            total_est, total_var = zip(*[_stratified_ratio(y, x, sizes) for y, x in (
+                ([2 * a for a in tp], [2 * a + b + c for a, b, c in zip(tp, fp, fn)]),
+                (tp, [a + b for a, b in zip(tp, fp)]),
+                (tp, [a + c for a, c in zip(tp, fn)]))])
+            average_est, average_var = _stratified_mean(
+                    [a.reshape(len(a), -1) for a in average], sizes, 0.25)
+            total_est, total_var = np.array(total_est).T, np.array(total_var).T
+            average_est = average_est.reshape(len(summaries), 3)
+            average_var = average_var.reshape(len(summaries), 3)
+
+            n_evaluated = int(np.sum(allocation))
+            done = n_evaluated == len(query_log) or 2 * z * np.sqrt(max(
+                np.max(total_var), np.max(average_var))) <= width or \
+                (time_budget is not None and time.time() - t0 >= time_budget)
+            if done:
+                break
+
+            # Spread the next batch by the largest reduction of variance,
+            # with the largest standard deviation of each stratum's metrics
+            sd = np.sqrt(np.max(_stratum_variances(
+                [a.reshape(len(a), -1) for a in average], 0.25), axis=1))
+            for _ in range(min(batch_size, len(query_log) - n_evaluated)):
+                n = allocation.astype(np.float64)
+                gain = np.where(n < sizes, (sizes * sd) ** 2 / (n * (n + 1)), -1.)
+                allocation[np.argmax(gain)] += 1
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        _SUMMARIES = None
+
+    def interval(estimate, variance):
+        half = z * np.sqrt(variance)
+        return tuple((float(max(0., e - h)), float(min(1., e + h)))
+                for e, h in zip(estimate, half))
+
+    return [{
+        'total': tuple(float(e) for e in total_est[i]),
+        'average': tuple(float(e) for e in average_est[i]),
+        'total_ci': interval(total_est[i], total_var[i]),
+        'average_ci': interval(average_est[i], average_var[i]),
+        'n_evaluated': n_evaluated,
+        'n_queries': len(query_log)
+    } for i in range(len(summaries))]
@@ -0,0 +1,211 @@
+"""Memory-mapped sorted index of names, such as Freebase MID labels.
+
+Name tables have a label for every entity of the KG, but queries are
+only ever generated with a handful of them. An index is built once from
+(key, value) pairs into a file
+
+    header, uint64 key offsets, uint64 value offsets, utf-8 keys, utf-8 values
+
+with the keys sorted, and is then memory-mapped, so that a lookup is a
+binary search over the file that reads O(log n) keys and one value, and
+opening it reads nothing but the header:
+
+    build_index(pairs, fname)               # once
+    names = StringIndex(fname)
+    names[mid], mid in names, names.get(mid, mid)
+
+Building sorts runs of pairs in memory and merges them from temporary
+files, so neither building nor lookups hold the whole table in memory.
+As with a dict, the last value of a repeated key is kept.
+"""
+
+import os
+import mmap
+import heapq
+import struct
+import tempfile
+import itertools
+
+MAGIC = b'GLSN'
+VERSION = 1
+HEADER = struct.Struct('<4sHxxQQQ')
+RECORD = struct.Struct('<II')
+OFFSET = struct.Struct('<Q')
+RANGE = struct.Struct('<QQ')
+
+
+def _write_run(pairs, dir_name):
+    """
+    :param pairs: list of (key, value) utf-8 bytes, sorted by key
+    :param dir_name: directory of the run file
+    :return fname: file of length-prefixed records
+    """
+    fd, fname = tempfile.mkstemp(suffix='.run', dir=dir_name)
+    with os.fdopen(fd, 'wb') as f:
+        for key, value in pairs:
+            f.write(RECORD.pack(len(key), len(value)))
+            f.write(key)
+            f.write(value)
+    return fname
+
+def _read_run(fname):
+    """
+    :param fname: file written by _write_run
+    :return pairs: generator of (key, value) utf-8 bytes
+    """
+    with open(fname, 'rb') as f:
+        while True:
+            record = f.read(RECORD.size)
+            if not record:
+                return
+            key_len, value_len = RECORD.unpack(record)
+            yield f.read(key_len), f.read(value_len)
+
+def build_index(pairs, fname, run_size=1 << 20):
+    """
+    :param pairs: iterable of (key, value) str
+    :param fname: file to write the index to
+    :param run_size: number of pairs sorted in memory at a time
+    :return n: number of distinct keys
+    """
+    dir_name = os.path.dirname(os.path.abspath(fname))
+    pairs = ((key.encode('utf-8'), value.encode('utf-8')) for key, value in pairs)
+    runs, parts = [], []
+    try:
+        # Sort runs of pairs; sorting is stable, and so is the merge
+        while True:
+            run = list(itertools.islice(pairs, run_size))
+            if not run:
+                break
+            run.sort(key=lambda pair: pair[0])
+            runs.append(_write_run(run, dir_name))
+            del run
+
+        # Stream the merged pairs into the four sections of the index
+        for _ in range(4):
+            fd, part = tempfile.mkstemp(suffix='.part', dir=dir_name)
+            parts.append((os.fdopen(fd, 'w+b'), part))
+        key_offsets, value_offsets, keys, values = [f for f, _ in parts]
+        key_offsets.write(OFFSET.pack(0))
+        value_offsets.write(OFFSET.pack(0))
+
+        n, key_bytes, value_bytes = 0, 0, 0
+        merged = heapq.merge(*[_read_run(run) for run in runs], key=lambda pair: pair[0])
+        for key, group in itertools.groupby(merged, key=lambda pair: pair[0]):
+            for _, value in group:
+                pass
+            keys.write(key)
+            values.write(value)
+            key_bytes += len(key)
+            value_bytes += len(value)
+            key_offsets.write(OFFSET.pack(key_bytes))
+            value_offsets.write(OFFSET.pack(value_bytes))
+            n += 1
+
+        tmp_fname = '{}.{}.tmp'.format(fname, os.getpid())
+        with open(tmp_fname, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, n, key_bytes, value_bytes))
+            for part, _ in parts:
+                part.seek(0)
+                while True:
+                    block = part.read(1 << 20)
+                    if not block:
+                        break
+                    f.write(block)
+        os.replace(tmp_fname, fname)
+        return n
+    finally:
+        for part, part_fname in parts:
+            part.close()
+            os.remove(part_fname)
+        for run in runs:
+            os.remove(run)
+
+
+class StringIndex(object):
+    """Read-only mapping of str keys to str values in a memory-mapped index"""
+
+    def __init__(self, fname):
+        """
+        :param fname: file written by build_index
+        """
+        self.fname_ = fname
+        self._open()
+
+    def _open(self):
+        with open(self.fname_, 'rb') as f:
+            self.buf_ = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n, key_bytes, value_bytes = HEADER.unpack_from(self.buf_)
+        if magic != MAGIC:
+            raise ValueError('Not a name index: {}'.format(self.fname_))
+        if version != VERSION:
+            raise ValueError('Unsupported name index version: {}'.format(version))
+
+        self.n_ = n
+        self.key_offsets_ = HEADER.size
+        self.value_offsets_ = self.key_offsets_ + OFFSET.size * (n + 1)
+        self.keys_start_ = self.value_offsets_ + OFFSET.size * (n + 1)
+        self.values_start_ = self.keys_start_ + key_bytes
+
+    def __getstate__(self):
+        # Processes reopen the file instead of pickling its contents
+        return {'fname_': self.fname_}
+
+    def __setstate__(self, state):
+        self.fname_ = state['fname_']
+        self._open()
+
+    def __len__(self):
+        return self.n_
+
+    def key(self, i):
+        """
+        :param i: rank of the key
+        :return key: utf-8 bytes of the i-th smallest key
+        """
+        start, end = RANGE.unpack_from(self.buf_, self.key_offsets_ + OFFSET.size * i)
+        return self.buf_[self.keys_start_ + start:self.keys_start_ + end]
+
+    def value(self, i):
+        """
+        :param i: rank of the key
+        :return value: str value of the i-th smallest key
+        """
+        start, end = RANGE.unpack_from(self.buf_, self.value_offsets_ + OFFSET.size * i)
+        return self.buf_[self.values_start_ + start:self.values_start_ + end].decode('utf-8')
+
+    def find(self, key):
+        """
+        :param key: str
+        :return i: rank of the key, or -1 if it is not in the index
+        """
+        key = key.encode('utf-8')
+        lo, hi = 0, self.n_
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < self.n_ and self.key(lo) == key else -1
+
+    def get(self, key, default=None):
+        """
+        :param key: str
+        :param default: value returned for missing keys
+        :return value: str value of the key, or default
+        """
+        i = self.find(key)
+        return self.value(i) if i >= 0 else default
+
+    def __getitem__(self, key):
+        i = self.find(key)
+        if i < 0:
+            raise KeyError(key)
+        return self.value(i)
+
+    def __contains__(self, key):
+        return self.find(key) >= 0
+
+    def close(self):
+        self.buf_.close()
@@ -0,0 +1,495 @@
+"""Out-of-core knowledge graphs, for KGs larger than memory.
+
+A DiskKnowledgeGraph keeps its triples on disk, in the layout of
+KnowledgeGraph.adjacency_arrays, as raw integer arrays sorted by
+(head, relationship, tail) ID:
+
+    head.bin, rel.bin, tail.bin     triple IDs
+    group_head.bin, group_rel.bin   (head, relationship) pairs
+    group_ptr.bin                   offsets of each pair's tails
+    head_ptr.bin                    offsets of each head's pairs
+    entities.idx                    sorted entity names, see src/names.py
+    meta.json                       sizes, ID type and relationship names
+
+Entities are numbered in name order, so an entity's ID is its rank in
+the name index. answer_query looks triples up through head_ptr and
+group_ptr, reading only the pages of the entities it visits, and random
+walks multiply the transition matrix by streaming the triples in blocks
+(see StreamedMatrix). Building and every pass over the triples work a
+block at a time, within the working set size, plus the dense per-entity
+vectors of random walks.
+
+That bounds the KG, not a whole run. GLIMPSE's candidate heap still
+holds every triple of positive value as a tuple of names, which is
+nearly every triple once random walks take a step, and the query
+generator of Synthetic sorts keys of all triples in memory. Peak memory
+of summarizing thus still grows with the number of triples, only with a
+smaller constant than an in-memory KG:
+
+    KG = DiskKnowledgeGraph('freebase-ooc/', source=Freebase(),
+            working_set_bytes=1 << 30)
+    KG.load()       # built from source.iter_triples() on first use
+
+The KG is read-only. Preferences are stored as the random walk vector
+only, and entity and triple values are derived from it on demand.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import itertools
+
+import numpy as np
+
+from .base import KnowledgeGraph
+from .dtypes import index_dtype, value_dtype
+from .names import StringIndex, build_index
+
+VERSION = 1
+WORKING_SET_BYTES = 1 << 28
+# Bytes per triple of a block, with its sort and product temporaries
+ROW_BYTES = 64
+# Bytes per triple of names while encoding, and per name of a sorted
+# run of the entity index, as Python objects
+TRIPLE_NAMES_BYTES = 512
+NAME_BYTES = 256
+ARRAYS = ('head', 'rel', 'tail', 'group_head', 'group_rel', 'group_ptr', 'head_ptr')
+
+
+def _fname(data_dir, name):
+    return os.path.join(data_dir, '{}.bin'.format(name))
+
+def read_block(fname, dtype, start, stop):
+    """
+    :param fname: raw array file
+    :param dtype: type of the array
+    :param start, stop: range of elements to read
+    :return block: np.array copy of the elements
+
+    Only the block is mapped, and unmapped once copied, so the pages
+    of a pass over an array do not stay resident.
+    """
+    if stop <= start:
+        return np.zeros(0, dtype=dtype)
+    block = np.memmap(fname, dtype=dtype, mode='r',
+            offset=start * np.dtype(dtype).itemsize, shape=(stop - start,))
+    return np.array(block)
+
+def _map(fname, dtype, n):
+    """
+    :return array: read-only np.memmap of the n elements of the file
+    """
+    if n == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(fname, dtype=dtype, mode='r', shape=(n,))
+
+def build(data_dir, triples, working_set_bytes=WORKING_SET_BYTES):
+    """
+    :param data_dir: directory to write the KG's files to
+    :param triples: function of no arguments returning an iterator of
+        (e1, r, e2) triples; it is called twice
+    :param working_set_bytes: memory to build the KG in
+    :return meta: dict written to meta.json
+
+    The first pass indexes the entity names. The second encodes the
+    triples and scatters them into files by range of head IDs, each
+    small enough to be sorted and deduplicated in memory, and the
+    buckets are then appended to the arrays in order.
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    dtype = np.dtype(index_dtype())
+
+    # Number entities in name order, so that IDs are index ranks
+    relationships, n_rows = set(), 0
+
+    def entity_names():
+        nonlocal n_rows
+        for e1, r, e2 in triples():
+            relationships.add(r)
+            n_rows += 1
+            yield e1, ''
+            yield e2, ''
+
+    n_entities = build_index(entity_names(), os.path.join(data_dir, 'entities.idx'),
+            run_size=max(1, working_set_bytes // NAME_BYTES))
+    relationships = sorted(relationships)
+    relationship_id = {r: rid for rid, r in enumerate(relationships)}
+    entities = StringIndex(os.path.join(data_dir, 'entities.idx'))
+
+    bucket_dir = tempfile.mkdtemp(prefix='buckets-', dir=data_dir)
+    try:
+        # Scatter encoded triples into buckets of consecutive heads
+        n_buckets = max(1, -(-n_rows * ROW_BYTES // working_set_bytes))
+        buckets = [open(os.path.join(bucket_dir, str(b)), 'wb') for b in range(n_buckets)]
+        try:
+            iterator = triples()
+            while True:
+                chunk = list(itertools.islice(iterator,
+                    max(1, working_set_bytes // TRIPLE_NAMES_BYTES)))
+                if not chunk:
+                    break
+                ids = {}
+                rows = np.array([(
+                    ids[e1] if e1 in ids else ids.setdefault(e1, entities.find(e1)),
+                    relationship_id[r],
+                    ids[e2] if e2 in ids else ids.setdefault(e2, entities.find(e2)))
+                    for e1, r, e2 in chunk], dtype=dtype)
+                bucket = rows[:, 0].astype(np.int64) * n_buckets // max(1, n_entities)
+                order = np.argsort(bucket, kind='stable')
+                bounds = np.searchsorted(bucket[order], np.arange(n_buckets + 1))
+                for b in range(n_buckets):
+                    rows[order[bounds[b]:bounds[b + 1]]].tofile(buckets[b])
+        finally:
+            for f in buckets:
+                f.close()
+
+        # Sort each bucket and append it to the arrays
+        files = {name: open(_fname(data_dir, name), 'wb') for name in ARRAYS}
+        try:
+            n_triples, n_groups = 0, 0
+            for b in range(n_buckets):
+                rows = np.fromfile(os.path.join(bucket_dir, str(b)), dtype=dtype).reshape(-1, 3)
+                os.remove(os.path.join(bucket_dir, str(b)))
+                rows = rows[np.lexsort(rows.T[::-1])]
+                if len(rows):
+                    rows = rows[np.concatenate(([True], np.any(rows[1:] != rows[:-1], axis=1)))]
+                head, rel, tail = rows[:, 0], rows[:, 1], rows[:, 2]
+
+                starts = np.flatnonzero(np.concatenate((
+                    [True], (head[1:] != head[:-1]) | (rel[1:] != rel[:-1])))) \
+                        if len(rows) else np.zeros(0, dtype=np.int64)
+                group_head = head[starts]
+
+                # Heads h of this bucket are those with h * n_buckets // n_entities == b
+                first = -(-b * n_entities // n_buckets)
+                last = -(-(b + 1) * n_entities // n_buckets)
+                head_ptr = n_groups + np.searchsorted(group_head, np.arange(first, last))
+
+                for name, array in (('head', head), ('rel', rel), ('tail', tail),
+                        ('group_head', group_head), ('group_rel', rel[starts]),
+                        ('group_ptr', (n_triples + starts).astype(np.int64)),
+                        ('head_ptr', head_ptr.astype(np.int64))):
+                    array.tofile(files[name])
+                n_triples += len(rows)
+                n_groups += len(starts)
+            np.array([n_triples], dtype=np.int64).tofile(files['group_ptr'])
+            np.array([n_groups], dtype=np.int64).tofile(files['head_ptr'])
+        finally:
+            for f in files.values():
+                f.close()
+    finally:
+        entities.close()
+        shutil.rmtree(bucket_dir, ignore_errors=True)
+
+    meta = {
+        'version': VERSION, 'dtype': dtype.str, 'n_entities': n_entities,
+        'n_triples': n_triples, 'n_groups': n_groups, 'relationships': relationships
+    }
+    tmp_fname = os.path.join(data_dir, 'meta.json.tmp')
+    with open(tmp_fname, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_fname, os.path.join(data_dir, 'meta.json'))
+    return meta
+
+
+class StreamedMatrix(object):
+    """Transition matrix of a DiskKnowledgeGraph, multiplied block by block"""
+
+    def __init__(self, KG):
+        """
+        :param KG: opened DiskKnowledgeGraph
+        """
+        self.KG_ = KG
+        n = KG.number_of_entities()
+        self.shape = (n, n)
+        self.dtype = np.dtype(value_dtype())
+        self.nnz = KG.number_of_triples()
+
+        degree = np.zeros(n, dtype=np.int64)
+        for head, in KG.blocks(('head',)):
+            degree += np.bincount(head, minlength=n)
+        self.degree_ = degree.astype(self.dtype)
+
+    def dot(self, x):
+        """
+        :param x: np.array (n_entities,) or (n_entities, k)
+        :return y: np.array shaped like x, M * x, as with the in-memory
+            transition matrix A^T D
+        """
+        x = np.asarray(x)
+        columns = x.reshape(len(x), -1)
+        y = np.zeros(columns.shape, dtype=np.float64)
+        for head, tail in self.KG_.blocks(('head', 'tail')):
+            weights = self.degree_[head, None] * columns[head]
+            for j in range(columns.shape[1]):
+                y[:, j] += np.bincount(tail, weights=weights[:, j], minlength=self.shape[0])
+        return y.reshape(x.shape).astype(np.result_type(self.dtype, x.dtype))
+
+    def __mul__(self, x):
+        return self.dot(x)
+
+    def __matmul__(self, x):
+        return self.dot(x)
+
+
+class DiskKnowledgeGraph(KnowledgeGraph):
+
+    def __init__(self, data_dir, source=None, working_set_bytes=WORKING_SET_BYTES):
+        """
+        :param data_dir: directory of the KG's files, see build
+        :param source: optional KnowledgeGraph with iter_triples() to build
+            the files from if they do not exist, and to take queries,
+            topics and entity names from
+        :param working_set_bytes: memory to build the KG in and to stream
+            its triples with
+        """
+        super().__init__()
+        self.data_dir_ = data_dir
+        self.source_ = source
+        self.working_set_bytes_ = working_set_bytes
+        self.name_ = 'Disk' if source is None else source.name()
+
+        self.meta_ = None
+        self.arrays_ = None
+        self.entity_index_ = None
+
+    def load(self, head=None):
+        """
+        :param head: optional number of triples of the source to read,
+            with repeats, when building
+        """
+        if not os.path.exists(os.path.join(self.data_dir_, 'meta.json')):
+            if self.source_ is None or not hasattr(self.source_, 'iter_triples'):
+                raise ValueError('No out-of-core KG in {} to load, and no source '
+                        'to build it from'.format(self.data_dir_))
+            build(self.data_dir_, lambda: itertools.islice(self.source_.iter_triples(), head),
+                    working_set_bytes=self.working_set_bytes_)
+        self.open()
+
+        # Sources that generate their queries from their triples, such as
+        # Synthetic, generate them over this KG instead
+        if hasattr(self.source_, 'load_queries'):
+            self.source_.load_queries(self)
+
+    def open(self):
+        with open(os.path.join(self.data_dir_, 'meta.json')) as f:
+            self.meta_ = json.load(f)
+        if self.meta_['version'] != VERSION:
+            raise ValueError('Unsupported out-of-core KG version: {}'.format(
+                self.meta_['version']))
+
+        dtype, n_groups = np.dtype(self.meta_['dtype']), self.meta_['n_groups']
+        sizes = {
+            'head': (dtype, self.meta_['n_triples']),
+            'rel': (dtype, self.meta_['n_triples']),
+            'tail': (dtype, self.meta_['n_triples']),
+            'group_head': (dtype, n_groups),
+            'group_rel': (dtype, n_groups),
+            'group_ptr': (np.int64, n_groups + 1),
+            'head_ptr': (np.int64, self.meta_['n_entities'] + 1)
+        }
+        self.arrays_ = {name: _map(_fname(self.data_dir_, name), *sizes[name])
+                for name in ARRAYS}
+        self.dtypes_ = {name: sizes[name][0] for name in ARRAYS}
+        self.entity_index_ = StringIndex(os.path.join(self.data_dir_, 'entities.idx'))
+
+        self.id_relationship_ = dict(enumerate(self.meta_['relationships']))
+        self.relationship_id_ = {r: rid for rid, r in self.id_relationship_.items()}
+        self.relationships_ = set(self.relationship_id_)
+        self.number_of_triples_ = self.meta_['n_triples']
+        self.eid_ = self.meta_['n_entities']
+        self.rid_ = len(self.relationship_id_)
+
+    def blocks(self, names):
+        """
+        :param names: names of triple arrays, e.g. ('head', 'tail')
+        :return blocks: generator of lists of np.array blocks of the
+            arrays, each of at most the working set size
+        """
+        block_rows = max(1, self.working_set_bytes_ // ROW_BYTES)
+        for start in range(0, self.number_of_triples(), block_rows):
+            stop = min(start + block_rows, self.number_of_triples())
+            yield [read_block(_fname(self.data_dir_, name), self.dtypes_[name], start, stop)
+                    for name in names]
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('DiskKnowledgeGraph is read-only, build it from a source '
+                'KnowledgeGraph with the triples and entity order it should have')
+
+    add_triple = reorder_entities = build_reverse_index = _read_only
+
+    def entities(self):
+        """
+        :return entities: generator of all entities, in ID order
+        """
+        return (self.id_entity(eid) for eid in range(self.number_of_entities()))
+
+    def triples(self):
+        """
+        :return triples: generator of all (e1, r, e2) triples, streamed
+            from disk in (head, relationship, tail) ID order
+        """
+        for head, rel, tail in self.blocks(('head', 'rel', 'tail')):
+            for eid1, rid, eid2 in zip(head.tolist(), rel.tolist(), tail.tolist()):
+                yield self.id_entity(eid1), self.id_relationship(rid), self.id_entity(eid2)
+
+    def ordered_triples(self):
+        return self.triples()
+
+    def number_of_entities(self):
+        return self.meta_['n_entities']
+
+    def has_entity(self, entity):
+        return self.entity_index_.find(entity) >= 0
+
+    def entity_id(self, entity):
+        eid = self.entity_index_.find(entity)
+        if eid < 0:
+            raise KeyError(entity)
+        return eid
+
+    def id_entity(self, eid):
+        return self.entity_index_.key(eid).decode('utf-8')
+
+    def _groups(self, eid):
+        """
+        :param eid: entity ID
+        :return start, stop: range of the entity's (head, relationship) groups
+        """
+        head_ptr = self.arrays_['head_ptr']
+        return int(head_ptr[eid]), int(head_ptr[eid + 1])
+
+    def _tails(self, group):
+        """
+        :param group: index of a (head, relationship) group
+        :return tails: np.array of the group's sorted tail IDs
+        """
+        group_ptr = self.arrays_['group_ptr']
+        return self.arrays_['tail'][int(group_ptr[group]):int(group_ptr[group + 1])]
+
+    def __contains__(self, entity):
+        eid = self.entity_index_.find(entity)
+        if eid < 0:
+            return False
+        start, stop = self._groups(eid)
+        return stop > start
+
+    def __getitem__(self, entity):
+        """
+        :param entity: str
+        :return d: dict of set of {relation : entities}, read from disk
+        """
+        if entity not in self:
+            raise KeyError(entity)
+        start, stop = self._groups(self.entity_id(entity))
+        rels = self.arrays_['group_rel'][start:stop].tolist()
+        return {self.id_relationship(rid): {self.id_entity(eid2)
+            for eid2 in self._tails(group).tolist()}
+            for group, rid in zip(range(start, stop), rels)}
+
+    def has_triple(self, triple):
+        e1, r, e2 = triple
+        eid1, eid2 = self.entity_index_.find(e1), self.entity_index_.find(e2)
+        if eid1 < 0 or eid2 < 0 or r not in self.relationship_id_:
+            return False
+        start, stop = self._groups(eid1)
+        rels = self.arrays_['group_rel'][start:stop]
+        group = start + int(np.searchsorted(rels, self.relationship_id_[r]))
+        if group == stop or self.arrays_['group_rel'][group] != self.relationship_id_[r]:
+            return False
+        tails = self._tails(group)
+        i = int(np.searchsorted(tails, eid2))
+        return i < len(tails) and tails[i] == eid2
+
+    def adjacency_arrays(self):
+        """
+        :return adjacency: dict of read-only memory-mapped arrays, see
+            KnowledgeGraph.adjacency_arrays
+        """
+        return self.arrays_
+
+    def fingerprint(self):
+        """
+        :return fingerprint: hex digest identifying the KG's triples, the
+            same as an in-memory KG's with the same triples and IDs
+        """
+        if self.fingerprint_ is None:
+            h = hashlib.sha256()
+            for name in ('head', 'rel', 'tail'):
+                for block, in self.blocks((name,)):
+                    h.update(block.astype('<i8').tobytes())
+            for n, names in ((self.number_of_entities(), self.entities()),
+                    (self.number_of_relationships(), self.meta_['relationships'])):
+                h.update('{}\n'.format(n).encode('utf-8'))
+                for name in names:
+                    h.update(name.encode('utf-8') + b'\0')
+            self.fingerprint_ = h.hexdigest()
+        return self.fingerprint_
+
+    def transition_matrix(self):
+        """
+        :return M: StreamedMatrix, the column-stochastic transition matrix
+        """
+        if self.transition_matrix_ is None:
+            self.transition_matrix_ = StreamedMatrix(self)
+        return self.transition_matrix_
+
+    def store_pref(self, x):
+        """
+        :param x: np.array (n_entities,) random walk vector, not modified
+            afterwards
+        """
+        self.preference_vector_ = x
+
+    def reset(self):
+        self.preference_vector_ = None
+
+    def entity_value(self, entity):
+        return np.log(self.preference_vector_[self.entity_id(entity)] + 1)
+
+    def triple_value(self, triple):
+        e1, _, e2 = triple
+        x = self.preference_vector_
+        return np.log(x[self.entity_id(e1)] * x[self.entity_id(e2)] + 1)
+
+    def valued_triples(self):
+        """
+        :return triples: generator of ((e1, r, e2), value) pairs of the
+            triples of positive value, see KnowledgeGraph.valued_triples
+
+        Values are computed a block at a time, and only the names of
+        triples of positive value are read, but callers that keep the
+        triples, like Heap, hold all of them in memory.
+        """
+        x = self.preference_vector_
+        for head, rel, tail in self.blocks(('head', 'rel', 'tail')):
+            x1, x2 = x[head], x[tail]
+            values = np.log(x1 + 1) + np.log(x2 + 1) + np.log(x1 * x2 + 1)
+            positive = np.flatnonzero(values > 0)
+            for eid1, rid, eid2, value in zip(head[positive].tolist(), rel[positive].tolist(),
+                    tail[positive].tolist(), values[positive]):
+                yield (self.id_entity(eid1), self.id_relationship(rid),
+                        self.id_entity(eid2)), value
+
+    def is_entity(self, s):
+        return self.source_.is_entity(s)
+
+    def query_dir(self):
+        return self.source_.query_dir()
+
+    def topic_dir(self):
+        return self.source_.topic_dir()
+
+    def mid_dir(self):
+        return self.source_.mid_dir()
+
+    def topics(self):
+        return self.source_.topics()
+
+    def topic_mids(self):
+        return self.source_.topic_mids()
+
+    def entity_names(self):
+        return self.source_.entity_names()
@@ -0,0 +1,67 @@
+"""Overlapping the I/O-bound and compute-bound parts of a run.
+
+Simulating a user's query log mostly waits on reading and decoding
+json questions, while summarizing and evaluating leave the disk idle.
+prefetch() computes the next items on a background thread while the
+caller works on the current one, so a run takes close to the longer of
+the two instead of their sum.
+"""
+
+import queue
+import threading
+
+_DONE = object()
+
+
+def prefetch(fn, items, depth=2):
+    """
+    :param fn: function called as fn(item) on a background thread
+    :param items: iterable of items
+    :param depth: maximum number of results computed ahead of the caller
+    :return results: generator of (item, fn(item)) pairs, in order of items
+
+    Items are processed one at a time in order, so fn may use state
+    that depends on previous calls. Exceptions raised by fn are raised
+    by the generator at the position of the failing item. Closing the
+    generator early stops the background thread after its current item.
+    """
+    results = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+
+    def put(entry):
+        # Give up waiting for space once the consumer is gone
+        while not stopped.is_set():
+            try:
+                results.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        for item in items:
+            if stopped.is_set():
+                return
+            try:
+                entry = (item, fn(item), None)
+            except Exception as e:
+                put((item, None, e))
+                return
+            if not put(entry):
+                return
+        put(_DONE)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            entry = results.get()
+            if entry is _DONE:
+                return
+            item, result, error = entry
+            if error is not None:
+                raise error
+            yield item, result
+    finally:
+        stopped.set()
+        thread.join()
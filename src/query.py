@@ -3,6 +3,9 @@ import sys
 import os
 import json
 import random
+import threading
+
+import numpy as np
 
 from collections import defaultdict
 
@@ -121,6 +124,140 @@ def load_questions_from_file(query_dir, fname):
     return {qid: load_question(
         os.path.join(query_dir, '{}.json'.format(qid))) for qid in qids}
 
+def append_questions(questions, packed_fname):
+    """
+    :param questions: list of dict questions in WebQSP format
+    :param packed_fname: packed query filename
+
+    A packed query file stores many questions in one file,
+    one json-encoded question per line.
+    """
+    for question in questions:
+        if not check_question(question):
+            raise ValueError('Incorrectly formatted question')
+
+    with open(packed_fname, 'a') as f:
+        for question in questions:
+            f.write(json.dumps(question))
+            f.write('\n')
+
+def load_packed_questions(packed_fname):
+    """
+    :param packed_fname: packed query filename
+    :return questions: dict of {query ID (str) : question (dict)}
+    """
+    questions = {}
+    with open(packed_fname, 'r') as f:
+        for line in f:
+            question = json.loads(line)
+            if not check_question(question):
+                raise ValueError('Incorrectly formatted question')
+            questions[question['QuestionId']] = question
+    return questions
+
+class QueryPool(object):
+    """A size-bounded pool of decoded questions from a query directory,
+    for drawing random queries without reading them from disk each time."""
+
+    class Generation(object):
+        """For use inside the QueryPool class only"""
+
+        def __init__(self, query_dir, fnames):
+            """
+            :param query_dir: directory where queries are saved as json
+            :param fnames: query filenames in this generation of the pool
+            """
+            self.query_dir_, self.fnames_ = query_dir, fnames
+            self.questions_ = [None] * len(fnames)
+            self.thread_ = threading.Thread(target=self.load, daemon=True)
+
+        def __len__(self):
+            return len(self.fnames_)
+
+        def __getitem__(self, i):
+            """
+            :param i: slot index
+            :return question: dict question in WebQSP format
+            """
+            if self.questions_[i] is None: # not prefetched yet
+                self.questions_[i] = load_question(
+                        os.path.join(self.query_dir_, self.fnames_[i]))
+            return self.questions_[i]
+
+        def load(self):
+            """Decode every question in this generation, in slot order"""
+            for i in range(len(self)):
+                self[i]
+
+    def __init__(self, query_dir, size=10000, refresh_every=None, seed=0, prefetch=True):
+        """
+        :param query_dir: directory where queries are saved as json
+        :param size: max number of decoded questions held in memory, a
+            random subset of larger directories, or None to hold every
+            question of the directory
+        :param refresh_every: swap in a new random subset of the directory
+            after this many draws, or never if None
+        :param seed: seed for choosing which files are in the pool
+        :param prefetch: decode questions on a background thread
+        """
+        self.query_dir_ = query_dir
+        self.fnames_ = sorted(os.listdir(query_dir))
+        self.size_ = len(self.fnames_) if size is None else min(size, len(self.fnames_))
+        self.refresh_every_ = refresh_every
+        self.rng_ = np.random.RandomState(seed)
+        self.prefetch_ = prefetch
+
+        self.n_draws_ = 0
+        self.current_ = self._generation()
+        self.next_ = self._generation() if self._refreshes() else None
+
+    def __len__(self):
+        return self.size_
+
+    def _refreshes(self):
+        """
+        :return: whether the pool ever swaps in a new subset of files
+        """
+        return self.refresh_every_ is not None and self.size_ < len(self.fnames_)
+
+    def _generation(self):
+        """
+        :return generation: QueryPool.Generation, loading in the background
+
+        Generations are drawn in a fixed order from the pool's own
+        generator, so the pool's contents only depend on seed.
+        """
+        if self.size_ == len(self.fnames_):
+            fnames = self.fnames_
+        else:
+            indices = self.rng_.choice(len(self.fnames_), size=self.size_, replace=False)
+            fnames = [self.fnames_[i] for i in indices]
+
+        generation = QueryPool.Generation(self.query_dir_, fnames)
+        if self.prefetch_:
+            generation.thread_.start()
+        return generation
+
+    def wait(self):
+        """Block until the current generation is fully decoded"""
+        if self.current_.thread_.is_alive():
+            self.current_.thread_.join()
+        self.current_.load()
+
+    def sample(self, n, rng=np.random):
+        """
+        :param n: number of questions to draw, with replacement
+        :param rng: np.random.RandomState or the np.random module
+        :return questions: list of dict questions in WebQSP format
+        """
+        if self._refreshes() and self.n_draws_ >= self.refresh_every_:
+            self.current_, self.next_ = self.next_, self._generation()
+            self.n_draws_ = 0
+        self.n_draws_ += n
+
+        indices = rng.randint(len(self.current_), size=n)
+        return [self.current_[i] for i in indices]
+
 def load_qids(fname):
     """
     :param fname: file listing query IDs
@@ -149,10 +286,33 @@ def is_webqsp_query(query):
 def get_name(mid, entity_names):
     """
     :param mid: entity MID (str)
-    :param entity_names: dict of {MID: label}
+    :param entity_names: dict or StringIndex of {MID: label}
     :return name: str or None
     """
-    return entity_names[mid] if mid in entity_names else mid
+    return entity_names.get(mid, mid)
+
+def filter_by_constraint(KG, candidates, predicate, argument):
+    """
+    :param KG: object that can be accessed by {subject: {predicate: {object}}}
+    :param candidates: set of candidate entities
+    :param predicate: constraint relation
+    :param argument: constraint argument
+    :return candidates: subset of candidates e with (e, predicate, argument) in KG
+
+    If the KG keeps a reverse index, the entities that fit the constraint
+    are looked up once from the argument side instead of probing each
+    candidate's outgoing edges.
+    """
+    if getattr(KG, 'has_reverse_index', None) and KG.has_reverse_index():
+        return candidates.intersection(KG.heads(argument, predicate))
+
+    remove = set()
+    for entity in candidates:
+        if entity not in KG or \
+            predicate not in KG[entity] or \
+            argument not in KG[entity][predicate]:
+            remove.add(entity)
+    return candidates.difference(remove)
 
 def answer_query(KG, query):
     """
@@ -179,22 +339,16 @@ def answer_query(KG, query):
                 candidates.update(KG[entity][predicate])
 
         # Remove candidates that don't fit the constraints
-        remove = set()
         for constraint in constraints[index]:
             argument, predicate = constraint['Argument'], constraint['NodePredicate']
-            for entity in candidates:
-                if entity not in KG or \
-                    predicate not in KG[entity] or \
-                    argument not in KG[entity][predicate]:
-                    remove.add(entity)
+            candidates = filter_by_constraint(KG, candidates, predicate, argument)
 
-        candidates = candidates.difference(remove)
         result = candidates
 
     return result.difference({topic_mid}) # topic entity cannot be part of answer
 
 def generate_query(KG, topic_mid, chain_len=2, qid=0,
-        entity_names={}, constraint_index=None, exclude_preds=[]):
+        entity_names={}, constraint_index=None, exclude_preds=[], py_rng=random):
     """
     :param KG: object that can be accessed by {subject: {predicate: {object}}}
     :param topic_mid: str ID of the query's topic entity
@@ -203,6 +357,7 @@ def generate_query(KG, topic_mid, chain_len=2, qid=0,
     :param entity_names: mapping of {entity ID: label}
     :param contrain_index: optional index at [0, chain_len - 1] to place a constraint
     :param exclude_preds: predicates to exclude from generated query
+    :param py_rng: random.Random or the random module
     :return query: query following WebQSP query structure, without metadata/comments
     """
     inferential_chain = []
@@ -217,11 +372,11 @@ def generate_query(KG, topic_mid, chain_len=2, qid=0,
         if not predicates:
             break
 
-        predicate = random.choice(predicates)
+        predicate = py_rng.choice(predicates)
         inferential_chain.append(predicate)
 
         entities = KG[entity][predicate]
-        entity = random.choice(list(entities))
+        entity = py_rng.choice(sorted(entities))
 
     # Add constraints and get the answers
     result = {topic_mid}
@@ -233,16 +388,16 @@ def generate_query(KG, topic_mid, chain_len=2, qid=0,
                 candidates.update(KG[entity][predicate])
 
         if candidates and constraint_index == index:
-            entity = random.choice(list(candidates))
+            entity = py_rng.choice(sorted(candidates))
             predicates = [
                 pred for pred in KG[entity] if pred not in inferential_chain \
                     and pred not in exclude_preds
             ] if entity in KG else []
 
             if predicates:
-                predicate = random.choice(predicates)
+                predicate = py_rng.choice(predicates)
                 if KG[entity][predicate]:
-                    argument = random.choice(list(KG[entity][predicate]))
+                    argument = py_rng.choice(sorted(KG[entity][predicate]))
                     constraints.append({
                         'SourceNodeIndex': index,
                         'NodePredicate': predicate,
@@ -250,13 +405,7 @@ def generate_query(KG, topic_mid, chain_len=2, qid=0,
                         'EntityName': get_name(entity, entity_names)
                     })
 
-                    remove = set()
-                    for entity in candidates:
-                        if entity not in KG or \
-                            predicate not in KG[entity] or \
-                            argument not in KG[entity][predicate]:
-                            remove.add(entity)
-                    candidates = candidates.difference(remove)
+                    candidates = filter_by_constraint(KG, candidates, predicate, argument)
 
         result = candidates
 
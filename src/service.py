@@ -0,0 +1,379 @@
+"""Resident summarization service.
+
+The KG is loaded once, and summaries are requested over HTTP:
+
+    POST /summarize  {"query_log": [...], "K": 1000, "method": "glimpse",
+                      "format": "json" | "binary"}
+    GET  /metrics    latency percentiles and counters, as json
+    GET  /health
+
+The response is the summary in the export format of src/export.py.
+Requests are run by a pool of worker threads. The random walks of
+concurrent requests are batched into one sparse matrix-matrix product,
+and since user preferences are stored on the KG, the greedy selection
+of each summary runs while holding the KG's lock. Requests beyond the
+queue capacity are rejected with 503 instead of piling up, and with a
+SummaryCache (see src/cache.py), repeated requests skip the queue.
+"""
+
+import json
+import queue
+import logging
+import threading
+import urllib.request
+
+import numpy as np
+
+from time import perf_counter
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from . import export
+from .cache import summary_key
+from .algorithms import RandomWalk, query_vector
+from .glimpse import GLIMPSE, greedy_summary
+
+class Overloaded(Exception):
+    """Raised when a request arrives while the service queue is full"""
+
+
+class LatencyStats(object):
+
+    def __init__(self, window=1000):
+        """
+        :param window: number of latest measurements kept per stage
+        """
+        self.window_ = window
+        self.seconds_ = {}
+        self.counters_ = {}
+        self.lock_ = threading.Lock()
+
+    def record(self, name, seconds):
+        """
+        :param name: stage of a request, e.g. 'total' or 'greedy'
+        :param seconds: time spent in the stage
+        """
+        with self.lock_:
+            if name not in self.seconds_:
+                self.seconds_[name] = deque(maxlen=self.window_)
+            self.seconds_[name].append(seconds)
+
+    def count(self, name, n=1):
+        """
+        :param name: counter, e.g. 'rejected'
+        :param n: increment
+        """
+        with self.lock_:
+            self.counters_[name] = self.counters_.get(name, 0) + n
+
+    def summary(self):
+        """
+        :return summary: dict of counters and of latency percentiles per stage
+        """
+        with self.lock_:
+            summary = {'counters': dict(self.counters_), 'latency': {}}
+            for name, seconds in self.seconds_.items():
+                seconds = np.array(seconds)
+                summary['latency'][name] = {
+                    'count': len(seconds),
+                    'mean': float(seconds.mean()),
+                    'p50': float(np.percentile(seconds, 50)),
+                    'p90': float(np.percentile(seconds, 90)),
+                    'p99': float(np.percentile(seconds, 99))
+                }
+            return summary
+
+
+class RWRBatcher(object):
+    """Batches random walks submitted by concurrent requests"""
+
+    def __init__(self, M, batch_size=16, max_wait=0.005, stats=None):
+        """
+        :param M: scipy sparse transition matrix
+        :param batch_size: maximum number of seed vectors per batch
+        :param max_wait: seconds to wait for more vectors to fill a batch
+        :param stats: optional LatencyStats to count batches in
+        """
+        self.M_ = M
+        self.batch_size_, self.max_wait_ = batch_size, max_wait
+        self.stats_ = stats
+        self.queue_ = queue.Queue()
+        self.thread_ = threading.Thread(target=self._run, daemon=True)
+        self.thread_.start()
+
+    def submit(self, x, power=1):
+        """
+        :param x: np.array (n_entities,) seed initializations
+        :param power: number of terms in Taylor expansion
+        :return future: Future of the random walk vector
+        """
+        future = Future()
+        self.queue_.put((x, power, future))
+        return future
+
+    def close(self):
+        self.queue_.put(None)
+        self.thread_.join()
+
+    def _next_batch(self):
+        """
+        :return batch, closed: list of queued (x, power, future), and
+            whether close() was called
+        """
+        item = self.queue_.get()
+        if item is None:
+            return [], True
+
+        batch = [item]
+        deadline = perf_counter() + self.max_wait_
+        while len(batch) < self.batch_size_:
+            timeout = deadline - perf_counter()
+            try:
+                item = self.queue_.get(timeout=timeout) if timeout > 0 \
+                        else self.queue_.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self):
+        closed = False
+        while not closed:
+            batch, closed = self._next_batch()
+
+            # One walk over the stacked seed vectors, up to the largest
+            # power, since columns are normalized independently
+            try:
+                walk = RandomWalk(self.M_, np.column_stack([x for x, _, _ in batch]))
+                for i, (_, power, future) in enumerate(batch):
+                    future.set_result(walk.vector(power)[:, i])
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            if self.stats_ is not None:
+                self.stats_.count('rwr_batches')
+                self.stats_.count('rwr_vectors', len(batch))
+
+
+class SummaryService(object):
+
+    def __init__(self, KG, methods, n_workers=4, max_pending=64,
+            batch_size=16, batch_wait=0.005, cache=None):
+        """
+        :param KG: loaded KnowledgeGraph
+        :param methods: {name: SummaryMethod} that requests can choose from
+        :param n_workers: number of worker threads running requests
+        :param max_pending: maximum number of queued and running
+            requests, beyond which requests are rejected
+        :param batch_size: maximum number of random walks per batch
+        :param batch_wait: seconds to wait for more random walks to batch
+        :param cache: optional SummaryCache answering repeated requests
+        """
+        self.KG_, self.methods_ = KG, methods
+        self.cache_ = cache
+        self.max_pending_ = max_pending
+        self.pending_ = 0
+        self.pending_lock_ = threading.Lock()
+        self.KG_lock_ = threading.Lock()
+
+        self.stats_ = LatencyStats()
+        self.batcher_ = RWRBatcher(KG.transition_matrix(), batch_size=batch_size,
+                max_wait=batch_wait, stats=self.stats_)
+        self.pool_ = ThreadPoolExecutor(n_workers)
+
+    def stats(self):
+        return self.stats_
+
+    def submit(self, query_log, K, method):
+        """
+        :param query_log: list of dict queries
+        :param K: number of triples in summary
+        :param method: name of a summary method
+        :return future: Future of the Summary
+        """
+        if method not in self.methods_:
+            raise ValueError('Unknown method: {}'.format(method))
+        if K < 1:
+            raise ValueError('K must be positive: {}'.format(K))
+        for query in query_log:
+            if not self.KG_.has_entity(query['Parse']['TopicEntityMid']):
+                raise ValueError('Unknown topic entity: {}'.format(
+                    query['Parse']['TopicEntityMid']))
+
+        key = None
+        if self.cache_ is not None:
+            key = summary_key(self.KG_, K, query_log, self.methods_[method])
+            S = self.cache_.get(self.KG_, key)
+            if S is not None:
+                self.stats_.count('cache_hits')
+                future = Future()
+                future.set_result(S)
+                return future
+
+        with self.pending_lock_:
+            if self.pending_ >= self.max_pending_:
+                self.stats_.count('rejected')
+                raise Overloaded()
+            self.pending_ += 1
+
+        self.stats_.count('accepted')
+        future = self.pool_.submit(self._summarize, query_log, K,
+                self.methods_[method], perf_counter(), key)
+        future.add_done_callback(self._done)
+        return future
+
+    def summarize(self, query_log, K, method):
+        """
+        :return S: Summary, see submit()
+        """
+        return self.submit(query_log, K, method).result()
+
+    def _done(self, future):
+        with self.pending_lock_:
+            self.pending_ -= 1
+        if future.exception() is not None:
+            self.stats_.count('errors')
+
+    def _summarize(self, query_log, K, summary_method, t_submit, key=None):
+        """
+        :param query_log: list of dict queries
+        :param K: number of triples in summary
+        :param summary_method: SummaryMethod
+        :param t_submit: perf_counter() when the request was accepted
+        :param key: summary_key to cache the summary under, if caching
+        :return S: Summary
+        """
+        S = self._compute(query_log, K, summary_method, t_submit)
+        if key is not None:
+            self.cache_.put(key, S)
+        return S
+
+    def _compute(self, query_log, K, summary_method, t_submit):
+        t0 = perf_counter()
+        self.stats_.record('queue', t0 - t_submit)
+
+        # Only GLIMPSE is split into batched walks and greedy selection,
+        # other methods run as a whole while holding the lock
+        if summary_method.fn() is not GLIMPSE:
+            with self.KG_lock_:
+                S = summary_method(self.KG_, K, query_log)
+            self.stats_.record('total', perf_counter() - t_submit)
+            return S
+
+        kwargs = summary_method.kwargs()
+        x = self.batcher_.submit(query_vector(self.KG_, query_log),
+                power=kwargs.get('power', 1)).result()
+        t1 = perf_counter()
+        self.stats_.record('rwr', t1 - t0)
+
+        with self.KG_lock_:
+            t2 = perf_counter()
+            self.KG_.store_pref(x)
+            S = greedy_summary(self.KG_, K, epsilon=kwargs.get('epsilon', 1e-3),
+                    budget=kwargs.get('budget', False))
+        t3 = perf_counter()
+        self.stats_.record('lock_wait', t2 - t1)
+        self.stats_.record('greedy', t3 - t2)
+        self.stats_.record('total', t3 - t_submit)
+        return S
+
+    def close(self):
+        self.pool_.shutdown()
+        self.batcher_.close()
+
+
+class SummaryRequestHandler(BaseHTTPRequestHandler):
+    """Serves the SummaryService of self.server"""
+
+    def _send(self, code, body, content_type='application/json', headers={}):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, code, message, headers={}):
+        self._send(code, json.dumps({'error': message}), headers=headers)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._send(200, json.dumps({'status': 'ok'}))
+        elif self.path == '/metrics':
+            self._send(200, json.dumps(self.server.service_.stats().summary()))
+        else:
+            self._error(404, 'Not found')
+
+    def do_POST(self):
+        if self.path != '/summarize':
+            self._error(404, 'Not found')
+            return
+
+        try:
+            request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            query_log, K = request['query_log'], int(request['K'])
+            method = request.get('method', 'glimpse')
+            fmt = request.get('format', 'json')
+            if fmt not in ('json', 'binary'):
+                raise ValueError('Unknown format: {}'.format(fmt))
+            future = self.server.service_.submit(query_log, K, method)
+        except Overloaded:
+            self._error(503, 'Too many pending requests', headers={'Retry-After': '1'})
+            return
+        except (ValueError, KeyError, TypeError) as e:
+            self._error(400, 'Bad request: {}'.format(e))
+            return
+
+        try:
+            S = future.result()
+        except Exception as e:
+            logging.exception('Summarization failed')
+            self._error(500, 'Summarization failed: {}'.format(e))
+            return
+
+        if fmt == 'binary':
+            self._send(200, export.to_bytes(S), content_type='application/octet-stream')
+        else:
+            self._send(200, export.dumps(S))
+
+    def log_message(self, fmt, *args):
+        logging.debug('{} - {}'.format(self.address_string(), fmt % args))
+
+
+def make_server(service, host='127.0.0.1', port=8000):
+    """
+    :param service: SummaryService
+    :param host: address to listen on
+    :param port: port to listen on, 0 for any free port
+    :return server: ThreadingHTTPServer, started with serve_forever()
+    """
+    server = ThreadingHTTPServer((host, port), SummaryRequestHandler)
+    server.daemon_threads = True
+    server.service_ = service
+    return server
+
+def request_summary(url, query_log, K, method='glimpse', fmt='json', timeout=None):
+    """
+    :param url: base URL of the service, e.g. http://127.0.0.1:8000
+    :param query_log: list of dict queries
+    :param K: number of triples in summary
+    :param method: name of a summary method
+    :param fmt: 'json' or 'binary'
+    :param timeout: optional timeout in seconds
+    :return summary: dict or bytes in the export format
+    """
+    body = json.dumps({'query_log': query_log, 'K': K, 'method': method, 'format': fmt})
+    request = urllib.request.Request(url.rstrip('/') + '/summarize', data=body.encode('utf-8'),
+            headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        data = response.read()
+    return data if fmt == 'binary' else json.loads(data.decode('utf-8'))
@@ -0,0 +1,119 @@
+"""Multi-threaded sparse matrix products for random walks.
+
+SciPy multiplies a sparse matrix by a vector on one core. The products
+of random_walk_with_restart are split into blocks of rows with about
+equal numbers of nonzeros, which a thread pool multiplies at the same
+time; SciPy's kernels release the GIL, so the blocks run in parallel.
+Every row is computed exactly as SciPy computes it, so results are
+identical to single-threaded products.
+
+The backend is selected at runtime, for the whole process:
+
+    use_threads(16)     # products of large matrices on 16 threads
+    use_scipy()         # back to SciPy, the default
+
+Forked worker processes start their own thread pool on first use.
+"""
+
+import os
+import weakref
+
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+from scipy.sparse import csr_matrix, issparse
+
+# Matrices with fewer nonzeros are not worth the threads' overhead
+MIN_NNZ = 1 << 16
+
+_N_THREADS = 1
+_POOL = None
+_POOL_PID = None
+# id(M): BlockMatrix of M, while M is alive
+_OPERATORS = {}
+
+
+def use_threads(n_threads):
+    """
+    :param n_threads: number of threads to multiply large matrices with,
+        1 to use SciPy
+    """
+    global _N_THREADS, _POOL, _POOL_PID
+    if _POOL is not None and _POOL_PID == os.getpid():
+        _POOL.shutdown()
+    _N_THREADS, _POOL, _POOL_PID = max(1, n_threads), None, None
+    _OPERATORS.clear()
+
+def use_scipy():
+    """Multiply with SciPy on the calling thread"""
+    use_threads(1)
+
+def n_threads():
+    return _N_THREADS
+
+def _pool():
+    global _POOL, _POOL_PID
+    # Threads of a pool do not survive a fork
+    if _POOL is None or _POOL_PID != os.getpid():
+        _POOL, _POOL_PID = ThreadPoolExecutor(_N_THREADS), os.getpid()
+    return _POOL
+
+
+class BlockMatrix(object):
+    """Sparse matrix split into row blocks multiplied in parallel"""
+
+    def __init__(self, M, n_blocks):
+        """
+        :param M: scipy sparse matrix
+        :param n_blocks: number of row blocks
+        """
+        M = csr_matrix(M)
+        self.shape = M.shape
+        self.dtype = M.dtype
+
+        # Block boundaries at about equal numbers of nonzeros
+        bounds = np.searchsorted(M.indptr, np.linspace(0, M.nnz, n_blocks + 1))
+        bounds[0], bounds[-1] = 0, M.shape[0]
+        bounds = np.unique(bounds)
+        self.blocks_ = [(start, end, M[start:end])
+                for start, end in zip(bounds[:-1].tolist(), bounds[1:].tolist())]
+
+    def dot(self, x):
+        """
+        :param x: np.array (n_columns,) or (n_columns, k)
+        :return y: np.array (n_rows,) or (n_rows, k), M * x
+        """
+        x = np.asarray(x)
+        y = np.empty((self.shape[0],) + x.shape[1:],
+                dtype=np.result_type(self.dtype, x.dtype))
+
+        def multiply(block):
+            start, end, B = block
+            y[start:end] = B.dot(x)
+
+        for future in [_pool().submit(multiply, block) for block in self.blocks_]:
+            future.result()
+        return y
+
+    def __mul__(self, x):
+        return self.dot(x)
+
+    def __matmul__(self, x):
+        return self.dot(x)
+
+
+def operator(M):
+    """
+    :param M: scipy sparse matrix, or another operator with a dot method
+    :return M: M, or its BlockMatrix if products of a sparse M are
+        multi-threaded
+
+    BlockMatrix instances are kept as long as M is alive, so repeated
+    walks over the same transition matrix split it only once.
+    """
+    if _N_THREADS == 1 or not issparse(M) or M.nnz < MIN_NNZ:
+        return M
+    if id(M) not in _OPERATORS:
+        _OPERATORS[id(M)] = BlockMatrix(M, _N_THREADS)
+        weakref.finalize(M, _OPERATORS.pop, id(M), None)
+    return _OPERATORS[id(M)]
@@ -0,0 +1,223 @@
+"""Online ingestion of production query logs.
+
+Production logs arrive as WebQSP-format questions, one json object per
+line, each with an extra user ID field. Instead of keeping every user's
+full log, only exponentially decayed counts of each user's topic
+entities are kept; these are exactly the seeds that query_vector would
+build from the log, with older queries weighted down.
+"""
+
+import json
+import time
+import logging
+
+import numpy as np
+
+from .query import check_question
+from .glimpse import greedy_summary
+
+def tail_questions(fname, user_key='UserId', follow=True, poll_interval=1.):
+    """
+    :param fname: json lines file that queries are appended to
+    :param user_key: field of each line holding the user ID
+    :param follow: keep waiting for new lines at the end of the file
+    :param poll_interval: seconds to sleep when no new line is available
+    :return questions: generator of (user, question) pairs
+
+    Lines that are not valid json or not correctly formatted
+    questions are logged and skipped.
+    """
+    with open(fname, 'r') as f:
+        partial = ''
+        while True:
+            line = partial + f.readline()
+            if not line.endswith('\n'):
+                if not follow and not line:
+                    break
+                elif follow:
+                    # Wait for the writer to finish the line
+                    partial = line
+                    time.sleep(poll_interval)
+                    continue
+
+            partial = ''
+            if not line.strip():
+                continue
+
+            try:
+                question = json.loads(line)
+            except ValueError:
+                logging.warning('Skipping malformed line in {}'.format(fname))
+                continue
+
+            if user_key not in question or not check_question(question):
+                logging.warning('Skipping incorrectly formatted question')
+                continue
+            yield question[user_key], question
+
+
+class DecayedCounts(object):
+
+    def __init__(self, half_life, min_weight=1e-3):
+        """
+        :param half_life: seconds after which a query counts half as much
+        :param min_weight: decayed weights below this are dropped
+        """
+        self.rate_ = np.log(2) / half_life
+        self.min_weight_ = min_weight
+
+        # Per user: {entity ID: weight scaled to the user's landmark time}
+        self.counts_ = {}
+        self.landmark_ = {}
+
+    def users(self):
+        return list(self.counts_)
+
+    def _scale(self, user, t):
+        """
+        :return scale: factor from a weight at time t to a stored weight
+        """
+        return np.exp(self.rate_ * (t - self.landmark_[user]))
+
+    def add(self, user, eid, t, count=1.):
+        """
+        :param user: user ID
+        :param eid: topic entity integer ID
+        :param t: float timestamp of the query
+        :param count: weight of the query at time t
+
+        Weights are stored relative to a per-user landmark time, so adding
+        a query does not touch the user's other entries. Entries are only
+        rescaled when the landmark gets too old to represent weights.
+        """
+        if user not in self.counts_:
+            self.counts_[user], self.landmark_[user] = {}, t
+
+        if self.rate_ * (t - self.landmark_[user]) > 200:
+            self._rescale(user, t)
+        scale = self._scale(user, t)
+
+        counts = self.counts_[user]
+        counts[eid] = counts.get(eid, 0.) + count * scale
+
+    def _rescale(self, user, t):
+        """Move the user's landmark to time t, dropping negligible weights"""
+        decay = np.exp(-self.rate_ * (t - self.landmark_[user]))
+        self.counts_[user] = {
+            eid: weight * decay for eid, weight in self.counts_[user].items()
+            if weight * decay >= self.min_weight_
+        }
+        self.landmark_[user] = t
+
+    def vector(self, user, n_entities, t):
+        """
+        :param user: user ID
+        :param n_entities: length of the vector
+        :param t: float timestamp to decay weights to
+        :return x: np.array (n_entities,) decayed seed weights, as query_vector
+        """
+        x = np.zeros(n_entities)
+        if user in self.counts_:
+            counts = self.counts_[user]
+            eids = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+            x[eids] = np.fromiter(counts.values(), dtype=np.float64, count=len(counts))
+            x *= np.exp(-self.rate_ * (t - self.landmark_[user]))
+        return x
+
+
+class StreamingSummarizer(object):
+
+    def __init__(self, KG, K, half_life=7 * 24 * 3600., refresh_every=50,
+            refresh_interval=None, epsilon=1e-3, power=1, on_refresh=None):
+        """
+        :param KG: loaded KnowledgeGraph
+        :param K: number of triples per summary
+        :param half_life: seconds after which a query counts half as much
+        :param refresh_every: re-summarize a user after this many new queries
+        :param refresh_interval: or after this many seconds since the last
+            summary, if the user has new queries
+        :param epsilon: GLIMPSE epsilon-from-optimal factor
+        :param power: number of terms in Taylor expansion
+        :param on_refresh: optional function called as on_refresh(user, S)
+        """
+        self.KG_, self.K_ = KG, K
+        self.counts_ = DecayedCounts(half_life)
+        self.refresh_every_ = refresh_every
+        self.refresh_interval_ = refresh_interval
+        self.epsilon_, self.power_ = epsilon, power
+        self.on_refresh_ = on_refresh
+
+        self.pending_ = {} # user: number of queries since last summary
+        self.refreshed_ = {} # user: time of last summary
+        self.summaries_ = {}
+
+    def summary(self, user):
+        """
+        :param user: user ID
+        :return S: latest Summary of the user, or None
+        """
+        return self.summaries_.get(user)
+
+    def ingest(self, user, question, t=None):
+        """
+        :param user: user ID
+        :param question: dict question in WebQSP format
+        :param t: float timestamp, defaults to the question's 'Timestamp'
+            field or the current time
+        :return S: new Summary if this query triggered a refresh, else None
+        """
+        if t is None:
+            t = question.get('Timestamp', time.time())
+
+        topic_mid = question['Parse']['TopicEntityMid']
+        if not self.KG_.has_entity(topic_mid):
+            return None
+
+        self.counts_.add(user, self.KG_.entity_id(topic_mid), t)
+        self.pending_[user] = self.pending_.get(user, 0) + 1
+
+        if self._due(user, t):
+            return self.refresh(user, t)
+        return None
+
+    def _due(self, user, t):
+        """
+        :return: whether the user's summary should be recomputed at time t
+        """
+        if self.refresh_every_ is not None and self.pending_[user] >= self.refresh_every_:
+            return True
+        if self.refresh_interval_ is not None:
+            return t - self.refreshed_.get(user, -np.inf) >= self.refresh_interval_
+        return False
+
+    def refresh(self, user, t=None):
+        """
+        :param user: user ID
+        :param t: float timestamp to decay the user's counts to
+        :return S: Summary of the user's decayed preferences
+        """
+        t = time.time() if t is None else t
+        x = self.counts_.vector(user, self.KG_.number_of_entities(), t)
+
+        self.KG_.model_seed_pref(x, power=self.power_)
+        S = greedy_summary(self.KG_, self.K_, epsilon=self.epsilon_)
+
+        self.summaries_[user] = S
+        self.pending_[user], self.refreshed_[user] = 0, t
+        if self.on_refresh_ is not None:
+            self.on_refresh_(user, S)
+        return S
+
+    def run(self, fname, user_key='UserId', follow=True, poll_interval=1.):
+        """
+        :param fname: json lines file that queries are appended to
+        :param user_key: field of each line holding the user ID
+        :param follow: keep waiting for new lines at the end of the file
+        :param poll_interval: seconds to sleep when no new line is available
+        """
+        for user, question in tail_questions(fname, user_key=user_key,
+                follow=follow, poll_interval=poll_interval):
+            S = self.ingest(user, question)
+            if S is not None:
+                logging.info('Refreshed summary of user {} ({} triples)'.format(
+                    user, S.number_of_triples()))
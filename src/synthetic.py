@@ -0,0 +1,178 @@
+import os
+import shutil
+import weakref
+import tempfile
+
+import numpy as np
+
+from collections import defaultdict
+
+from .base import KnowledgeGraph
+from .generate import generate_queries
+from .query import load_packed_questions, save_question
+
+
+class Synthetic(KnowledgeGraph):
+
+    def __init__(self, n_entities=10000, n_relationships=50, n_triples=100000,
+                 skew=1., seed=0, data_dir=None, query_dir='queries/',
+                 mid_dir='by-mid/', reverse_index=False, n_topic_mids=0):
+        """
+        :param n_entities: number of entities to draw triples between
+        :param n_relationships: number of relationships to draw from
+        :param n_triples: number of distinct triples to generate
+        :param skew: power-law exponent of entity degrees, 0 for uniform
+        :param seed: seed of the generator; the KG only depends on the
+            parameters above and this seed
+        :param data_dir: directory for generated queries, a new temporary
+            directory removed along with the KG if None
+        :param query_dir: directory where queries are saved as json
+        :param mid_dir: directory where lists of query IDs by MID are stored
+        :param reverse_index: also index triples by tail entity after load
+        :param n_topic_mids: if positive, load() also writes queries about
+            this many topic entities, see write_queries
+        """
+        super().__init__(reverse_index=reverse_index)
+        self.name_ = 'Synthetic'
+
+        self.n_entities_ = n_entities
+        self.n_relationships_ = n_relationships
+        self.n_triples_ = n_triples
+        self.skew_ = skew
+        self.seed_ = seed
+        self.n_topic_mids_ = n_topic_mids
+
+        self.data_dir_ = data_dir
+        if data_dir is None:
+            self.data_dir_ = tempfile.mkdtemp(prefix='glimpse-synthetic-')
+            weakref.finalize(self, shutil.rmtree, self.data_dir_, True)
+        self.query_dir_ = os.path.join(self.data_dir_, query_dir)
+        self.mid_dir_ = os.path.join(self.data_dir_, mid_dir)
+
+    def is_entity(self, s):
+        return True
+
+    def query_dir(self):
+        return self.query_dir_
+
+    def mid_dir(self):
+        return self.mid_dir_
+
+    def topic_mids(self):
+        return sorted(fname[:-5] for fname in os.listdir(self.mid_dir_))
+
+    def entity_names(self):
+        return { entity : entity for entity in self.entities() }
+
+    def power_law(self, n, exponent, rng):
+        """
+        :param n: number of items
+        :param exponent: power-law exponent
+        :param rng: np.random.Generator
+        :return p: (n,) probabilities p_i ~ rank_i^-exponent, in random rank order
+        """
+        p = np.arange(1, n + 1, dtype=np.float64) ** -exponent
+        return rng.permutation(p / np.sum(p))
+
+    def sample_triples(self, rng):
+        """
+        :param rng: np.random.Generator
+        :return triples: generator of (e1, r, e2) triples, with repeats
+
+        Heads and tails are drawn from independent power-law popularity
+        rankings over the entities, and relations from a Zipf ranking.
+        """
+        p_head = self.power_law(self.n_entities_, self.skew_, rng)
+        p_tail = self.power_law(self.n_entities_, self.skew_, rng)
+        p_rel = self.power_law(self.n_relationships_, 1., rng)
+
+        while True:
+            n = self.n_triples_
+            heads = rng.choice(self.n_entities_, size=n, p=p_head)
+            rels = rng.choice(self.n_relationships_, size=n, p=p_rel)
+            tails = rng.choice(self.n_entities_, size=n, p=p_tail)
+            for e1, r, e2 in zip(heads.tolist(), rels.tolist(), tails.tolist()):
+                yield 'e{}'.format(e1), 'r{}'.format(r), 'e{}'.format(e2)
+
+    def iter_triples(self, head=None):
+        """
+        :param head: optional number of triples to generate
+        :return triples: generator of the distinct (e1, r, e2) triples of
+            the KG, in the order load adds them
+        """
+        head = self.n_triples_ if head is None else min(head, self.n_triples_)
+        if head > self.n_entities_ ** 2 * self.n_relationships_ // 2:
+            raise ValueError('Too many triples for the number of entities and relations')
+
+        seen = set()
+        for triple in self.sample_triples(np.random.default_rng(self.seed_)):
+            if len(seen) == head:
+                break
+            if triple not in seen:
+                seen.add(triple)
+                yield triple
+
+    def load(self, head=None):
+        for triple in self.iter_triples(head):
+            self.add_triple(triple)
+
+        if self.reverse_index_:
+            self.build_reverse_index()
+
+        self.load_queries()
+
+    def load_queries(self, KG=None):
+        """
+        :param KG: KnowledgeGraph of this KG's triples to answer the
+            queries over, e.g. an out-of-core copy, self if None
+
+        Writes queries about n_topic_mids topic entities, if positive.
+        """
+        if self.n_topic_mids_ > 0:
+            self.write_queries(n_topic_mids=self.n_topic_mids_, seed=self.seed_, KG=KG)
+
+    def write_queries(self, n_topic_mids=50, n_queries_per_mid=20, seed=0,
+            constraint_prob=0.1, KG=None):
+        """
+        :param n_topic_mids: number of topic entities to generate queries for
+        :param n_queries_per_mid: number of queries per topic entity
+        :param seed: seed for choosing topic entities and generating queries
+        :param constraint_prob: prob. of adding a constraint to a query
+        :param KG: KnowledgeGraph to generate queries over, self if None
+
+        Writes WebQSP-format queries under query_dir() and lists of query
+        IDs by topic entity under mid_dir(), following the directory
+        structure expected by generate_queries_by_mid.
+        """
+        for directory in (self.query_dir_, self.mid_dir_):
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+        # Topic entities are drawn among entities with outgoing edges
+        KG = self if KG is None else KG
+        rng = np.random.default_rng(seed)
+        head_ptr = KG.adjacency_arrays()['head_ptr']
+        heads = [KG.id_entity(eid) for eid in np.flatnonzero(np.diff(head_ptr)).tolist()]
+        topic_mids = [
+            heads[i] for i in rng.choice(
+                len(heads), size=min(n_topic_mids, len(heads)), replace=False)
+        ]
+
+        packed_fname = os.path.join(self.data_dir_, 'queries.jsonl')
+        if os.path.isfile(packed_fname):
+            os.remove(packed_fname)
+
+        for i, topic_mid in enumerate(topic_mids):
+            generate_queries(KG, [topic_mid], n_queries_per_mid, packed_fname,
+                    constraint_prob=constraint_prob,
+                    qid_prefix='Synth-{}-'.format(i), seed=[seed, i])
+
+        qids_by_mid = defaultdict(list)
+        for qid, question in load_packed_questions(packed_fname).items():
+            save_question(question, os.path.join(self.query_dir_, '{}.json'.format(qid)))
+            qids_by_mid[question['Parse']['TopicEntityMid']].append(qid)
+
+        for topic_mid, qids in qids_by_mid.items():
+            with open(os.path.join(self.mid_dir_, '{}.list'.format(topic_mid)), 'w') as f:
+                for qid in qids:
+                    f.write('{}\n'.format(qid))
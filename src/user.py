@@ -7,7 +7,7 @@ import numpy as np
 
 from collections import defaultdict
 
-from .query import generate_query, load_question, load_questions_from_file
+from .query import generate_query, load_questions_from_file
 
 
 def reuse(query_log):
@@ -34,6 +34,16 @@ def entity_counts(query_log):
         entities[topic_entity] += 1
     return entities
 
+def topic_counts(query_log):
+    """
+    :param query_log: list of dict WebQSP-style questions
+    :return counts: sorted list of (topic entity MID, count) pairs
+    """
+    counts = defaultdict(int)
+    for query in query_log:
+        counts[query['Parse']['TopicEntityMid']] += 1
+    return sorted(counts.items())
+
 def predicate_counts(query_log):
     """
     :param query_log: list of dict WebQSP-style questions
@@ -45,12 +55,15 @@ def predicate_counts(query_log):
             relations[predicate] += 1
     return relations
 
-def generate_queries_by_topic(KG, topic, n_topic_queries, n_topic_mids):
+def generate_queries_by_topic(KG, topic, n_topic_queries, n_topic_mids,
+        rng=np.random, py_rng=random):
     """
     :param KG: KnowledgeGraph
     :param topic: name of querying topic ("art", "music")
     :param n_topic_queries: number of queries to generate
     :param n_topic_mids: number of unique topic entities in generated queries
+    :param rng: np.random.RandomState or the np.random module
+    :param py_rng: random.Random or the random module
     :return query_log: list of dict
 
     Assumes that there is a directory called
@@ -79,7 +92,7 @@ def generate_queries_by_topic(KG, topic, n_topic_queries, n_topic_mids):
         q3
     """
     # Generate the number of queries per topic MID
-    p = np.random.uniform(size=n_topic_mids)
+    p = rng.uniform(size=n_topic_mids)
     p /= np.sum(p)
     queries_per_mid = np.int64(np.ceil(p * n_topic_queries))
 
@@ -90,23 +103,24 @@ def generate_queries_by_topic(KG, topic, n_topic_queries, n_topic_mids):
     topic_mids = [
         question['Parse']['TopicEntityMid'] for qid, question in queries_of_topic.items()
     ]
-    topic_mids = random.choices(topic_mids, k=n_topic_mids)
+    topic_mids = py_rng.choices(topic_mids, k=n_topic_mids)
 
     # Obtain a selection of queries for each topic MID
     query_log = []
     for topic_mid, n_mid_queries in zip(topic_mids, queries_per_mid):
         n_mid_queries = min(n_mid_queries, n_topic_queries - len(query_log))
         query_log.extend(
-                generate_queries_by_mid(KG, topic_mid, n_mid_queries)
+                generate_queries_by_mid(KG, topic_mid, n_mid_queries, py_rng=py_rng)
         )
 
     return query_log
 
-def generate_queries_by_mid(KG, topic_mid, n_mid_queries):
+def generate_queries_by_mid(KG, topic_mid, n_mid_queries, py_rng=random):
     """
     :param KG: KnowledgeGraph
     :param topic_mid: topic entity of query
     :param n_mid_queries: number of queries to generate
+    :param py_rng: random.Random or the random module
     :return query_log: list of queries (dict)
 
     Assumes that there is a directory called <KG.mid_dir()> that
@@ -145,38 +159,40 @@ def generate_queries_by_mid(KG, topic_mid, n_mid_queries):
             question for question in load_questions_from_file(
                 KG.query_dir(), mid_file).values()
         ]
-        return random.choices(mid_queries, k=n_mid_queries)
+        return py_rng.choices(mid_queries, k=n_mid_queries)
 
     return [
-        generate_query(KG, topic_mid, chain_len=random.randint(1, 3)) for _ in range(n_mid_queries)
+        generate_query(KG, topic_mid, chain_len=py_rng.randint(1, 3), py_rng=py_rng)
+        for _ in range(n_mid_queries)
     ]
 
-def randomize_log(KG, query_log, random_query_prob=0.1, shuffle=False):
+def randomize_log(KG, query_log, random_query_prob=0.1, shuffle=False,
+        rng=np.random, py_rng=random):
     """
     :param KG: KnowledgeGraph
     :param query_log: list of dict queries
     :param random_query_prob: prob. of replacing a query with a random one
     :param shuffle: randomly shuffle the returned log
+    :param rng: np.random.RandomState or the np.random module
+    :param py_rng: random.Random or the random module
     :return query_log: updated query log
     """
     n_random = np.int64(random_query_prob * len(query_log))
-    indices = np.random.randint(len(query_log), size=n_random)
-
-    query_fnames = os.listdir(KG.query_dir())
+    if n_random > 0:
+        indices = rng.randint(len(query_log), size=n_random)
 
-    # Add randomly selected queries at specified indices
-    for index in indices:
-        query_fname = random.choice(query_fnames)
-        query_log[index] = load_question(os.path.join(KG.query_dir(), query_fname))
+        # Add randomly selected queries at specified indices
+        for index, question in zip(indices, KG.query_pool().sample(n_random, rng=rng)):
+            query_log[index] = question
 
     # Randomly shuffle the log
     if shuffle:
-        random.shuffle(query_log)
+        py_rng.shuffle(query_log)
 
     return query_log
 
 def query_log_by_topics(KG, topics, n_mids_per_topic, n_queries_in_log,
-        topic_dist=None, shuffle=False, random_query_prob=0.1):
+        topic_dist=None, shuffle=False, random_query_prob=0.1, rng=np.random, py_rng=random):
     """
     :param KG: KnowledgeGraph
     :param topics: high-level topics in the log ("art", "music")
@@ -185,11 +201,13 @@ def query_log_by_topics(KG, topics, n_mids_per_topic, n_queries_in_log,
     :param topic_dist: if specified, a probability distribution per topic
     :param shuffle: randomly shuffle the returned queries
     :param random_query_prob: prob. of replacing a query with a random one
+    :param rng: np.random.RandomState or the np.random module
+    :param py_rng: random.Random or the random module
     :return query_log: list of query dicts
     """
     # Number of queries per topic
     n_topics = len(topics)
-    topic_dist = np.random.uniform(size=n_topics) if topic_dist is None else topic_dist
+    topic_dist = rng.uniform(size=n_topics) if topic_dist is None else topic_dist
     topic_dist /= np.sum(topic_dist)
     queries_per_topic = np.int64(np.ceil(topic_dist * n_queries_in_log))
 
@@ -198,16 +216,16 @@ def query_log_by_topics(KG, topics, n_mids_per_topic, n_queries_in_log,
     for n_topic_queries, topic in zip(queries_per_topic, topics):
         n_topic_queries = min(n_topic_queries, n_queries_in_log - len(query_log))
         query_log.extend(generate_queries_by_topic(
-            KG, topic, n_topic_queries, n_mids_per_topic))
+            KG, topic, n_topic_queries, n_mids_per_topic, rng=rng, py_rng=py_rng))
 
     # Replace some queries with random ones
     query_log = randomize_log(KG, query_log,
-        random_query_prob=random_query_prob, shuffle=shuffle)
+        random_query_prob=random_query_prob, shuffle=shuffle, rng=rng, py_rng=py_rng)
 
     return query_log
 
 def query_log_by_mids(KG, topic_mids, n_queries_in_log,
-        topic_dist=None, shuffle=False, random_query_prob=0.1):
+        topic_dist=None, shuffle=False, random_query_prob=0.1, rng=np.random, py_rng=random):
     """
     :param KG: KnowledgeGraph
     :param topic_mids: topic entities in the log
@@ -215,10 +233,12 @@ def query_log_by_mids(KG, topic_mids, n_queries_in_log,
     :param topic_dist: if specified, a probability distribution per topic
     :param shuffle: randomly shuffle the returned queries
     :param random_query_prob: prob. of replacing a query with a random one
+    :param rng: np.random.RandomState or the np.random module
+    :param py_rng: random.Random or the random module
     :return query_log: list of query dicts
     """
     n_topics = len(topic_mids)
-    topic_dist = np.random.uniform(size=n_topics) if topic_dist is None else topic_dist
+    topic_dist = rng.uniform(size=n_topics) if topic_dist is None else topic_dist
     topic_dist /= np.sum(topic_dist)
     queries_per_topic = np.int64(np.ceil(topic_dist * n_queries_in_log))
 
@@ -227,10 +247,24 @@ def query_log_by_mids(KG, topic_mids, n_queries_in_log,
     for n_mid_queries, topic_mid in zip(queries_per_topic, topic_mids):
         n_mid_queries = min(n_mid_queries, n_queries_in_log - len(query_log))
         query_log.extend(generate_queries_by_mid(
-            KG, topic_mid, n_mid_queries))
+            KG, topic_mid, n_mid_queries, py_rng=py_rng))
 
     # Replace some queries with random ones
     query_log = randomize_log(KG, query_log,
-        random_query_prob=random_query_prob, shuffle=shuffle)
+        random_query_prob=random_query_prob, shuffle=shuffle, rng=rng, py_rng=py_rng)
 
     return query_log
+
+def split_log(query_log, test_size=0.5, rng=np.random):
+    """
+    :param query_log: list of dict queries
+    :param test_size: fraction of queries to hold out for testing
+    :param rng: np.random.RandomState, or the np.random module
+    :return train_log, test_log: lists of dict queries
+
+    Draws the same split as sklearn's train_test_split with the same
+    generator state, without importing sklearn.
+    """
+    indices = rng.permutation(len(query_log))
+    n_test = int(np.ceil(test_size * len(query_log)))
+    return [query_log[i] for i in indices[n_test:]], [query_log[i] for i in indices[:n_test]]
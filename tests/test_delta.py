@@ -0,0 +1,98 @@
+import os
+import random
+import tempfile
+import unittest
+
+from src import delta, export
+from src.glimpse import Summary
+from src.synthetic import Synthetic
+
+
+class DeltaTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.KG = Synthetic(n_entities=300, n_relationships=20, n_triples=3000)
+        cls.KG.load()
+        cls.triples = list(cls.KG.ordered_triples())
+
+    def setUp(self):
+        self.rng = random.Random(0)
+        fd, self.fname = tempfile.mkstemp(suffix='.glsm')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.fname)
+
+    def summary(self, triples):
+        S = Summary(self.KG)
+        for triple in triples:
+            S.add_triple(triple)
+        return S
+
+    def random_summary(self, previous, n_triples):
+        """
+        :param previous: set of triples of the previous summary
+        :param n_triples: number of triples of the new summary
+        :return triples: set of n_triples triples, keeping a random share
+            of previous and drawing the rest from the KG
+        """
+        kept = self.rng.sample(sorted(previous), self.rng.randint(0, min(len(previous), n_triples)))
+        triples = set(kept)
+        while len(triples) < n_triples:
+            triples.add(self.rng.choice(self.triples))
+        return triples
+
+    def assertPatches(self, data, S):
+        """
+        :param data: bytes of the binary export last shipped, in self.fname
+        :param S: new Summary
+        :return data: patched bytes, equal to the patched file
+        """
+        patch = delta.diff(self.KG, data, S)
+        patched = delta.patch_bytes(data, patch)
+        delta.patch_file(self.fname, patch)
+        with open(self.fname, 'rb') as f:
+            self.assertEqual(f.read(), patched)
+
+        # Patched exports hold the same summary, up to unused names and row order
+        self.assertEqual(export.to_bytes(export.from_bytes(self.KG, patched)),
+                export.to_bytes(S))
+        return patched
+
+    def test_round_trip(self):
+        # Empty to empty, growth from empty, churn, shrinkage, back to empty
+        sizes = [0, 0, 5, 50, 50, 200, 120, 120, 10, 0, 80, 1, 0]
+        sizes += [self.rng.randint(0, 300) for _ in range(40)]
+
+        triples = set()
+        S = self.summary(triples)
+        export.save_summary(S, self.fname)
+        data = export.to_bytes(S)
+        for n_triples in sizes:
+            triples = self.random_summary(triples, n_triples)
+            data = self.assertPatches(data, self.summary(triples))
+
+    def test_unchanged(self):
+        S = self.summary(self.rng.sample(self.triples, 100))
+        export.save_summary(S, self.fname)
+        data = export.to_bytes(S)
+        self.assertEqual(self.assertPatches(data, S), data)
+
+    def test_vocabulary_growth(self):
+        # Only new names, so the triples move for every patch
+        by_head = {}
+        for triple in self.triples:
+            by_head.setdefault(triple[0], triple)
+        heads = sorted(by_head)
+
+        S = self.summary([by_head[heads[0]]])
+        export.save_summary(S, self.fname)
+        data = export.to_bytes(S)
+        for n_heads in (2, 10, 50, 150):
+            data = self.assertPatches(data,
+                    self.summary(by_head[head] for head in heads[:n_heads]))
+
+
+if __name__ == '__main__':
+    unittest.main()
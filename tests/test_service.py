@@ -0,0 +1,98 @@
+import json
+import threading
+import unittest
+import urllib.error
+
+from src import export
+from src.glimpse import GLIMPSE, SummaryMethod
+from src.service import SummaryService, make_server, request_summary
+from src.synthetic import Synthetic
+
+
+def topic_log(KG, n_queries=5):
+    """
+    :param KG: loaded KnowledgeGraph
+    :param n_queries: number of queries
+    :return query_log: queries about the first heads of KG, with only the
+        topic entity the service reads
+    """
+    heads = []
+    for e1, _, _ in KG.ordered_triples():
+        if e1 not in heads:
+            heads.append(e1)
+        if len(heads) == n_queries:
+            break
+    return [{'Parse': {'TopicEntityMid': e1}} for e1 in heads]
+
+
+class SummaryServiceTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.KG = Synthetic(n_entities=300, n_relationships=5, n_triples=3000)
+        cls.KG.load()
+
+    def setUp(self):
+        # Exact greedy selection, as lazy greedy samples with np.random
+        self.method = SummaryMethod(GLIMPSE, 'GLIMPSE', epsilon=None)
+        self.service = SummaryService(self.KG, {'glimpse': self.method},
+                n_workers=2, max_pending=2, batch_wait=0.001)
+        self.server = make_server(self.service, port=0)
+        self.url = 'http://{}:{}'.format(*self.server.server_address)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.service.close()
+
+    def assertStatus(self, code, *args, **kwargs):
+        with self.assertRaises(urllib.error.HTTPError) as context:
+            request_summary(self.url, *args, **kwargs)
+        self.assertEqual(context.exception.code, code)
+        return context.exception
+
+    def test_summarize(self):
+        query_log = topic_log(self.KG)
+        d = request_summary(self.url, query_log, 50)
+        self.assertEqual(len(d['triples']), 50)
+
+        S = export.from_dict(self.KG, d)
+        self.assertTrue(all(self.KG.has_triple(triple) for triple in S.triples()))
+        self.assertEqual(export.to_dict(S),
+                export.to_dict(self.method(self.KG, 50, query_log)))
+
+        data = request_summary(self.url, query_log, 50, fmt='binary')
+        self.assertEqual(export.to_dict(export.from_bytes(self.KG, data)), d)
+
+        counters = self.service.stats().summary()['counters']
+        self.assertEqual(counters['accepted'], 2)
+        self.assertNotIn('errors', counters)
+
+    def test_bad_requests(self):
+        query_log = topic_log(self.KG)
+        for K in (0, -1):
+            self.assertStatus(400, query_log, K)
+        self.assertStatus(400, query_log, 10, method='unknown')
+        self.assertStatus(400, query_log, 10, fmt='xml')
+        self.assertStatus(400, [{'Parse': {'TopicEntityMid': 'unknown'}}], 10)
+
+    def test_overloaded(self):
+        query_log = topic_log(self.KG)
+
+        # Hold the KG so that accepted requests stay pending
+        with self.service.KG_lock_:
+            futures = [self.service.submit(query_log, 10, 'glimpse') for _ in range(2)]
+            error = self.assertStatus(503, query_log, 10)
+            self.assertEqual(error.headers['Retry-After'], '1')
+            self.assertEqual(json.loads(error.read())['error'], 'Too many pending requests')
+
+        for future in futures:
+            self.assertEqual(future.result().number_of_triples(), 10)
+        self.assertEqual(self.service.stats().summary()['counters']['rejected'], 1)
+        self.assertEqual(len(request_summary(self.url, query_log, 10)['triples']), 10)
+
+
+if __name__ == '__main__':
+    unittest.main()